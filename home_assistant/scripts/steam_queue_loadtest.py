@@ -0,0 +1,861 @@
+#!/usr/bin/env python3
+"""
+Steam Deck Queue Processor — load and soak test
+Runs steam_queue_processor.py as a subprocess against local stand-ins and
+drives synthetic traffic at it, fully offline:
+
+  - an in-process MQTT 3.1.1 broker (or an external one, e.g. a local
+    mosquitto, with --broker host:port)
+  - a stub InfluxDB /write endpoint (optionally failing a share of requests,
+    and rejecting every request holding one chosen point, --influx-reject)
+  - a temp directory holding the config, queue journal, library and logs
+
+Several simulated Decks create closed sessions and resend their whole queue
+every tick until each session is ACKed, half of them through the HTTP bridge
+(/process_deck_queue) and half on the retained MQTT queue topic, so unchanged
+and duplicate payloads arrive all the time. A simulated HA sends interleaved
+/game_start + /game_stop pairs. The processor can be restarted mid-run.
+
+At the end the processor is stopped cleanly and the run is checked, the same
+way after SIGKILL restarts (--kill, which also turns on influxdb_durable_ack
+so no points are lost from the processor's memory):
+  - every Deck session was ACKed, once per delivery: a session ACKed again is
+    an error unless its Deck resent it after the previous ACK arrived
+  - every session was applied exactly once (session log, InfluxDB points)
+  - no seconds were double counted: each Deck game's library total equals the
+    end_playtime of its last session, each game_stop game's total equals the
+    sum of its stop durations, and session counts match
+  - with --influx-reject GAME, the first playtime point of GAME is in the
+    processor's reject file and every other point still reached InfluxDB
+
+Reports throughput, ACK latency percentiles and processor memory (RSS, Linux).
+Exit status is 1 when an invariant fails.
+
+Usage:
+  python3 steam_queue_loadtest.py --decks 4 --sessions 4000 --stops 200 --restarts 2
+"""
+
+import argparse
+import gzip
+import http.client
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import paho.mqtt.client as mqtt_client
+
+PROCESSOR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'steam_queue_processor.py')
+
+def log(message):
+    print(f'{datetime.now().strftime("%H:%M:%S")} {message}', flush=True)
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+# ── MQTT broker stub ───────────────────────────────────────────────────────────
+class MqttBroker:
+    """
+    Just enough of MQTT 3.1.1 for the processor and the simulated Decks:
+    CONNECT, PUBLISH (QoS 0/1, retained), SUBSCRIBE with + and # wildcards,
+    PINGREQ and DISCONNECT. Messages are delivered to subscribers at QoS 0.
+    No authentication, no persistence.
+    """
+
+    def __init__(self):
+        self.lock     = threading.Lock()
+        self.retained = {}  # topic → payload
+        self.subs     = []  # (connection, topic filter)
+        self.sock     = None
+        self.port     = None
+
+    def start(self):
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(64)
+        self.port = self.sock.getsockname()[1]
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self):
+        while True:
+            conn, _ = self.sock.accept()
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self.serve, args=(conn, threading.Lock()), daemon=True).start()
+
+    @staticmethod
+    def matches(topic_filter, topic):
+        f_parts, t_parts = topic_filter.split('/'), topic.split('/')
+        for i, part in enumerate(f_parts):
+            if part == '#':
+                return True
+            if i >= len(t_parts) or (part != '+' and part != t_parts[i]):
+                return False
+        return len(f_parts) == len(t_parts)
+
+    @staticmethod
+    def packet(header, body):
+        length, encoded = len(body), b''
+        while True:
+            byte, length = length % 128, length // 128
+            encoded += bytes([byte | (128 if length else 0)])
+            if not length:
+                return bytes([header]) + encoded + body
+
+    def publish_packet(self, topic, payload, retain):
+        topic_bytes = topic.encode()
+        return self.packet(0x30 | int(retain), len(topic_bytes).to_bytes(2, 'big') + topic_bytes + payload)
+
+    @staticmethod
+    def read_exact(conn, n):
+        data = b''
+        while len(data) < n:
+            chunk = conn.recv(n - len(data))
+            if not chunk:
+                raise ConnectionError
+            data += chunk
+        return data
+
+    def send(self, conn, send_lock, data):
+        with send_lock:
+            conn.sendall(data)
+
+    def serve(self, conn, send_lock):
+        try:
+            while True:
+                header = self.read_exact(conn, 1)[0]
+                length, shift = 0, 0
+                while True:
+                    byte = self.read_exact(conn, 1)[0]
+                    length |= (byte & 127) << shift
+                    shift += 7
+                    if not byte & 128:
+                        break
+                body = self.read_exact(conn, length)
+                kind = header >> 4
+                if kind == 1:      # CONNECT
+                    self.send(conn, send_lock, b'\x20\x02\x00\x00')
+                elif kind == 3:    # PUBLISH
+                    self.handle_publish(conn, send_lock, header, body)
+                elif kind == 8:    # SUBSCRIBE
+                    self.handle_subscribe(conn, send_lock, body)
+                elif kind == 10:   # UNSUBSCRIBE
+                    self.send(conn, send_lock, b'\xb0\x02' + body[:2])
+                elif kind == 12:   # PINGREQ
+                    self.send(conn, send_lock, b'\xd0\x00')
+                elif kind == 14:   # DISCONNECT
+                    break
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            with self.lock:
+                self.subs = [(c, f) for c, f in self.subs if c[0] is not conn]
+            conn.close()
+
+    def handle_publish(self, conn, send_lock, header, body):
+        qos, retain = (header >> 1) & 3, header & 1
+        topic_len   = int.from_bytes(body[:2], 'big')
+        topic       = body[2:2 + topic_len].decode()
+        pos         = 2 + topic_len
+        if qos:
+            packet_id = body[pos:pos + 2]
+            pos += 2
+            self.send(conn, send_lock, b'\x40\x02' + packet_id)
+        payload = body[pos:]
+        with self.lock:
+            if retain:
+                if payload:
+                    self.retained[topic] = payload
+                else:
+                    self.retained.pop(topic, None)
+            targets = [c for c, f in self.subs if self.matches(f, topic)]
+        data = self.publish_packet(topic, payload, False)
+        for target, target_lock in targets:
+            try:
+                self.send(target, target_lock, data)
+            except OSError:
+                pass
+
+    def handle_subscribe(self, conn, send_lock, body):
+        packet_id, pos, filters = body[:2], 2, []
+        while pos < len(body):
+            n = int.from_bytes(body[pos:pos + 2], 'big')
+            filters.append(body[pos + 2:pos + 2 + n].decode())
+            pos += 3 + n
+        with self.lock:
+            for topic_filter in filters:
+                self.subs.append(((conn, send_lock), topic_filter))
+            retained = [(t, p) for t, p in self.retained.items() if any(self.matches(f, t) for f in filters)]
+        self.send(conn, send_lock, self.packet(0x90, packet_id + bytes(len(filters))))
+        for topic, payload in retained:
+            self.send(conn, send_lock, self.publish_packet(topic, payload, True))
+
+# ── InfluxDB stub ──────────────────────────────────────────────────────────────
+class InfluxStub:
+    """
+    /write endpoint that keeps the session_count of every playtime point and
+    the sessions field of every rollup point. Like InfluxDB, a point replaces
+    an earlier one of the same series and timestamp. A request holding the
+    first playtime point (session_count 1) of reject_game is answered with 400
+    and nothing in it is stored, like a field type conflict.
+    """
+
+    def __init__(self, error_rate=0.0, reject_game=None):
+        self.lock       = threading.Lock()
+        self.points     = {}  # (game, timestamp) → session_count
+        self.rollups    = {}  # (measurement, game, timestamp) → sessions
+        self.requests   = 0
+        self.errors     = 0
+        self.error_rate = error_rate
+        self.reject_game = reject_game
+        self.rejected    = 0
+        self.server      = None
+
+    def start(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True  # the 400 body goes out after the headers
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                with stub.lock:
+                    stub.requests += 1
+                    fail = random.random() < stub.error_rate
+                    if fail:
+                        stub.errors += 1
+                if fail:
+                    self.send_response(503)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                if self.headers.get('Content-Encoding') == 'gzip':
+                    body = gzip.decompress(body)
+                points = [stub.parse(line) for line in body.decode().splitlines() if line.strip()]
+                if any(stub.rejects(point) for point in points):
+                    with stub.lock:
+                        stub.rejected += 1
+                    detail = b'{"error":"partial write: field type conflict"}'
+                    self.send_response(400)
+                    self.send_header('Content-Length', str(len(detail)))
+                    self.end_headers()
+                    self.wfile.write(detail)
+                    return
+                with stub.lock:
+                    for measurement, game, values, timestamp in points:
+                        if measurement == 'playtime':
+                            stub.points[game, timestamp] = values.get('session_count')
+                        else:
+                            stub.rollups[(measurement, game, timestamp)] = values.get('sessions')
+                self.send_response(204)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.server.server_address[1]
+
+    def rejects(self, point):
+        measurement, game, values, _ = point
+        return measurement == 'playtime' and game == self.reject_game and values.get('session_count') == 1
+
+    @staticmethod
+    def split_unescaped(text, sep):
+        """Split line protocol on sep, skipping backslash-escaped characters and quoted strings."""
+        parts, current, i, quoted = [], '', 0, False
+        while i < len(text):
+            char = text[i]
+            if char == '\\' and i + 1 < len(text):
+                current += text[i:i + 2]
+                i += 2
+                continue
+            if char == '"':
+                quoted = not quoted
+            if char == sep and not quoted:
+                parts.append(current)
+                current = ''
+            else:
+                current += char
+            i += 1
+        return parts + [current]
+
+    @classmethod
+    def parse(cls, line):
+        """(measurement, game tag, integer fields, timestamp) of a line."""
+        head, fields, timestamp = cls.split_unescaped(line, ' ')[:3]
+        measurement, *tags = cls.split_unescaped(head, ',')
+        game = None
+        for tag in tags:
+            key, _, value = tag.partition('=')
+            if key == 'game':
+                game = value.replace('\\ ', ' ').replace('\\,', ',').replace('\\=', '=')
+        values = {}
+        for field in cls.split_unescaped(fields, ','):
+            key, _, value = field.partition('=')
+            if value.endswith('i'):
+                values[key] = int(value[:-1])
+        return measurement, game, values, int(timestamp)
+
+# ── Processor process ──────────────────────────────────────────────────────────
+class Processor:
+    """steam_queue_processor.py as a subprocess with its config in workdir."""
+
+    def __init__(self, workdir, config):
+        self.workdir   = workdir
+        self.config    = config
+        self.proc      = None
+        self.instances = []  # per start: {'rss_start', 'rss_peak', 'rss_end'} in kB
+        self.up        = threading.Event()
+        with open(os.path.join(workdir, 'steam_queue_config.json'), 'w') as f:
+            json.dump(config, f, indent=2)
+        threading.Thread(target=self.sample_memory, daemon=True).start()
+
+    def start(self):
+        env = dict(os.environ, STEAM_QUEUE_CONFIG=os.path.join(self.workdir, 'steam_queue_config.json'))
+        out = open(os.path.join(self.workdir, 'processor_stdout.log'), 'a')
+        self.proc = subprocess.Popen([sys.executable, PROCESSOR], env=env, stdout=out, stderr=subprocess.STDOUT)
+        deadline = time.time() + 30
+        while time.time() < deadline:
+            if self.proc.poll() is not None:
+                raise RuntimeError(f'processor exited with {self.proc.returncode}, see {self.workdir}')
+            try:
+                conn = http.client.HTTPConnection('127.0.0.1', self.config['port'], timeout=2)
+                conn.request('GET', '/metrics')
+                conn.getresponse().read()
+                conn.close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        else:
+            raise RuntimeError('processor did not start listening within 30s')
+        rss = self.rss()
+        self.instances.append({'rss_start': rss, 'rss_peak': rss, 'rss_end': rss})
+        self.up.set()
+
+    def stop(self, kill=False):
+        self.up.clear()
+        if self.proc is None or self.proc.poll() is not None:
+            return
+        if self.instances:
+            self.instances[-1]['rss_end'] = self.rss() or self.instances[-1]['rss_end']
+        self.proc.send_signal(signal.SIGKILL if kill else signal.SIGTERM)
+        try:
+            self.proc.wait(30)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+
+    def rss(self):
+        try:
+            with open(f'/proc/{self.proc.pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1])
+        except (OSError, AttributeError):
+            return None
+        return None
+
+    def sample_memory(self):
+        while True:
+            time.sleep(0.5)
+            if self.up.is_set() and self.instances:
+                rss = self.rss()
+                if rss:
+                    instance = self.instances[-1]
+                    instance['rss_peak'] = max(instance['rss_peak'] or 0, rss)
+                    instance['rss_end']  = rss
+
+# ── Simulated Decks and HA ─────────────────────────────────────────────────────
+class SimDeck:
+    """
+    One Deck playing its own games. Every tick it adds closed sessions and
+    resends its whole queue — open session included — until each session is
+    ACKed, like the real script republishing its retained queue.
+    """
+
+    def __init__(self, index, run, total, transport):
+        self.name      = f'deck{index}'
+        self.run       = run
+        self.total     = total
+        self.transport = transport
+        self.games     = [f'Deck {index} Game {g}' for g in range(run.args.games)]
+        self.playtime  = {game: random.randint(0, 10000) for game in self.games}  # minutes
+        self.clock     = 1_700_000_000 + index * 10_000_000
+        self.created   = 0
+        self.lock      = threading.Lock()
+        self.pending   = {}  # session_id → session, oldest first
+        self.http      = None
+        self.mqtt      = None
+
+    def new_session(self):
+        game  = random.choice(self.games)
+        added = random.randint(1, 180)
+        start = self.playtime[game]
+        self.playtime[game] = start + added
+        self.clock += added * 60 + random.randint(60, 600)
+        session = {
+            'session_id':     f'{self.name}-{self.created}',
+            'appid':          str(1000 + self.games.index(game)),
+            'name':           game,
+            'game_state':     'closed',
+            'ha_processed':   False,
+            'start_playtime': start,
+            'end_playtime':   start + added,
+            'start_time':     self.clock - added * 60,
+            'end_time':       self.clock,
+        }
+        self.created += 1
+        self.run.expect_session(self.name, session)
+        return session
+
+    def payload(self):
+        with self.lock:
+            sessions = list(self.pending.values())
+        open_session = {
+            'session_id': f'{self.name}-open', 'appid': '1', 'name': self.games[0],
+            'game_state': 'opened', 'ha_processed': None, 'start_playtime': 0,
+            'end_playtime': None, 'start_time': self.clock, 'end_time': None,
+        }
+        body = json.dumps({'schema': 1, 'deck': self.name, 'active_sessions': sessions + [open_session]}, separators=(',', ':'))
+        return body, [s['session_id'] for s in sessions]
+
+    def acked(self, session_id):
+        with self.lock:
+            self.pending.pop(session_id, None)
+
+    def send(self, body, session_ids):
+        self.run.note_sent(session_ids)
+        if self.transport == 'mqtt':
+            self.mqtt.publish('steamdeck/playtime/queue', body, qos=1, retain=True)
+            return
+        try:
+            if self.http is None:
+                self.http = http.client.HTTPConnection('127.0.0.1', self.run.processor.config['port'], timeout=10)
+            self.http.request('POST', '/process_deck_queue', body=body, headers={'Content-Type': 'application/json'})
+            self.http.getresponse().read()
+        except (OSError, http.client.HTTPException):
+            self.http = None  # processor restarting — resent next tick
+
+    def loop(self):
+        if self.transport == 'mqtt':
+            self.mqtt = self.run.mqtt_client(f'sim-{self.name}')
+        args = self.run.args
+        while not self.run.stopping.is_set():
+            with self.lock:
+                for _ in range(min(args.burst, self.total - self.created)):
+                    session = self.new_session()
+                    self.pending[session['session_id']] = session
+                    self.run.sent_at.setdefault(session['session_id'], time.monotonic())
+                idle = not self.pending and self.created >= self.total
+            if idle:
+                return
+            body, session_ids = self.payload()
+            self.send(body, session_ids)
+            if random.random() < args.duplicate_rate:
+                self.send(body, session_ids)  # duplicate delivery of the same payload
+            time.sleep(args.tick)
+
+class SimHomeAssistant:
+    """Interleaved /game_start + /game_stop pairs for games the Decks never report."""
+
+    def __init__(self, run):
+        self.run     = run
+        self.expect  = defaultdict(lambda: {'seconds': 0.0, 'sessions': 0})
+        self.clock   = 1_600_000_000
+
+    def post(self, path, data):
+        while not self.run.stopping.is_set():
+            self.run.processor.up.wait()
+            try:
+                conn = http.client.HTTPConnection('127.0.0.1', self.run.processor.config['port'], timeout=10)
+                conn.request('POST', path, body=json.dumps(data), headers={'Content-Type': 'application/json'})
+                status = conn.getresponse().status
+                conn.close()
+                if status == 200:
+                    return
+            except (OSError, http.client.HTTPException):
+                time.sleep(0.2)
+
+    def loop(self):
+        args = self.run.args
+        for k in range(args.stops):
+            if self.run.stopping.is_set():
+                return
+            game     = f'HA Game {k % args.stop_games}'
+            duration = random.randint(60, 7200)
+            self.clock += duration + 600
+            start = datetime.fromtimestamp(self.clock - duration).isoformat()
+            stop  = datetime.fromtimestamp(self.clock).isoformat()
+            # A restart between start and stop would lose the pair's response;
+            # hold it off so every stop is sent (and counted) exactly once.
+            with self.run.restart_lock:
+                self.post('/game_start', {'game_name': game, 'appid': str(5000 + k % args.stop_games),
+                                          'game_type': 'Non-Steam', 'start_time': start})
+                self.post('/game_stop', {'game_name': game, 'stop_time': stop,
+                                         'properly_closed': False, 'start_time': start})
+            self.expect[game]['seconds']  += duration
+            self.expect[game]['sessions'] += 1
+            time.sleep(args.stop_interval)
+
+# ── Run ────────────────────────────────────────────────────────────────────────
+class LoadTest:
+    def __init__(self, args):
+        self.args         = args
+        self.workdir      = args.workdir or tempfile.mkdtemp(prefix='steam_queue_loadtest_')
+        os.makedirs(self.workdir, exist_ok=True)
+        self.stopping     = threading.Event()
+        self.restart_lock = threading.Lock()
+        self.expected     = {}                 # session_id → session
+        self.last_session = {}                 # Deck game → last session created
+        self.sent_at      = {}                 # session_id → monotonic time first sent
+        self.ack_at       = {}                 # session_id → monotonic time first ACKed
+        self.last_sent    = {}                 # session_id → monotonic time last sent by its Deck
+        self.last_ack     = {}                 # session_id → monotonic time last ACKed
+        self.ack_counts   = Counter()
+        self.reacked      = 0                  # ACKs of a session resent after its previous ACK
+        self.extra_acks   = []                 # sessions ACKed again without being resent
+        self.ack_lock     = threading.Lock()
+        self.decks        = {}
+        self.broker       = None
+        self.influx       = None
+        self.processor    = None
+        self.broker_addr  = None
+
+    def expect_session(self, deck, session):
+        self.expected[session['session_id']] = session
+        self.last_session[session['name']]   = session
+
+    def mqtt_client(self, client_id):
+        client = mqtt_client.Client(mqtt_client.CallbackAPIVersion.VERSION2, client_id=client_id)
+        client.connect(*self.broker_addr)
+        client.loop_start()
+        return client
+
+    def note_sent(self, session_ids):
+        now = time.monotonic()
+        with self.ack_lock:
+            for session_id in session_ids:
+                self.last_sent[session_id] = now
+
+    def on_ack(self, client, userdata, msg):
+        if not msg.payload:
+            return  # our own clear of a retained ACK
+        parts = msg.topic.split('/')
+        if parts[2] == 'batch_ack':
+            session_ids = json.loads(msg.payload).get('session_ids', [])
+        else:
+            session_ids = [parts[3]]
+        now = time.monotonic()
+        with self.ack_lock:
+            for session_id in session_ids:
+                previous = self.last_ack.get(session_id)
+                if previous is not None:
+                    # a Deck that resends a session after its ACK gets it ACKed again
+                    if self.last_sent.get(session_id, 0) > previous:
+                        self.reacked += 1
+                    else:
+                        self.extra_acks.append(session_id)
+                self.last_ack[session_id] = now
+                self.ack_counts[session_id] += 1
+                self.ack_at.setdefault(session_id, now)
+        for session_id in session_ids:
+            deck = self.decks.get(session_id.rsplit('-', 1)[0])
+            if deck:
+                deck.acked(session_id)
+        client.publish(msg.topic, b'', retain=True)
+
+    def setup(self):
+        args = self.args
+        if args.broker:
+            host, _, port = args.broker.partition(':')
+            self.broker_addr = (host, int(port or 1883))
+        else:
+            self.broker = MqttBroker()
+            self.broker.start()
+            self.broker_addr = ('127.0.0.1', self.broker.port)
+        self.influx = InfluxStub(args.influx_error_rate, args.influx_reject)
+        influx_port = self.influx.start()
+        w = self.workdir
+        self.processor = Processor(w, {
+            'ha_url':                  'http://127.0.0.1:9',
+            'ha_token':                'loadtest',
+            'mqtt_host':               self.broker_addr[0],
+            'mqtt_port':               self.broker_addr[1],
+            'mqtt_user':               'loadtest',
+            'mqtt_pass':               'loadtest',
+            'mqtt_tls':                False,
+            'mqtt_subscribe':          True,
+            'queue_file':              os.path.join(w, 'steam_queue.json'),
+            'library_file':            os.path.join(w, 'steam_library.json'),
+            'session_log_file':        os.path.join(w, 'steam_session_log.jsonl'),
+            'processed_sessions_file': os.path.join(w, 'steam_processed_sessions.jsonl'),
+            'influxdb_url':            f'http://127.0.0.1:{influx_port}',
+            'influxdb_db':             'steamdeck',
+            'influxdb_spool_file':     os.path.join(w, 'influxdb_spool.lp'),
+            'influxdb_reject_file':    os.path.join(w, 'influxdb_rejected.lp'),
+            'influxdb_max_backoff':    2,
+            # a SIGKILL loses points still buffered in memory unless they are spooled first
+            'influxdb_durable_ack':    args.kill,
+            'port':                    free_port(),
+        })
+        acks = self.mqtt_client('sim-ack-reader')
+        acks.on_message = self.on_ack
+        acks.subscribe('steamdeck/playtime/ack/#', qos=1)
+        acks.subscribe('steamdeck/playtime/batch_ack/#', qos=1)
+
+    def restarter(self, generation_seconds):
+        args = self.args
+        for n in range(args.restarts):
+            if self.stopping.wait(generation_seconds / (args.restarts + 1)):
+                return
+            with self.restart_lock:
+                log(f'Restart {n + 1}/{args.restarts} ({"SIGKILL" if args.kill else "SIGTERM"})')
+                self.processor.stop(kill=args.kill)
+                self.processor.start()
+
+    def run(self):
+        args = self.args
+        log(f'Work directory: {self.workdir}')
+        self.setup()
+        self.processor.start()
+        log(f'Processor up on port {self.processor.config["port"]}, broker {self.broker_addr[0]}:{self.broker_addr[1]}')
+
+        per_deck = [args.sessions // args.decks + (1 if i < args.sessions % args.decks else 0) for i in range(args.decks)]
+        for i, total in enumerate(per_deck):
+            transport = args.transport if args.transport != 'mixed' else ('mqtt' if i % 2 else 'http')
+            deck = SimDeck(i, self, total, transport)
+            self.decks[deck.name] = deck
+        ha = SimHomeAssistant(self)
+
+        # Restarts are spread over the expected generation time
+        generation_seconds = max(per_deck) / args.burst * args.tick
+        threads = [threading.Thread(target=d.loop, daemon=True) for d in self.decks.values()]
+        threads.append(threading.Thread(target=ha.loop, daemon=True))
+        started = time.monotonic()
+        for t in threads:
+            t.start()
+        restarter = threading.Thread(target=self.restarter, args=(generation_seconds,), daemon=True)
+        restarter.start()
+
+        deadline = started + args.timeout
+        next_progress = started + 5
+        while any(t.is_alive() for t in threads) and time.monotonic() < deadline:
+            time.sleep(0.2)
+            if time.monotonic() >= next_progress:
+                next_progress += 5
+                log(f'{len(self.ack_at)}/{len(self.expected)} sessions ACKed')
+        elapsed = time.monotonic() - started
+        self.stopping.set()
+        restarter.join()
+        timed_out = any(t.is_alive() for t in threads)
+
+        # Let the last library flush and InfluxDB batches happen, then stop cleanly
+        time.sleep(2)
+        self.wait_for_influx()
+        self.processor.stop()
+        return self.report(ha, elapsed, timed_out)
+
+    def wait_for_influx(self, timeout=30):
+        """Wait until the processor's InfluxDB writer has no points left to write (after retries)."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                conn = http.client.HTTPConnection('127.0.0.1', self.processor.config['port'], timeout=5)
+                conn.request('GET', '/status')
+                status = json.loads(conn.getresponse().read())
+                conn.close()
+                if not status.get('influxdb', {}).get('buffered'):
+                    return
+            except (OSError, http.client.HTTPException, ValueError):
+                pass
+            time.sleep(0.2)
+        log(f'InfluxDB writer still had points buffered after {timeout}s')
+
+    def report(self, ha, elapsed, timed_out):
+        args     = self.args
+        failures = []
+
+        with open(self.processor.config['library_file']) as f:
+            library = json.load(f).get('games', {})
+        applied = Counter()
+        try:
+            with open(self.processor.config['session_log_file']) as f:
+                for line in f:
+                    applied[json.loads(line)['session_id']] += 1
+        except FileNotFoundError:
+            pass
+
+        unacked = [sid for sid in self.expected if sid not in self.ack_at]
+        if unacked:
+            failures.append(f'{len(unacked)} session(s) never ACKed, e.g. {unacked[:3]}')
+        if self.extra_acks:
+            failures.append(f'{len(self.extra_acks)} ACK(s) of a session its Deck had not resent since the previous ACK, '
+                            f'e.g. {self.extra_acks[:3]}')
+        not_applied = [sid for sid in self.expected if applied[sid] == 0]
+        if not_applied:
+            failures.append(f'{len(not_applied)} session(s) ACKed or pending but never applied, e.g. {not_applied[:3]}')
+        double = [sid for sid in self.expected if applied[sid] > 1]
+        if double:
+            failures.append(f'{len(double)} session(s) applied more than once, e.g. {double[:3]}')
+
+        sessions_per_game = Counter(s['name'] for s in self.expected.values())
+        for game, last in self.last_session.items():
+            entry = library.get(game, {})
+            if entry.get('session_count') != sessions_per_game[game]:
+                failures.append(f'{game}: session_count {entry.get("session_count")} != {sessions_per_game[game]} sessions')
+            if entry.get('seconds') != last['end_playtime'] * 60:
+                failures.append(f'{game}: {entry.get("seconds")}s in library != last end_playtime {last["end_playtime"] * 60}s')
+        for game, expect in ha.expect.items():
+            entry = library.get(game, {})
+            if entry.get('session_count') != expect['sessions']:
+                failures.append(f'{game}: session_count {entry.get("session_count")} != {expect["sessions"]} game_stops')
+            if abs(entry.get('seconds', 0) - expect['seconds']) > 0.01:
+                failures.append(f'{game}: {entry.get("seconds")}s in library != {expect["seconds"]}s of game_stops')
+
+        stats_file = os.path.join(os.path.dirname(self.processor.config['library_file']), 'steam_library_stats.json')
+        with open(stats_file) as f:
+            decks = json.load(f).get('decks', {})
+        for deck in self.decks.values():
+            if decks.get(deck.name, {}).get('sessions') != deck.total:
+                failures.append(f'{deck.name}: {decks.get(deck.name, {}).get("sessions")} sessions in the rollups != {deck.total}')
+
+        points = defaultdict(list)
+        with self.influx.lock:
+            for (game, _), session_count in self.influx.points.items():
+                points[game].append(session_count)
+        expected_points = dict(sessions_per_game)
+        expected_points.update({game: e['sessions'] for game, e in ha.expect.items()})
+        if args.influx_reject:
+            rejected_points = set()  # a point rejected again after a restart counts once
+            try:
+                with open(self.processor.config['influxdb_reject_file']) as f:
+                    for line in f:
+                        if line.strip() and not line.startswith('#'):
+                            measurement, game, _, timestamp = InfluxStub.parse(line.rstrip('\n'))
+                            rejected_points.add((measurement, game, timestamp))
+            except FileNotFoundError:
+                pass
+            rejected = sorted(point[:2] for point in rejected_points)
+            if rejected != [('playtime', args.influx_reject)]:
+                failures.append(f'reject file holds {rejected[:5]}, expected the first playtime point of {args.influx_reject}')
+        for game, count in expected_points.items():
+            first = 2 if game == args.influx_reject else 1
+            if sorted(points.get(game, [])) != list(range(first, count + 1)):
+                seen = Counter(points.get(game, []))
+                failures.append(
+                    f'{game}: InfluxDB points {len(points.get(game, []))} for {count} sessions '
+                    f'(duplicated session_count: {sorted(k for k, v in seen.items() if v > 1)[:5]})'
+                )
+
+        rollups = Counter()
+        with self.influx.lock:
+            for (measurement, game, _), sessions in self.influx.rollups.items():
+                rollups[measurement, game] += sessions
+        for game, count in expected_points.items():
+            for measurement in ('playtime_daily', 'playtime_monthly'):
+                if rollups[measurement, game] != count:
+                    failures.append(f'{game}: {rollups[measurement, game]} sessions in {measurement} != {count}')
+
+        latencies = [self.ack_at[sid] - self.sent_at[sid] for sid in self.ack_at if sid in self.sent_at]
+        acked_twice = sum(1 for n in self.ack_counts.values() if n > 1)
+        total       = len(self.expected) + sum(e['sessions'] for e in ha.expect.values())
+        result = {
+            'decks':                 args.decks,
+            'deck_sessions':         len(self.expected),
+            'game_stops':            sum(e['sessions'] for e in ha.expect.values()),
+            'restarts':              args.restarts,
+            'elapsed_s':             round(elapsed, 2),
+            'throughput_per_s':      round(total / elapsed, 1) if elapsed else None,
+            'ack_latency_ms':        {
+                f'p{int(p * 100)}': round(percentile(latencies, p) * 1000, 1) if latencies else None
+                for p in (0.5, 0.95, 0.99)
+            },
+            'ack_latency_max_ms':    round(max(latencies) * 1000, 1) if latencies else None,
+            'sessions_acked_twice':  acked_twice,
+            'acks_after_resend':     self.reacked,
+            'acks_not_resent':       len(self.extra_acks),
+            'influx_requests':       self.influx.requests,
+            'influx_injected_errors': self.influx.errors,
+            'influx_rejected_requests': self.influx.rejected,
+            'processor_rss_kb':      self.processor.instances,
+            'timed_out':             timed_out,
+            'failures':              failures,
+        }
+
+        print()
+        print(f'Sessions:        {result["deck_sessions"]} from {args.decks} Decks + {result["game_stops"]} game_stops, '
+              f'{args.restarts} restart(s){" (SIGKILL)" if args.kill else ""}')
+        print(f'Elapsed:         {result["elapsed_s"]}s, {result["throughput_per_s"]} sessions/s')
+        print(f'ACK latency:     p50 {result["ack_latency_ms"]["p50"]} ms, p95 {result["ack_latency_ms"]["p95"]} ms, '
+              f'p99 {result["ack_latency_ms"]["p99"]} ms, max {result["ack_latency_max_ms"]} ms')
+        print(f'ACKed twice:     {acked_twice} session(s); {self.reacked} ACK(s) after a resend, '
+              f'{len(self.extra_acks)} without one')
+        print(f'InfluxDB:        {self.influx.requests} write requests, {self.influx.errors} injected errors, '
+              f'{self.influx.rejected} rejected')
+        for n, instance in enumerate(self.processor.instances, 1):
+            if instance['rss_start']:
+                print(f'Processor RSS:   run {n}: {instance["rss_start"]} kB at start, '
+                      f'peak {instance["rss_peak"]} kB, {instance["rss_end"]} kB at end '
+                      f'({instance["rss_end"] - instance["rss_start"]:+d} kB)')
+        if timed_out:
+            print(f'TIMED OUT after {args.timeout}s')
+        print('Invariants:      ' + ('all passed' if not failures else f'{len(failures)} FAILED'))
+        for failure in failures[:20]:
+            print(f'  - {failure}')
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(result, f, indent=2)
+        return 1 if failures or timed_out else 0
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Load and soak test for the Steam Deck queue processor')
+    parser.add_argument('--decks', type=int, default=4, help='simulated Decks')
+    parser.add_argument('--sessions', type=int, default=2000, help='closed sessions across all Decks')
+    parser.add_argument('--games', type=int, default=8, help='games per Deck')
+    parser.add_argument('--burst', type=int, default=5, help='new sessions per Deck per tick')
+    parser.add_argument('--tick', type=float, default=0.2, help='seconds between a Deck\'s queue resends')
+    parser.add_argument('--duplicate-rate', type=float, default=0.2, help='share of payloads delivered twice')
+    parser.add_argument('--transport', choices=('http', 'mqtt', 'mixed'), default='mixed',
+                        help='how Decks deliver their queue (mixed: every other Deck on MQTT)')
+    parser.add_argument('--stops', type=int, default=100, help='/game_start + /game_stop pairs')
+    parser.add_argument('--stop-games', type=int, default=5, help='games used for the game_stop pairs')
+    parser.add_argument('--stop-interval', type=float, default=0.05, help='seconds between game_stop pairs')
+    parser.add_argument('--restarts', type=int, default=1, help='processor restarts during the run')
+    parser.add_argument('--kill', action='store_true', help='restart with SIGKILL instead of SIGTERM')
+    parser.add_argument('--influx-error-rate', type=float, default=0.05, help='share of /write requests failing with 503')
+    parser.add_argument('--influx-reject', metavar='GAME',
+                        help='answer /write requests holding the first playtime point of GAME with 400, e.g. "Deck 0 Game 0"')
+    parser.add_argument('--broker', help='use this MQTT broker (host:port, e.g. a local mosquitto) instead of the stub')
+    parser.add_argument('--timeout', type=float, default=300, help='give up after this many seconds')
+    parser.add_argument('--workdir', help='keep the processor files here instead of a temp directory')
+    parser.add_argument('--json', help='also write the report to this file')
+    parser.add_argument('--seed', type=int, help='random seed')
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.seed is not None:
+        random.seed(args.seed)
+    exit(LoadTest(args).run())
@@ -30,34 +30,55 @@ Playtime flow:
     works offline, and is equally accurate for games played on the Deck.
 """
 
+import argparse
+import bisect
+import gzip
+import http.client
 import json
 import logging
 import os
 import queue
+import signal
 import ssl
 import threading
 import time as time_module
-import urllib.request
-import urllib.error
+import unicodedata
 import urllib.parse
+import urllib.request
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from datetime import datetime, timezone, timedelta
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 import paho.mqtt.client as mqtt_client
 
+# Optional binary payload codecs for Deck payloads
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
 # ── Logging ────────────────────────────────────────────────────────────────────
+# STEAM_QUEUE_CONFIG overrides the config file location (the load test runs the
+# processor from a temp directory); the log file is written next to it.
+CONFIG_FILE = os.environ.get('STEAM_QUEUE_CONFIG', '/config/scripts/steam_queue_config.json')
+
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s [%(levelname)s] %(message)s',
     handlers=[
-        logging.FileHandler('/config/scripts/steam_queue_processor.log'),
+        logging.FileHandler(os.path.join(os.path.dirname(CONFIG_FILE), 'steam_queue_processor.log')),
         logging.StreamHandler()
     ]
 )
 log = logging.getLogger(__name__)
 
 # ── Config ─────────────────────────────────────────────────────────────────────
-CONFIG_FILE = '/config/scripts/steam_queue_config.json'
 config = {}
 
 def load_config():
@@ -70,10 +91,141 @@ def load_config():
         log.error(f"Failed to load config: {e}")
         exit(1)
 
+# ── Metrics ────────────────────────────────────────────────────────────────────
+# Counters and histograms served on /metrics in the Prometheus text format.
+# An update is one short lock around a few integer additions, so they can sit
+# on the worker hot path; values that already exist elsewhere (queue depths,
+# InfluxDB and MQTT stats) are read when /metrics is scraped instead.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+DELAY_BUCKETS   = (0.01, 0.1, 0.5, 1, 5, 15, 30, 60, 120, 300, 900, 3600, 21600, 86400, 604800)
+
+def format_metric(name, kind, help_text, samples):
+    """One metric family; samples are (suffix, labels dict, value)."""
+    lines = [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+    for suffix, labels, value in samples:
+        label_text = ','.join(f'{k}="{v}"' for k, v in labels.items())
+        lines.append(f'{name}{suffix}{{{label_text}}} {value}' if label_text else f'{name}{suffix} {value}')
+    return '\n'.join(lines)
+
+class Counter:
+    def __init__(self, name, help_text, label=None):
+        self.name      = name
+        self.help_text = help_text
+        self.label     = label
+        self.lock      = threading.Lock()
+        self.values    = {}  # label value → count
+
+    def inc(self, label_value=None, amount=1):
+        with self.lock:
+            self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def render(self):
+        with self.lock:
+            values = sorted(self.values.items(), key=lambda kv: str(kv[0]))
+        return format_metric(self.name, 'counter', self.help_text, [
+            ('', {self.label: value} if self.label else {}, count) for value, count in values
+        ])
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS, label=None):
+        self.name      = name
+        self.help_text = help_text
+        self.buckets   = buckets
+        self.label     = label
+        self.lock      = threading.Lock()
+        self.series    = {}  # label value → [bucket counts (last slot is +Inf), sum, count]
+        if label is None:
+            self.series[None] = [[0] * (len(buckets) + 1), 0.0, 0]
+
+    def observe(self, value, label_value=None):
+        slot = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_value)
+            if series is None:
+                series = self.series[label_value] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][slot] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        with self.lock:
+            snapshot = sorted(((k, list(c), t, n) for k, (c, t, n) in self.series.items()), key=lambda s: str(s[0]))
+        samples = []
+        for label_value, counts, total, count in snapshot:
+            labels     = {self.label: label_value} if self.label else {}
+            cumulative = 0
+            for bound, n in zip(list(self.buckets) + ['+Inf'], counts):
+                cumulative += n
+                samples.append(('_bucket', {**labels, 'le': bound}, cumulative))
+            samples += [('_sum', labels, round(total, 6)), ('_count', labels, count)]
+        return format_metric(self.name, 'histogram', self.help_text, samples)
+
+sessions_metric       = Counter('steam_queue_sessions_total',
+                                'Deck sessions by outcome', 'outcome')
+library_write_metric  = Histogram('steam_queue_library_write_seconds',
+                                  'Time to write steam_library.json')
+influx_write_metric   = Histogram('steam_queue_influxdb_write_seconds',
+                                  'Time per InfluxDB batch write request')
+publish_metric        = Histogram('steam_queue_mqtt_publish_seconds',
+                                  'Time from publish to broker confirmation (ACKs and capabilities)')
+session_delay_metric  = Histogram('steam_queue_session_ack_delay_seconds',
+                                  'Time from a session\'s end_time to its ACK', DELAY_BUCKETS)
+trace_hop_metric      = Histogram('steam_queue_trace_hop_seconds',
+                                  'Per-hop latency of completed session traces', DELAY_BUCKETS, 'hop')
+METRICS = [sessions_metric, library_write_metric, influx_write_metric, publish_metric, session_delay_metric,
+           trace_hop_metric]
+
+# ── Payload formats ────────────────────────────────────────────────────────────
+# Highest Deck payload schema version this processor understands
+PAYLOAD_SCHEMA = 1
+
+PAYLOAD_CONTENT_TYPES = {
+    'application/msgpack':   'msgpack',
+    'application/x-msgpack': 'msgpack',
+    'application/cbor':      'cbor',
+}
+
+def available_formats():
+    formats = ['json']
+    if msgpack is not None:
+        formats.append('msgpack')
+    if cbor2 is not None:
+        formats.append('cbor')
+    return formats
+
+def decode_payload(raw, fmt='json'):
+    """Decode a Deck payload in json, msgpack or cbor. Raises ValueError if unsupported."""
+    if fmt == 'msgpack':
+        if msgpack is None:
+            raise ValueError('msgpack payload received but msgpack is not installed')
+        data = msgpack.unpackb(raw, raw=False)
+    elif fmt == 'cbor':
+        if cbor2 is None:
+            raise ValueError('cbor payload received but cbor2 is not installed')
+        data = cbor2.loads(raw)
+    else:
+        data = json.loads(raw) if raw else {}
+    if isinstance(data, dict) and int(data.get('schema', 1)) > PAYLOAD_SCHEMA:
+        log.warning(f'Payload schema {data.get("schema")} is newer than supported schema {PAYLOAD_SCHEMA}')
+    return data
+
+# ── Game name normalization ────────────────────────────────────────────────────
+TRADEMARK_SIGNS = str.maketrans('', '', '™®©')
+
+def normalize_game_name(name):
+    """
+    Lookup key for a game name: NFKC-normalized, trademark signs removed,
+    whitespace collapsed and casefolded, so "Diablo® IV" and "diablo iv" match.
+    """
+    # Strip the signs first: NFKC would turn ™ into "TM"
+    name = unicodedata.normalize('NFKC', (name or '').translate(TRADEMARK_SIGNS))
+    return ' '.join(name.split()).casefold()
+
 # ── In-flight session tracking (prevents double processing) ───────────────────
 in_flight_lock = threading.Lock()
 in_flight_sessions = set()
-recently_stopped_games = {}  # game_name_lower → timestamp of game_stop processing
+recently_stopped_games = {}  # normalized game name → timestamp of game_stop processing
+RECENTLY_STOPPED_WINDOW = 120  # seconds a game_stop suppresses Deck sessions of the same game
 
 def is_in_flight(session_id):
     with in_flight_lock:
@@ -83,25 +235,147 @@ def mark_in_flight(session_id):
     with in_flight_lock:
         in_flight_sessions.add(session_id)
 
+def claim_in_flight(session_id):
+    """Mark a session in-flight unless it already is. Returns False for a duplicate."""
+    with in_flight_lock:
+        if session_id in in_flight_sessions:
+            return False
+        in_flight_sessions.add(session_id)
+        return True
+
 def unmark_in_flight(session_id):
     with in_flight_lock:
         in_flight_sessions.discard(session_id)
 
 def mark_recently_stopped(game_name):
+    now = datetime.now().timestamp()
     with in_flight_lock:
-        recently_stopped_games[game_name.lower()] = datetime.now().timestamp()
+        for key, ts in list(recently_stopped_games.items()):
+            if now - ts >= RECENTLY_STOPPED_WINDOW:
+                del recently_stopped_games[key]
+        recently_stopped_games[normalize_game_name(game_name)] = now
 
-def was_recently_stopped(game_name, within_seconds=120):
+def was_recently_stopped(game_name, within_seconds=RECENTLY_STOPPED_WINDOW):
     with in_flight_lock:
-        ts = recently_stopped_games.get(game_name.lower())
+        ts = recently_stopped_games.get(normalize_game_name(game_name))
         if ts is None:
             return False
         return (datetime.now().timestamp() - ts) < within_seconds
 
-# ── Queue file helpers ─────────────────────────────────────────────────────────
-queue_file_lock = threading.Lock()
+# ── Processed session store ────────────────────────────────────────────────────
+# Deck sessions that were handled are recorded with their outcome in an
+# append-only JSON lines file, one {"session_id", "outcome", "ts"} per line.
+# The set is kept in memory so a session the Deck resends — after a restart,
+# from a retained queue payload or because its ACK was lost — is recognised at
+# intake and only ACKed again. Records expire after processed_session_ttl_days;
+# expired ones are dropped whenever the file is compacted.
+processed_lock         = threading.Lock()
+processed_sessions     = {}    # session_id → {'outcome', 'ts'}
+processed_file         = None  # append handle
+processed_file_records = 0     # records in the file
+
+def processed_sessions_path():
+    return config.get('processed_sessions_file', '/config/scripts/steam_processed_sessions.jsonl')
+
+def processed_session_ttl():
+    return config.get('processed_session_ttl_days', 30) * 86400
+
+def write_processed_sessions():
+    """Atomically rewrite the file with the unexpired records. Call with processed_lock held."""
+    global processed_file, processed_file_records
+    cutoff = datetime.now().timestamp() - processed_session_ttl()
+    for session_id in [k for k, v in processed_sessions.items() if v['ts'] < cutoff]:
+        del processed_sessions[session_id]
+    path     = processed_sessions_path()
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        for session_id, record in processed_sessions.items():
+            f.write(json.dumps({'session_id': session_id, **record}, separators=(',', ':')) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    if processed_file:
+        processed_file.close()
+    processed_file         = open(path, 'a')
+    processed_file_records = len(processed_sessions)
+
+def open_processed_sessions():
+    """Load the unexpired records and compact the file."""
+    path = processed_sessions_path()
+    with processed_lock:
+        records = 0
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                for raw in f:
+                    try:
+                        record = json.loads(raw)
+                        processed_sessions[record['session_id']] = {
+                            'outcome': record['outcome'], 'ts': record['ts']
+                        }
+                    except (json.JSONDecodeError, KeyError):
+                        log.warning('Skipping malformed processed session record')
+                        continue
+                    records += 1
+        write_processed_sessions()
+    log.info(
+        f'Processed session store loaded: {len(processed_sessions)} sessions '
+        f'({records - len(processed_sessions)} expired or repeated records dropped)'
+    )
 
-def read_queue_file():
+def record_processed_session(session_id, outcome):
+    """Remember that a session was handled. Must happen before its ACK is sent."""
+    record_processed_sessions([session_id], outcome)
+
+def record_processed_sessions(session_ids, outcome):
+    """Remember that sessions were handled, with one fsync for all of them."""
+    global processed_file_records
+    if not session_ids:
+        return
+    record = {'outcome': outcome, 'ts': datetime.now().timestamp()}
+    with processed_lock:
+        for session_id in session_ids:
+            processed_sessions[session_id] = record
+            processed_file.write(json.dumps({'session_id': session_id, **record}, separators=(',', ':')) + '\n')
+        processed_file.flush()
+        os.fsync(processed_file.fileno())
+        processed_file_records += len(session_ids)
+        if processed_file_records > max(config.get('processed_compact_min_records', 1000), 2 * len(processed_sessions)):
+            write_processed_sessions()
+
+def processed_outcome(session_id):
+    """Outcome of an already handled session, or None."""
+    with processed_lock:
+        record = processed_sessions.get(session_id)
+    if record is None or record['ts'] < datetime.now().timestamp() - processed_session_ttl():
+        return None
+    return record['outcome']
+
+def processed_seconds_ago(session_id):
+    """Seconds since session_id was recorded as processed, or None."""
+    with processed_lock:
+        record = processed_sessions.get(session_id)
+    return None if record is None else datetime.now().timestamp() - record['ts']
+
+# ── Queue journal ──────────────────────────────────────────────────────────────
+# The HA-side queue is an append-only journal of JSON lines:
+#   {"op": "start", "entry": {...}}   game started, entry added
+#   {"op": "stop",  "entry": {...}}   entry updated to its stop state
+#   {"op": "done",  "entry_id": ...}  entry processed and removed
+# Every change is one appended line. The live entries are kept in memory and
+# the journal is compacted in the background once it holds many more records
+# than live entries. A legacy steam_queue.json is migrated on first start.
+queue_file_lock     = threading.Lock()
+queue_entries       = {}    # entry_id → entry, in insertion order
+queue_start_index   = {}    # normalized game name → entry_ids of its 'start' entries, oldest first
+queue_journal       = None  # append handle
+queue_journal_lines = 0     # records in the journal file
+queue_compact_event = threading.Event()
+
+def queue_journal_path():
+    return config.get('queue_journal_file', os.path.splitext(config['queue_file'])[0] + '.journal')
+
+def load_queue_file():
+    """Entries of a legacy steam_queue.json."""
     path = config['queue_file']
     if not os.path.exists(path):
         return []
@@ -113,25 +387,147 @@ def read_queue_file():
             log.warning('Queue file is malformed, starting fresh')
             return []
 
-def write_queue_file(entries):
-    path = config['queue_file']
+def apply_queue_record(record):
+    """Apply one journal record to the in-memory queue. Call with queue_file_lock held."""
+    op = record.get('op')
+    if op in ('start', 'stop'):
+        entry    = record['entry']
+        entry_id = entry['entry_id']
+        unindex_start_entry(entry_id)
+        queue_entries[entry_id] = entry
+        if entry.get('state') == 'start':
+            queue_start_index.setdefault(normalize_game_name(entry.get('game_name', '')), []).append(entry_id)
+    elif op == 'done':
+        unindex_start_entry(record['entry_id'])
+        queue_entries.pop(record['entry_id'], None)
+
+def unindex_start_entry(entry_id):
+    entry = queue_entries.get(entry_id)
+    if entry is None or entry.get('state') != 'start':
+        return
+    key = normalize_game_name(entry.get('game_name', ''))
+    ids = queue_start_index.get(key, [])
+    if entry_id in ids:
+        ids.remove(entry_id)
+    if not ids:
+        queue_start_index.pop(key, None)
+
+def append_queue_record(record):
+    """Apply a record and append it to the journal. Call with queue_file_lock held."""
+    global queue_journal_lines
+    apply_queue_record(record)
+    queue_journal.write(json.dumps(record, separators=(',', ':')) + '\n')
+    queue_journal.flush()
+    queue_journal_lines += 1
+    if queue_journal_lines > max(config.get('queue_compact_min_records', 1000), 4 * len(queue_entries)):
+        queue_compact_event.set()
+
+def write_queue_journal(entries):
+    """Atomically replace the journal with one record per live entry. Call with queue_file_lock held."""
+    global queue_journal, queue_journal_lines
+    path     = queue_journal_path()
     tmp_path = path + '.tmp'
     with open(tmp_path, 'w') as f:
-        json.dump({'queue': entries}, f, indent=2)
+        for entry in entries:
+            f.write(json.dumps({'op': entry.get('state', 'start'), 'entry': entry}, separators=(',', ':')) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
     os.replace(tmp_path, path)
+    if queue_journal:
+        queue_journal.close()
+    queue_journal       = open(path, 'a')
+    queue_journal_lines = len(entries)
+
+def open_queue_journal():
+    """Replay the journal into memory, migrating a legacy queue file if there is no journal yet."""
+    global queue_journal, queue_journal_lines
+    path = queue_journal_path()
+    with queue_file_lock:
+        if not os.path.exists(path):
+            legacy = load_queue_file()
+            for entry in legacy:
+                apply_queue_record({'op': entry.get('state', 'start'), 'entry': entry})
+            write_queue_journal(list(queue_entries.values()))
+            if os.path.exists(config['queue_file']):
+                os.replace(config['queue_file'], config['queue_file'] + '.migrated')
+                log.info(f'Migrated {len(legacy)} entries from {config["queue_file"]} to the queue journal')
+            return
+        lines = 0
+        valid = 0  # byte length up to the last complete record
+        with open(path, 'rb') as f:
+            for raw in f:
+                if not raw.endswith(b'\n'):
+                    log.warning('Dropping incomplete last queue journal record (interrupted write)')
+                    break
+                valid += len(raw)
+                try:
+                    record = json.loads(raw)
+                except json.JSONDecodeError:
+                    log.warning('Skipping malformed queue journal record')
+                    continue
+                apply_queue_record(record)
+                lines += 1
+        if valid != os.path.getsize(path):
+            # Cut the torn record so the next append starts on a fresh line
+            os.truncate(path, valid)
+        queue_journal       = open(path, 'a')
+        queue_journal_lines = lines
+    log.info(f'Queue journal replayed: {lines} records, {len(queue_entries)} live entries')
+
+def compact_queue_journal():
+    with queue_file_lock:
+        before = queue_journal_lines
+        write_queue_journal(list(queue_entries.values()))
+    log.info(f'Queue journal compacted: {before} → {len(queue_entries)} records')
+
+def queue_compactor():
+    """Background thread: compact the journal whenever append_queue_record asks for it."""
+    while True:
+        queue_compact_event.wait()
+        queue_compact_event.clear()
+        try:
+            compact_queue_journal()
+        except OSError as e:
+            log.error(f'Queue journal compaction failed: {e}')
+
+def read_queue_file():
+    """Copies of the live queue entries, oldest first."""
+    with queue_file_lock:
+        return [dict(e) for e in queue_entries.values()]
+
+def find_start_entry(game_name):
+    """Copy of the oldest open 'start' entry for game_name, or None. Call with queue_file_lock held."""
+    ids = queue_start_index.get(normalize_game_name(game_name))
+    return dict(queue_entries[ids[0]]) if ids else None
+
+def unique_entry_id(base_id):
+    """
+    base_id, or base_id with a _2, _3, … suffix if it is taken by a live entry
+    or by one already processed (which may be from before a restart, or
+    compacted out of the journal). Call with queue_file_lock held.
+    """
+    entry_id = base_id
+    n = 2
+    while entry_id in queue_entries or processed_outcome(entry_id) is not None:
+        entry_id = f'{base_id}_{n}'
+        n += 1
+    return entry_id
 
 def append_to_queue_file(entry):
+    """Journal a new start entry, with its entry_id made unique (a game can start twice in one second)."""
     with queue_file_lock:
-        entries = read_queue_file()
-        entries.append(entry)
-        write_queue_file(entries)
+        entry['entry_id'] = unique_entry_id(entry['entry_id'])
+        append_queue_record({'op': entry['state'], 'entry': dict(entry)})
     log.info(f'Appended entry to queue file: {entry["game_name"]} [{entry["state"]}]')
 
+def update_queue_entry(entry):
+    """Journal an entry's new state. Call with queue_file_lock held."""
+    append_queue_record({'op': entry['state'], 'entry': dict(entry)})
+
 def remove_from_queue_file(entry_id):
     with queue_file_lock:
-        entries = read_queue_file()
-        entries = [e for e in entries if e.get('entry_id') != entry_id]
-        write_queue_file(entries)
+        if entry_id in queue_entries:
+            append_queue_record({'op': 'done', 'entry_id': entry_id})
     log.info(f'Removed entry {entry_id} from queue file')
 
 # ── HA REST API helpers ────────────────────────────────────────────────────────
@@ -149,43 +545,166 @@ def get_ha_state(entity_id):
     return result.get('state', '')
 
 # ── Library file helpers ───────────────────────────────────────────────────────
-library_file_lock = threading.Lock()
+# The library lives in memory and is written behind: changes are flushed
+# library_flush_delay seconds after the first unflushed change and at shutdown.
+# If the file is replaced on disk (manual edit, restore) it is reloaded on the
+# next access and unflushed changes are reapplied. Home Assistant edits single
+# games through PATCH /library/<game> instead of rewriting the file.
+# Applied sessions are appended to the session log before the library is
+# flushed, and the file records how much of the log it covers ("session_log":
+# {"offset", "previous_offset"}). After a crash the records past the offset are
+# replayed at startup. Sessions are only recorded as processed, ACKed and
+# removed from the queue journal once a flush covering them has completed.
+library_file_lock   = threading.Lock()
+library_games       = None   # game name → entry
+library_mtime       = None   # mtime of the file as last read or written
+library_dirty       = set()  # keys changed in memory since the last flush
+library_index       = {}     # normalized name → library key
+library_duplicates  = {}     # library key → other keys with the same normalized name
+library_flush_timer = None
+library_log_offset  = None   # session log offset covered by the library file
+
+def library_file_mtime():
+    try:
+        return os.stat(config['library_file']).st_mtime_ns
+    except FileNotFoundError:
+        return None
 
-def read_library():
+def read_library_file():
     path = config['library_file']
     if not os.path.exists(path):
         return {}
     with open(path, 'r') as f:
         try:
-            data = json.load(f)
-            return data.get('games', {})
+            return json.load(f)
         except json.JSONDecodeError:
             log.error('Library file is malformed')
             return {}
 
-def write_library(games):
+def load_library():
+    """
+    Return the in-memory library, loading it on first use and merging the file
+    if it changed on disk since it was last read or written. Call with
+    library_file_lock held.
+    """
+    global library_games, library_mtime
+    mtime = library_file_mtime()
+    if library_games is None:
+        library_games = read_library_file().get('games', {})
+        library_mtime = mtime
+        index_library(library_games)
+    elif mtime != library_mtime:
+        games = read_library_file().get('games', {})
+        for key in library_dirty:
+            if key in library_games:
+                games[key] = library_games[key]
+        log.info(f'Library file changed on disk, reloaded and kept {len(library_dirty)} unflushed change(s)')
+        library_games = games
+        library_mtime = mtime
+        index_library(library_games)
+    return library_games
+
+def index_library(games):
+    """
+    Rebuild library_index. Keys that normalize to the same name as an earlier
+    key are near-duplicates (e.g. "Diablo® IV" next to "Diablo IV"); lookups
+    resolve to the first one and the others are reported in library_duplicates.
+    """
+    global library_index, library_duplicates
+    index      = {}
+    duplicates = {}
+    for key in games:
+        normalized = normalize_game_name(key)
+        if normalized in index:
+            duplicates.setdefault(index[normalized], []).append(key)
+        else:
+            index[normalized] = key
+    for key, others in duplicates.items():
+        log.warning(f'Library has near-duplicate entries for {key}: {", ".join(others)}')
+    library_index      = index
+    library_duplicates = duplicates
+
+def find_library_key(game_name):
+    """Library key for game_name, matched case- and trademark-insensitively, or None. Call with library_file_lock held."""
+    load_library()
+    return library_index.get(normalize_game_name(game_name))
+
+def read_library():
+    """Copy of the library, for readers outside the lock."""
+    with library_file_lock:
+        return {key: dict(value) if isinstance(value, dict) else value
+                for key, value in load_library().items()}
+
+def write_library_file(games, session_log):
+    global library_mtime
     path = config['library_file']
     tmp_path = path + '.tmp'
     with open(tmp_path, 'w') as f:
-        json.dump({'games': games}, f, indent=2)
+        json.dump({'games': games, 'session_log': session_log}, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
     os.replace(tmp_path, path)
-    log.info('Library file updated')
+    library_mtime = library_file_mtime()
+
+def flush_library():
+    """
+    Write unflushed library changes and the playtime rollups to disk, then
+    record, ACK and dequeue the sessions the write made durable.
+    """
+    global library_flush_timer, library_log_offset
+    with library_file_lock:
+        library_flush_timer = None
+        offset, pending = take_session_log_pending()
+        if library_dirty or pending or offset != library_log_offset:
+            games = load_library()
+            started = time_module.monotonic()
+            try:
+                sync_session_log()
+                write_library_file(games, {'offset': offset, 'previous_offset': library_log_offset})
+            except OSError as e:
+                log.error(f'Failed to write library file, retrying: {e}')
+                return_session_log_pending(pending)
+                schedule_library_flush()
+                return
+            library_write_metric.observe(time_module.monotonic() - started)
+            log.info(f'Library file updated ({len(library_dirty)} changed, {len(pending)} session(s) made durable)')
+            library_dirty.clear()
+            library_log_offset = offset
+            record_processed_sessions([session_id for session_id, _ in pending], 'applied')
+        if not flush_stats():
+            schedule_library_flush()
+    for session_id, on_durable in pending:
+        try:
+            on_durable()
+        except Exception:
+            log.exception(f'Failed to finish durable session {session_id}')
+
+def schedule_library_flush():
+    """Flush library_flush_delay seconds after the first unflushed change. Call with library_file_lock held."""
+    global library_flush_timer
+    if library_flush_timer is not None:
+        return
+    library_flush_timer = threading.Timer(config.get('library_flush_delay', 2), flush_library)
+    library_flush_timer.daemon = True
+    library_flush_timer.start()
 
 def update_library_entry(game_name, new_seconds, start_time, stop_time):
     """
-    Update a single game entry in the library under lock.
-    Returns the updated entry dict for use in InfluxDB write.
+    Update a single game entry in the library under lock. Returns the library
+    key, the previous entry (None for a new game) for restore_library_entry,
+    and the updated entry dict for use in InfluxDB write.
     """
     with library_file_lock:
-        games = read_library()
-
-        matched_key = game_name
-        existing_entry = {}
-        for key in games.keys():
-            if key.lower() == game_name.lower():
-                matched_key = key
-                existing_entry = games[key] if isinstance(games[key], dict) else {}
-                break
+        games = load_library()
+
+        matched_key = find_library_key(game_name)
+        if matched_key is None:
+            matched_key = game_name
+            library_index[normalize_game_name(game_name)] = game_name
+        previous_entry = games.get(matched_key)
+        existing_entry = previous_entry
+        if not isinstance(existing_entry, dict):
+            existing_entry = {}
 
         first_played = existing_entry.get('first_played')
         if not first_played:
@@ -200,18 +719,98 @@ def update_library_entry(game_name, new_seconds, start_time, stop_time):
             'last_played':   start_time
         }
         games[matched_key] = updated_entry
-        write_library(games)
+        library_dirty.add(matched_key)
+        schedule_library_flush()
         log.info(f'Updated library entry for {matched_key}: {round(new_seconds)}s | sessions={session_count}')
-        return updated_entry
+        return matched_key, previous_entry, updated_entry
+
+def restore_library_entry(key, previous):
+    """Undo update_library_entry for a session that could not be logged."""
+    with library_file_lock:
+        games = load_library()
+        if previous is None:
+            games.pop(key, None)
+            index_library(games)
+        else:
+            games[key] = previous
+        library_dirty.add(key)
+        schedule_library_flush()
+    log.info(f'Restored library entry for {key}')
 
 def get_existing_seconds(game_name):
+    with library_file_lock:
+        key = find_library_key(game_name)
+        if key is None:
+            return 0.0
+        value = library_games[key]
+    if isinstance(value, dict):
+        return float(value.get('seconds', 0))
+    return float(value)
+
+LIBRARY_FIELD_TYPES = {
+    'seconds':       (int, float),
+    'session_count': int,
+    'first_played':  str,
+    'last_played':   str,
+}
+
+def validate_library_patch(patch):
+    """
+    Raise ValueError unless patch is a JSON merge patch for one library entry.
+    Only the fields in LIBRARY_FIELD_TYPES can be set; any field can be removed.
+    """
+    if not isinstance(patch, dict) or not patch:
+        raise ValueError('Body must be a JSON object with the fields to change')
+    for field, value in patch.items():
+        if value is None:
+            continue
+        expected = LIBRARY_FIELD_TYPES.get(field)
+        if expected is None:
+            raise ValueError(f'Unknown library field {field!r}, expected one of {", ".join(LIBRARY_FIELD_TYPES)}')
+        if isinstance(value, bool) or not isinstance(value, expected):
+            raise ValueError(f'Invalid value for {field}: {value!r}')
+        if field in ('seconds', 'session_count') and value < 0:
+            raise ValueError(f'{field} must not be negative')
+
+def patch_library_entry(game_name, patch):
+    """
+    Apply a merge patch to one library entry (null removes a field), creating
+    the entry if the game is not in the library yet. Runs on the game's worker
+    shard. Returns (library key, updated entry).
+    """
+    with library_file_lock:
+        games = load_library()
+        key   = find_library_key(game_name)
+        if key is None:
+            key = game_name
+            library_index[normalize_game_name(game_name)] = game_name
+        entry = games.get(key)
+        if isinstance(entry, dict):
+            entry = dict(entry)
+        elif isinstance(entry, (int, float)):
+            entry = {'seconds': float(entry)}
+        else:
+            entry = {}
+        for field, value in patch.items():
+            if value is None:
+                entry.pop(field, None)
+            else:
+                entry[field] = value
+        games[key] = entry
+        library_dirty.add(key)
+        schedule_library_flush()
+    log.info(f'Library entry for {key} patched: {", ".join(patch)}')
+    return key, dict(entry)
+
+def project_library(fields=None):
+    """Copy of the library with only the given fields of each entry."""
     games = read_library()
-    for key, value in games.items():
-        if key.lower() == game_name.lower():
-            if isinstance(value, dict):
-                return float(value.get('seconds', 0))
-            return float(value)
-    return 0.0
+    if not fields:
+        return games
+    return {
+        key: {f: entry[f] for f in fields if f in entry}
+        for key, entry in ((k, v if isinstance(v, dict) else {'seconds': v}) for k, v in games.items())
+    }
 
 # ── InfluxDB helpers ───────────────────────────────────────────────────────────
 def escape_influx_tag(value):
@@ -248,92 +847,1034 @@ def to_utc_string(dt_str):
     except Exception:
         return dt_str  # return as-is if parsing fails
 
-def write_to_influxdb(game_name, appid, game_type, total_seconds, session_seconds,
-                       session_count, first_played, last_played, start_time_dt):
-    influxdb_url      = config.get('influxdb_url')
-    influxdb_db       = config.get('influxdb_db')
-    influxdb_user     = config.get('influxdb_user', '')
-    influxdb_password = config.get('influxdb_password', '')
-
-    if not influxdb_url or not influxdb_db:
-        log.warning('InfluxDB not configured, skipping write')
-        return
-
-    timestamp_ns = int(start_time_dt.timestamp() * 1_000_000_000)
+def session_extra_fields(session):
+    """
+    Flatten the optional per-session summaries sent by the Deck (telemetry and
+    MangoHud frametimes) into InfluxDB fields: nested stats become
+    <metric>_<stat> (e.g. power_w_mean), scalars keep their name (e.g. fps_avg).
+    """
+    fields = {}
+    for summary_key in ('telemetry', 'frametimes'):
+        summary = session.get(summary_key)
+        if not isinstance(summary, dict):
+            continue
+        for key, value in summary.items():
+            if isinstance(value, dict):
+                for stat, stat_value in value.items():
+                    if isinstance(stat_value, (int, float)) and not isinstance(stat_value, bool):
+                        fields[f'{key}_{stat}'] = stat_value
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                fields[key] = value
+    return fields
+
+def format_influx_field(value):
+    if isinstance(value, int):
+        return f'{value}i'
+    return str(round(float(value), 2))
+
+def playtime_line(record):
+    """Line protocol for a session record (see append_session_log) in the current tag schema."""
+    timestamp_ns = int(record['start_time'] * 1_000_000_000)
 
     # Build tags dynamically — skip empty appid since InfluxDB rejects empty tag values
     tags = [
-        f'game={escape_influx_tag(game_name)}',
-        f'game_type={escape_influx_tag(game_type)}',
+        f'game={escape_influx_tag(record["game"])}',
+        f'game_type={escape_influx_tag(record["game_type"])}',
     ]
-    if appid:
-        tags.append(f'appid={escape_influx_tag(appid)}')
+    if record.get('appid'):
+        tags.append(f'appid={escape_influx_tag(record["appid"])}')
     tag_str = ','.join(tags)
 
     # Convert string fields to UTC so Grafana displays correct local time
-    field_first_played = escape_influx_string_field(to_utc_string(first_played))
-    field_last_played  = escape_influx_string_field(to_utc_string(last_played))
+    field_first_played = escape_influx_string_field(to_utc_string(record['first_played']))
+    field_last_played  = escape_influx_string_field(to_utc_string(record['last_played']))
 
-    line = (
+    extra_str = ''.join(
+        f',{escape_influx_tag(key)}={format_influx_field(value)}'
+        for key, value in (record.get('fields') or {}).items()
+    )
+
+    return (
         f'playtime,{tag_str} '
-        f'total_seconds={round(total_seconds, 2)},'
-        f'session_seconds={round(session_seconds, 2)},'
-        f'session_count={session_count}i,'
+        f'total_seconds={round(record["total_seconds"], 2)},'
+        f'session_seconds={round(record["session_seconds"], 2)},'
+        f'session_count={record["session_count"]}i,'
         f'first_played="{field_first_played}",'
-        f'last_played="{field_last_played}" '
+        f'last_played="{field_last_played}"'
+        f'{extra_str} '
         f'{timestamp_ns}'
     )
 
+def write_to_influxdb(game_name, appid, game_type, total_seconds, session_seconds,
+                       session_count, first_played, last_played, start_time_dt,
+                       extra_fields=None, session_id=None, deck=None, on_durable=None):
+    """
+    Append the session to the session log and rollups and queue its playtime
+    point for InfluxDB. on_durable is called once a library flush has made the
+    session durable (see flush_library). Raises OSError if the session log
+    could not be written.
+    """
+    record = {
+        'session_id':      session_id,
+        'deck':            deck,
+        'game':            game_name,
+        'appid':           appid or '',
+        'game_type':       game_type,
+        'total_seconds':   total_seconds,
+        'session_seconds': session_seconds,
+        'session_count':   session_count,
+        'first_played':    first_played,
+        'last_played':     last_played,
+        'start_time':      start_time_dt.timestamp(),
+        'fields':          extra_fields or {},
+    }
+    rollup_lines = append_session_log(record, on_durable)
+    with library_file_lock:
+        schedule_library_flush()
+
+    if not influx_writer.configured():
+        log.warning('InfluxDB not configured, skipping write')
+        return
+
+    line = playtime_line(record)
+    log.info(f'InfluxDB line: {line}')
+    influx_writer.enqueue(line, *rollup_lines)
+
+# ── Session log ────────────────────────────────────────────────────────────────
+# Every processed session is appended to session_log_file as one JSON line with
+# the values its InfluxDB point is built from, so the playtime measurement can
+# be regenerated later with the backfill command. The record also carries the
+# library entry the session produced, which makes the log the write-ahead log
+# the library is recovered from (see replay_session_log).
+session_log_lock    = threading.Lock()
+session_log_size    = 0    # end offset of the last appended record
+session_log_pending = []   # (session_id, on_durable) appended since the last library flush
+
+def session_log_path():
+    return config.get('session_log_file', '/config/scripts/steam_session_log.jsonl')
+
+def append_session_log(record, on_durable=None):
+    """
+    Append a session record and add it to the rollups, under one lock so the
+    rollups' session log offset matches what they contain. Returns the rollup
+    points the session changed. Raises OSError if the record could not be
+    written; the session is then neither rolled up nor made durable.
+    """
+    global session_log_size
+    line = json.dumps(record, separators=(',', ':')) + '\n'
+    with session_log_lock:
+        try:
+            with open(session_log_path(), 'a') as f:
+                f.write(line)
+                session_log_size = f.tell()
+        except OSError as e:
+            log.error(f'Failed to append to session log, session {record["session_id"]} not applied: {e}')
+            try:
+                os.truncate(session_log_path(), session_log_size)  # drop a partly written line
+            except OSError:
+                pass
+            raise
+        if on_durable is not None:
+            session_log_pending.append((record['session_id'], on_durable))
+        return rollup_session(record, session_log_size)
+
+def take_session_log_pending():
+    """
+    The session log size and the sessions appended up to it that wait for a
+    library flush. Taken together so every record before the offset is
+    finished by this flush or an earlier one.
+    """
+    global session_log_pending
+    with session_log_lock:
+        pending = session_log_pending
+        session_log_pending = []
+        return session_log_size, pending
+
+def return_session_log_pending(pending):
+    """Put sessions back after a failed library flush."""
+    with session_log_lock:
+        session_log_pending[:0] = pending
+
+def sync_session_log():
+    """fsync the session log, so the records a library write covers are on disk before it."""
     try:
-        params = urllib.parse.urlencode({
-            'db': influxdb_db,
-            'u': influxdb_user,
-            'p': influxdb_password
-        })
-        log.info(f'InfluxDB line: {line}')
-        url = f'{influxdb_url}/write?{params}'
-        req = urllib.request.Request(url, data=line.encode('utf-8'), method='POST')
-        with urllib.request.urlopen(req, timeout=10) as resp:
-            if resp.status == 204:
-                log.info(f'InfluxDB write successful for {game_name}')
-            else:
-                log.warning(f'InfluxDB write returned unexpected status {resp.status}')
-    except urllib.error.HTTPError as e:
-        body = e.read().decode('utf-8')
-        log.error(f'InfluxDB write failed for {game_name}: {e} | Body: {body}')
-    except Exception as e:
-        log.error(f'InfluxDB write failed for {game_name}: {e}')
+        fd = os.open(session_log_path(), os.O_RDONLY)
+    except FileNotFoundError:
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
 
-# ── MQTT ACK publisher ─────────────────────────────────────────────────────────
-def publish_ack(session_id):
+def read_session_log_tail(offset):
     """
-    Publish a retained ACK message to steamdeck/playtime/ack/<session_id>
-    so the Steam Deck script knows this session has been processed.
+    (offset, record) for the session log records from byte offset on. A
+    partial last line left by a crash is truncated so the next append starts
+    on a fresh line.
     """
-    mqtt_host = config.get('mqtt_host')
-    mqtt_port = int(config.get('mqtt_port', 8883))
-    mqtt_user = config.get('mqtt_user')
-    mqtt_pass = config.get('mqtt_pass')
+    records = []
+    try:
+        with open(session_log_path(), 'rb+') as f:
+            f.seek(offset)
+            data = f.read()
+            end  = data.rfind(b'\n') + 1
+            if end < len(data):
+                log.warning(f'Truncating a partial session log record at offset {offset + end}')
+                f.truncate(offset + end)
+    except FileNotFoundError:
+        return records
+    for raw in data[:end].splitlines(keepends=True):
+        try:
+            records.append((offset, json.loads(raw)))
+        except json.JSONDecodeError:
+            log.warning('Skipping malformed session log record')
+        offset += len(raw)
+    return records
 
-    if not mqtt_host:
-        log.warning('MQTT not configured in config, skipping ACK publish')
-        return
+def replay_session_log():
+    """
+    Reapply the session log records past the offset the library file covers —
+    sessions applied after the last library flush before a crash — and flush.
+    Each record holds the whole resulting library entry, so replaying one that
+    is already in the library is harmless.
+
+    Sessions from the previous flush's offset on may have been applied without
+    being recorded as processed yet; those are recorded now so a resent session
+    or a leftover queue journal entry is not applied a second time, and their
+    playtime points are queued again in case the crash came before they were
+    (InfluxDB overwrites a point with the same series and timestamp).
+    """
+    global session_log_size, library_log_offset
+    path = session_log_path()
+    size = os.path.getsize(path) if os.path.exists(path) else 0
+    with library_file_lock:
+        games   = load_library()
+        covered = read_library_file().get('session_log') or {}
+        library_log_offset = covered.get('offset')
+        offset   = size if library_log_offset is None else library_log_offset
+        previous = covered.get('previous_offset')
+        previous = offset if previous is None else min(previous, offset)
+        if offset > size:
+            log.warning(f'Session log is shorter than the library file expects ({size} < {offset}), not replaying')
+            offset = previous = size
+        replayed = []
+        for position, record in read_session_log_tail(previous):
+            try:
+                session_id = record['session_id']
+                if position < offset:
+                    replayed.append(record)
+                    continue
+                key = find_library_key(record['game'])
+                if key is None:
+                    key = record['game']
+                    library_index[normalize_game_name(key)] = key
+                games[key] = {
+                    'seconds':       round(record['total_seconds'], 2),
+                    'session_count': record['session_count'],
+                    'first_played':  record['first_played'],
+                    'last_played':   record['last_played'],
+                }
+            except (KeyError, TypeError):
+                log.warning('Skipping malformed session log record')
+                continue
+            library_dirty.add(key)
+            replayed.append(record)
+        with session_log_lock:
+            session_log_size = os.path.getsize(path) if os.path.exists(path) else 0
+    if library_dirty:
+        log.info(f'Replayed {len(library_dirty)} game(s) from the session log into the library')
+    for record in replayed:
+        if not record['session_id'] or processed_outcome(record['session_id']) is not None:
+            continue
+        record_processed_session(record['session_id'], 'applied')
+        if influx_writer.configured():
+            try:
+                with stats_lock:
+                    rollup_lines = session_rollup_lines(record) if stats is not None else []
+                influx_writer.enqueue(playtime_line(record), *rollup_lines)
+            except (KeyError, TypeError, ValueError):
+                log.warning(f'Cannot rebuild the InfluxDB point of session {record["session_id"]}')
+    flush_library()
+
+# ── Playtime rollups ───────────────────────────────────────────────────────────
+# Totals per game, game_type and Deck, and per day, ISO week and month, kept
+# up to date as sessions are applied so /stats answers from memory. A session
+# counts towards the period it started in. Each period bucket has the same
+# per-game, per-game_type and per-Deck breakdown. The rollups are written to
+# stats_file on every library flush together with the session log offset they
+# cover; at startup the records past it are added, and the rollups are rebuilt
+# from the whole log when the file is missing.
+# Each session also rewrites its game's day and month point in the
+# playtime_daily and playtime_monthly measurements with the rolled-up values,
+# so Grafana panels read one point per game and period instead of every
+# session. The points are queued together with the session's playtime point.
+STATS_PERIODS = {'day': 'days', 'week': 'weeks', 'month': 'months'}
+STATS_FILTERS = {'game': 'games', 'game_type': 'game_types', 'deck': 'decks'}
+ROLLUP_MEASUREMENTS = {'days': ('playtime_daily', '%Y-%m-%d'), 'months': ('playtime_monthly', '%Y-%m')}
+
+stats_lock  = threading.Lock()
+stats       = None   # see empty_stats()
+stats_dirty = False
+
+def stats_path():
+    default = os.path.join(os.path.dirname(config['library_file']), 'steam_library_stats.json')
+    return config.get('stats_file', default)
+
+def empty_stats():
+    return {'seconds': 0, 'sessions': 0, 'games': {}, 'game_types': {}, 'decks': {},
+            'days': {}, 'weeks': {}, 'months': {}, 'updated_at': None, 'session_log_offset': 0}
+
+def period_keys(start):
+    """The day, ISO week and month keys of a session starting at datetime start."""
+    year, week, _ = start.isocalendar()
+    return {'days': start.strftime('%Y-%m-%d'), 'weeks': f'{year}-W{week:02d}', 'months': start.strftime('%Y-%m')}
+
+def add_seconds(totals, key, seconds):
+    bucket = totals.setdefault(key, {'seconds': 0, 'sessions': 0})
+    bucket['seconds']   = round(bucket['seconds'] + seconds, 2)
+    bucket['sessions'] += 1
+    return bucket
+
+def add_session_to_stats(record):
+    """
+    Add a session record (see append_session_log) to the rollups. Call with
+    stats_lock held. A malformed record raises before anything is changed.
+    """
+    seconds       = record['session_seconds']
+    total_seconds = record['total_seconds']
+    last_played   = record['last_played']
+    game          = record['game']
+    game_type     = record.get('game_type') or 'unknown'
+    deck          = record.get('deck') or config.get('default_deck', 'steamdeck')
+    start         = datetime.fromtimestamp(record['start_time'])
+    if (not isinstance(seconds, (int, float)) or not isinstance(total_seconds, (int, float))
+            or not all(isinstance(v, str) for v in (last_played, game, game_type, deck))):
+        raise TypeError('malformed session record')
+
+    for totals in [stats] + [stats[name].setdefault(key, {'seconds': 0, 'sessions': 0})
+                             for name, key in period_keys(start).items()]:
+        totals['seconds']   = round(totals['seconds'] + seconds, 2)
+        totals['sessions'] += 1
+        entry = add_seconds(totals.setdefault('games', {}), game, seconds)
+        if entry.get('last_played', '') <= last_played:
+            entry['last_played']   = last_played
+            entry['total_seconds'] = total_seconds
+        add_seconds(totals.setdefault('game_types', {}), game_type, seconds)
+        add_seconds(totals.setdefault('decks', {}), deck, seconds)
+
+    stats['games'][game]['game_type'] = game_type
+    stats['updated_at'] = datetime.now().isoformat(timespec='seconds')
+
+def rollup_line(period, key, game, game_type, entry):
+    """Line protocol for one game's playtime_daily or playtime_monthly point, timestamped at the period's local start."""
+    measurement, key_format = ROLLUP_MEASUREMENTS[period]
+    timestamp_ns = int(datetime.strptime(key, key_format).timestamp()) * 1_000_000_000
+    fields = [
+        f'session_seconds={round(entry["seconds"], 2)}',
+        f'sessions={entry["sessions"]}i',
+    ]
+    if entry.get('total_seconds') is not None:
+        fields.append(f'total_seconds={round(entry["total_seconds"], 2)}')
+    if entry.get('last_played'):
+        fields.append(f'last_played="{escape_influx_string_field(to_utc_string(entry["last_played"]))}"')
+    return (
+        f'{measurement},game={escape_influx_tag(game)},game_type={escape_influx_tag(game_type)} '
+        f'{",".join(fields)} {timestamp_ns}'
+    )
 
-    topic = f"steamdeck/playtime/ack/{session_id}"
+def session_rollup_lines(record):
+    """The rollup points a session record changed. Call with stats_lock held, after add_session_to_stats."""
+    game      = record['game']
+    game_type = record.get('game_type') or 'unknown'
+    keys      = period_keys(datetime.fromtimestamp(record['start_time']))
+    return [rollup_line(period, keys[period], game, game_type, stats[period][keys[period]]['games'][game])
+            for period in ROLLUP_MEASUREMENTS]
+
+def add_session_log_to_stats(offset):
+    """
+    Add the session log records from byte offset on to the rollups and move
+    their session_log_offset past them. A partial last line is left for later.
+    Returns the number of sessions added.
+    """
+    sessions = 0
+    try:
+        with open(session_log_path(), 'rb') as f:
+            f.seek(offset)
+            for raw in f:
+                if not raw.endswith(b'\n'):
+                    break
+                offset += len(raw)
+                try:
+                    add_session_to_stats(json.loads(raw))
+                except (json.JSONDecodeError, KeyError, TypeError, ValueError):
+                    log.warning('Skipping malformed session log record')
+                    continue
+                sessions += 1
+    except FileNotFoundError:
+        pass
+    stats['session_log_offset'] = offset
+    return sessions
+
+def rebuild_stats():
+    """Rollups recomputed from the session log."""
+    global stats
+    stats = empty_stats()
+    sessions = add_session_log_to_stats(0)
+    log.info(f'Playtime rollups rebuilt from {sessions} session(s) in the session log')
+
+def load_stats():
+    """
+    Load the rollups from stats_file and add the sessions logged after it was
+    written, rebuilding them if it is missing, malformed or from before the
+    file recorded its session log offset.
+    """
+    global stats, stats_dirty
+    with stats_lock:
+        try:
+            with open(stats_path()) as f:
+                stats = json.load(f)
+            offset = stats.get('session_log_offset')
+            path   = session_log_path()
+            size   = os.path.getsize(path) if os.path.exists(path) else 0
+            if isinstance(offset, int) and offset <= size:
+                added = add_session_log_to_stats(offset)
+                log.info(
+                    f'Playtime rollups loaded: {stats["sessions"]} session(s), {len(stats["games"])} game(s), '
+                    f'{added} added from the session log'
+                )
+                if added:
+                    stats_dirty = True
+                return
+            log.warning('Stats file does not match the session log, rebuilding')
+        except FileNotFoundError:
+            pass
+        except (json.JSONDecodeError, KeyError, TypeError, AttributeError):
+            log.error('Stats file is malformed, rebuilding')
+        rebuild_stats()
+        stats_dirty = True
+
+def rollup_session(record, offset):
+    """
+    Add an applied session to the rollups, which are written with the next
+    library flush. offset is the session log offset after its record. Returns
+    the rollup points to write to InfluxDB. Call with session_log_lock held.
+    """
+    global stats_dirty
+    with stats_lock:
+        if stats is None:
+            return []
+        try:
+            add_session_to_stats(record)
+        except (KeyError, TypeError, ValueError) as e:
+            log.error(f'Session {record.get("session_id")} not added to the rollups: {e}')
+            return []
+        finally:
+            stats['session_log_offset'] = offset
+            stats_dirty = True
+        return session_rollup_lines(record)
+
+def flush_stats():
+    """Write the rollups if they changed. Returns False if the write failed."""
+    global stats_dirty
+    with stats_lock:
+        if not stats_dirty:
+            return True
+        body = json.dumps(stats, separators=(',', ':'))
+        stats_dirty = False
+    path     = stats_path()
+    tmp_path = path + '.tmp'
     try:
+        with open(tmp_path, 'w') as f:
+            f.write(body)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        log.error(f'Failed to write stats file, retrying: {e}')
+        with stats_lock:
+            stats_dirty = True
+        return False
+    return True
+
+def top_totals(totals, top):
+    """totals ordered by seconds, limited to the top entries (all if top is None)."""
+    ranked = sorted(totals.items(), key=lambda item: item[1]['seconds'], reverse=True)
+    return {key: dict(value) for key, value in ranked[:top]}
+
+def stats_view(totals, top, breakdown=None, value=None):
+    """
+    Totals with their breakdowns. With a filter, only that breakdown's entry
+    (matched case- and trademark-insensitively) and its own totals.
+    """
+    if breakdown is None:
+        result = {'seconds': totals['seconds'], 'sessions': totals['sessions']}
+        for name in STATS_FILTERS.values():
+            result[name] = top_totals(totals.get(name, {}), top)
+        return result
+    normalized = normalize_game_name(value)
+    entries = {key: dict(entry) for key, entry in totals.get(breakdown, {}).items()
+               if normalize_game_name(key) == normalized}
+    return {
+        'seconds':  round(sum(e['seconds'] for e in entries.values()), 2),
+        'sessions': sum(e['sessions'] for e in entries.values()),
+        breakdown:  entries,
+    }
+
+def query_stats(params):
+    """
+    The /stats response for the query parameters (name → list of values).
+
+    Without period: overall totals plus totals per game, game_type and Deck.
+    With period=day|week|month: one bucket per period between since and until
+    (inclusive, in the period's key format, e.g. 2026-10-19, 2026-W42, 2026-10),
+    optionally only the last N periods with playtime. One of game, game_type
+    or deck restricts the totals to that entry; top=N keeps the N entries of
+    each breakdown with the most playtime. Raises ValueError for invalid
+    parameters.
+    """
+    def param(name):
+        values = params.get(name)
+        return values[-1] if values else None
+
+    period = param('period')
+    if period is not None and period not in STATS_PERIODS:
+        raise ValueError(f'period must be one of {", ".join(STATS_PERIODS)}')
+    try:
+        top  = int(param('top')) if param('top') is not None else None
+        last = int(param('last')) if param('last') is not None else None
+    except ValueError:
+        raise ValueError('top and last must be integers')
+    since   = param('since')
+    until   = param('until')
+    filters = [(breakdown, param(name)) for name, breakdown in STATS_FILTERS.items() if param(name) is not None]
+    if len(filters) > 1:
+        raise ValueError(f'use only one of {", ".join(STATS_FILTERS)}')
+    breakdown, value = filters[0] if filters else (None, None)
+
+    with stats_lock:
+        if stats is None:
+            raise ValueError('Rollups are not loaded')
+        if period is None:
+            result = stats_view(stats, top, breakdown, value)
+            result['updated_at'] = stats['updated_at']
+            return result
+        periods = stats[STATS_PERIODS[period]]
+        buckets = {}
+        for key in sorted(periods):
+            if (since is None or key >= since) and (until is None or key <= until):
+                bucket = stats_view(periods[key], top, breakdown, value)
+                if bucket['sessions']:
+                    buckets[key] = bucket
+        if last is not None:
+            buckets = dict(list(buckets.items())[-last:]) if last > 0 else {}
+        return {'period': period, 'buckets': buckets, 'updated_at': stats['updated_at']}
+
+# ── InfluxDB writer ────────────────────────────────────────────────────────────
+class InfluxWriter:
+    """
+    Buffers line-protocol points and writes them in batches from a background
+    thread over one keep-alive connection, gzip-compressed.
+
+    A batch goes out once influxdb_batch_size points are buffered or the
+    oldest has waited influxdb_flush_interval seconds. Failed batches are
+    retried with exponential backoff (up to influxdb_max_backoff seconds) and
+    spilled to influxdb_spool_file, which is loaded again at startup. With
+    influxdb_durable_ack every point is appended to the spool (fsync) before
+    enqueue() returns, so the session ACK that follows never outruns the data.
+    A rejected batch (HTTP 4xx other than 429) is resent in halves until the
+    rejected points are found; only those are dropped, and they are appended
+    to influxdb_reject_file for inspection. After a failed request the rest of
+    the batch is sent where it stopped.
+    """
+
+    def __init__(self):
+        self.cond       = threading.Condition()
+        self.buffer     = []    # [line, spooled, enqueued monotonic time]
+        self.thread     = None
+        self.connection = None
+        self.backoff    = 0
+        self.stopping   = False
+        self.stats      = {'enqueued': 0, 'written': 0, 'batches': 0, 'failures': 0,
+                           'dropped': 0, 'last_error': None}
+
+    def configured(self):
+        return bool(config.get('influxdb_url') and config.get('influxdb_db'))
+
+    def spool_path(self):
+        return config.get('influxdb_spool_file', '/config/scripts/influxdb_spool.lp')
+
+    def reject_path(self):
+        default = os.path.join(os.path.dirname(self.spool_path()), 'influxdb_rejected.lp')
+        return config.get('influxdb_reject_file', default)
+
+    def start(self):
+        if not self.configured():
+            return
+        try:
+            with open(self.spool_path(), 'r') as f:
+                spooled = [line.rstrip('\n') for line in f if line.strip()]
+        except FileNotFoundError:
+            spooled = []
+        if spooled:
+            log.info(f'InfluxDB spool: {len(spooled)} point(s) from a previous run queued for writing')
+        now = time_module.monotonic()
+        with self.cond:
+            # points queued before start() that were spooled are in spooled already
+            self.buffer = [[line, True, now] for line in spooled] + [e for e in self.buffer if not e[1]]
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=5):
+        """Try to write what is buffered, then spool whatever is left."""
+        if self.thread is None:
+            return
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+        self.thread.join(timeout)
+        with self.cond:
+            self.spool_unspooled(self.buffer)
+
+    def enqueue(self, *lines):
+        """Buffer the points of one session (its playtime point and rollup points) together."""
+        durable = config.get('influxdb_durable_ack', False)
+        with self.cond:
+            now     = time_module.monotonic()
+            entries = [[line, False, now] for line in lines]
+            if durable:
+                self.spool_unspooled(entries)
+            self.buffer.extend(entries)
+            self.stats['enqueued'] += len(entries)
+            self.cond.notify_all()
+
+    def spool_unspooled(self, entries):
+        """Append entries not yet in the spool file to it. Call with cond held."""
+        pending = [e for e in entries if not e[1]]
+        if not pending:
+            return
+        try:
+            with open(self.spool_path(), 'a') as f:
+                f.write(''.join(e[0] + '\n' for e in pending))
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError as e:
+            log.error(f'Failed to write InfluxDB spool, {len(pending)} point(s) only in memory: {e}')
+            return
+        for e in pending:
+            e[1] = True
+
+    def rewrite_spool(self):
+        """Keep only still-buffered spooled points in the spool file. Call with cond held."""
+        remaining = [e[0] for e in self.buffer if e[1]]
+        path = self.spool_path()
+        try:
+            if not remaining:
+                if os.path.exists(path):
+                    os.remove(path)
+                return
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                f.write(''.join(line + '\n' for line in remaining))
+            os.replace(tmp_path, path)
+        except OSError as e:
+            log.error(f'Failed to rewrite InfluxDB spool: {e}')
+
+    def write_rejects(self, entries, reason):
+        """Append rejected points to the reject file, after a comment with the reason."""
+        log.error(f'{len(entries)} point(s) rejected by InfluxDB, moved to {self.reject_path()}')
+        try:
+            with open(self.reject_path(), 'a') as f:
+                f.write(f'# {datetime.now().isoformat(timespec="seconds")} {reason}\n')
+                f.write(''.join(e[0] + '\n' for e in entries))
+        except OSError as e:
+            log.error(f'Failed to write InfluxDB reject file, {len(entries)} point(s) lost: {e}')
+
+    def next_batch(self):
+        """Wait until a batch is due and return it (still in the buffer), or None when stopping."""
+        batch_size = config.get('influxdb_batch_size', 500)
+        interval   = config.get('influxdb_flush_interval', 1)
+        with self.cond:
+            while True:
+                if self.buffer:
+                    due = self.buffer[0][2] + interval
+                    if self.stopping or len(self.buffer) >= batch_size or time_module.monotonic() >= due:
+                        return self.buffer[:batch_size]
+                    self.cond.wait(max(0.01, due - time_module.monotonic()))
+                elif self.stopping:
+                    return None
+                else:
+                    self.cond.wait()
+
+    def run(self):
+        parts = None  # what is left of a batch whose write was interrupted
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                return
+            written, rejected, parts = self.send(parts or [(batch, False)])
+            done = {id(e) for e in written}
+            done.update(id(e) for e in rejected)
+            with self.cond:
+                if done:
+                    self.buffer = [e for e in self.buffer if id(e) not in done]
+                    self.stats['written'] += len(written)
+                    self.stats['dropped'] += len(rejected)
+                    if rejected:
+                        self.write_rejects(rejected, self.stats['last_error'])
+                    if any(e[1] for e in written) or any(e[1] for e in rejected):
+                        self.rewrite_spool()
+                if parts:
+                    unsent = [e for part, _ in parts for e in part]
+                    self.stats['failures'] += 1
+                    self.spool_unspooled(unsent)
+                    self.backoff = min(max(1, self.backoff * 2), config.get('influxdb_max_backoff', 300))
+                    log.warning(f'InfluxDB write of {len(unsent)} point(s) failed, retrying in {self.backoff}s')
+                    retry_at = time_module.monotonic() + self.backoff
+                    while not self.stopping and time_module.monotonic() < retry_at:
+                        self.cond.wait(retry_at - time_module.monotonic())
+                    if self.stopping:
+                        return
+                    continue
+                self.backoff = 0
+            if written:
+                log.info(f'InfluxDB batch written: {len(written)} point(s)')
+
+    def send(self, parts):
+        """
+        Write parts, a stack of (entries, known to be rejected) with the next
+        part last. A rejected part is resent in halves, down to single points,
+        so one bad point does not take the rest of the batch with it. Parts go
+        out in order, since a rollup point replaces the one written before it.
+        Returns the written and the rejected entries and, if a request failed,
+        the parts still to send (empty otherwise).
+        """
+        written, rejected = [], []
+        while parts:
+            part, known_rejected = parts.pop()
+            if not known_rejected:
+                result = self.post_entries(part)
+                if result == 'retry':
+                    parts.append((part, False))
+                    return written, rejected, parts
+                if result == 'ok':
+                    written.extend(part)
+                    continue
+            if len(part) == 1:
+                rejected.extend(part)
+                continue
+            middle = len(part) // 2
+            parts += [(part[middle:], False), (part[:middle], False)]
+        return written, rejected, []
+
+    def post_entries(self, entries):
+        return self.post(''.join(e[0] + '\n' for e in entries))
+
+    def post(self, body):
+        """POST one batch to /write. Returns 'ok', 'retry' or 'rejected'."""
+        url    = urllib.parse.urlsplit(config['influxdb_url'])
+        params = urllib.parse.urlencode({
+            'db': config['influxdb_db'],
+            'u':  config.get('influxdb_user', ''),
+            'p':  config.get('influxdb_password', '')
+        })
+        data    = body.encode('utf-8')
+        headers = {'Content-Type': 'text/plain; charset=utf-8'}
+        if config.get('influxdb_gzip', True):
+            data = gzip.compress(data)
+            headers['Content-Encoding'] = 'gzip'
+        started = time_module.monotonic()
+        try:
+            if self.connection is None:
+                conn_class = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+                self.connection = conn_class(url.hostname, url.port, timeout=10)
+            self.connection.request('POST', f'{url.path.rstrip("/")}/write?{params}', body=data, headers=headers)
+            resp = self.connection.getresponse()
+            detail = resp.read().decode('utf-8', 'replace')
+        except (OSError, http.client.HTTPException) as e:
+            # Dropped keep-alive connection or InfluxDB down — reconnect on the next attempt
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+            self.record_error(str(e))
+            return 'retry'
+        finally:
+            influx_write_metric.observe(time_module.monotonic() - started)
+        if resp.status == 204:
+            with self.cond:
+                self.stats['batches'] += 1
+            return 'ok'
+        self.record_error(f'HTTP {resp.status}: {detail}')
+        if resp.status == 429 or resp.status >= 500:
+            return 'retry'
+        log.error(f'InfluxDB rejected batch: HTTP {resp.status} | Body: {detail}')
+        return 'rejected'
+
+    def record_error(self, message):
+        with self.cond:
+            self.stats['last_error'] = message
+
+    def status(self):
+        with self.cond:
+            result = dict(self.stats)
+            result['buffered'] = len(self.buffer)
+            result['spooled']  = sum(1 for e in self.buffer if e[1])
+            result['backoff']  = self.backoff
+        return result
+
+influx_writer = InfluxWriter()
+
+# ── MQTT connection ────────────────────────────────────────────────────────────
+DECK_QUEUE_TOPICS = ('steamdeck/playtime/queue', 'steamdeck/playtime/queue_packed')
+
+class MqttConnection:
+    """
+    One long-lived MQTT connection for ACK and capability publishes, for the
+    Deck's completed session traces and, with mqtt_subscribe enabled, for
+    receiving the Deck queue directly.
+
+    paho's network loop reconnects on its own (1–30 s backoff) and the
+    subscriptions are renewed on every connect. Messages are published at QoS 1
+    and confirmed by the broker's PUBACK; anything published while the
+    connection is down stays in paho's outbound queue and is sent after the
+    reconnect.
+    """
+
+    def __init__(self):
+        self.client        = None
+        self.subscriptions = {}  # topic → handler(topic, payload bytes, retained)
+        self.connected     = threading.Event()
+        self.stats_lock    = threading.Lock()
+        self.ack_latencies = deque(maxlen=500)
+        self.stats         = {'published': 0, 'confirmed': 0, 'unconfirmed': 0, 'received': 0,
+                              'connects': 0, 'reconnects': 0, 'last_error': None}
+
+    def start(self):
+        mqtt_host = config.get('mqtt_host')
+        if not mqtt_host:
+            log.warning('MQTT not configured in config, ACKs will not be published')
+            return
         client = mqtt_client.Client(mqtt_client.CallbackAPIVersion.VERSION2)
-        client.username_pw_set(mqtt_user, mqtt_pass)
-        client.tls_set(cert_reqs=ssl.CERT_NONE)
-        client.tls_insecure_set(True)
-        client.connect(mqtt_host, mqtt_port, keepalive=30)
+        client.username_pw_set(config.get('mqtt_user'), config.get('mqtt_pass'))
+        if config.get('mqtt_tls', True):
+            client.tls_set(cert_reqs=ssl.CERT_NONE)
+            client.tls_insecure_set(True)
+        client.reconnect_delay_set(min_delay=1, max_delay=30)
+        client.max_queued_messages_set(1000)
+        client.on_connect    = self.on_connect
+        client.on_disconnect = self.on_disconnect
+        client.on_message    = self.on_message
+        client.connect_async(mqtt_host, int(config.get('mqtt_port', 8883)), keepalive=60)
         client.loop_start()
-        result = client.publish(topic, payload=session_id, retain=True)
-        result.wait_for_publish(timeout=5)
-        client.loop_stop()
-        client.disconnect()
-        log.info(f'ACK published for session {session_id} → {topic}')
-    except Exception as e:
-        log.error(f'Failed to publish ACK for session {session_id}: {e}')
+        self.client = client
+        # Give the first connection a moment so startup publishes go out directly
+        self.connected.wait(config.get('mqtt_publish_timeout', 10))
+
+    def subscribe(self, topic, handler):
+        """Register handler for topic. Call before start(); handlers run on paho's network thread and must not block."""
+        self.subscriptions[topic] = handler
+
+    def stop(self):
+        if self.client:
+            self.client.disconnect()
+            self.client.loop_stop()
+
+    def on_connect(self, client, userdata, flags, reason_code, properties):
+        if reason_code.is_failure:
+            self.record_error(f'connect refused: {reason_code}')
+            return
+        with self.stats_lock:
+            self.stats['connects'] += 1
+            if self.stats['connects'] > 1:
+                self.stats['reconnects'] += 1
+        for topic in self.subscriptions:
+            client.subscribe(topic, qos=1)
+        self.connected.set()
+        log.info(f'MQTT connected to {config.get("mqtt_host")}')
+
+    def on_disconnect(self, client, userdata, flags, reason_code, properties):
+        self.connected.clear()
+        if reason_code != 0:
+            self.record_error(f'disconnected: {reason_code}')
+            log.warning(f'MQTT connection lost ({reason_code}), reconnecting')
+
+    def on_message(self, client, userdata, msg):
+        handler = self.subscriptions.get(msg.topic)
+        if handler is None:
+            return
+        with self.stats_lock:
+            self.stats['received'] += 1
+        try:
+            handler(msg.topic, msg.payload, msg.retain)
+        except Exception as e:
+            log.error(f'Error handling MQTT message on {msg.topic}: {e}')
+
+    def record_error(self, message):
+        with self.stats_lock:
+            self.stats['last_error'] = message
+
+    def publish(self, topic, payload):
+        """Publish a retained QoS 1 message. Returns True once the broker confirmed it."""
+        if self.client is None:
+            log.warning('MQTT not configured in config, skipping ACK publish')
+            return False
+        timeout = config.get('mqtt_publish_timeout', 10)
+        started = time_module.monotonic()
+        self.connected.wait(timeout)
+        info = self.client.publish(topic, payload=payload, qos=1, retain=True)
+        with self.stats_lock:
+            self.stats['published'] += 1
+        try:
+            info.wait_for_publish(timeout=max(0.0, timeout - (time_module.monotonic() - started)))
+            confirmed = info.is_published()
+        except (RuntimeError, ValueError) as e:
+            # Not connected or queue full — paho keeps it queued unless the queue was full
+            self.record_error(str(e))
+            confirmed = False
+        elapsed = time_module.monotonic() - started
+        with self.stats_lock:
+            if confirmed:
+                self.stats['confirmed'] += 1
+                self.ack_latencies.append(elapsed)
+            else:
+                self.stats['unconfirmed'] += 1
+        if confirmed:
+            publish_metric.observe(elapsed)
+        else:
+            log.error(f'Publish to {topic} not confirmed by the broker within {timeout}s')
+        return confirmed
+
+    def status(self):
+        with self.stats_lock:
+            result    = dict(self.stats)
+            latencies = sorted(self.ack_latencies)
+        result['connected'] = self.connected.is_set()
+        if latencies:
+            result['ack_p50_ms'] = round(latencies[len(latencies) // 2] * 1000, 2)
+            result['ack_p95_ms'] = round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000, 2)
+            result['ack_max_ms'] = round(latencies[-1] * 1000, 2)
+        return result
+
+mqtt_connection = MqttConnection()
+
+def publish_retained(topic, payload):
+    """Publish a single retained message on the shared connection. Returns True on success."""
+    return mqtt_connection.publish(topic, payload)
+
+def publish_ack(session_id, trace=None, rejected=None):
+    """
+    Publish a retained ACK message to steamdeck/playtime/ack/<session_id>
+    so the Steam Deck script knows this session has been processed. With a
+    trace the payload is {"session_id", "trace"}, otherwise the bare session_id.
+    A session that can never be processed is ACKed with {"session_id",
+    "rejected": reason} so the Deck stops resending it.
+    """
+    topic = f"steamdeck/playtime/ack/{session_id}"
+    if rejected:
+        payload = json.dumps({'session_id': session_id, 'rejected': rejected})
+    else:
+        payload = json.dumps({'session_id': session_id, 'trace': trace}) if trace else session_id
+    if publish_retained(topic, payload):
+        log.info(f'ACK{" (rejected)" if rejected else ""} published for session {session_id} → {topic}')
+        return True
+    return False
+
+def publish_batch_ack(seq, session_ids, traces=None, rejected=None):
+    """
+    Publish one retained ACK for a whole sync batch to
+    steamdeck/playtime/batch_ack/<seq>, listing the sessions that were
+    processed, under traces their session traces and under rejected the
+    sessions that can never be processed (session_id → reason).
+    """
+    topic   = f"steamdeck/playtime/batch_ack/{seq}"
+    message = {'seq': seq, 'session_ids': session_ids}
+    if traces:
+        message['traces'] = traces
+    if rejected:
+        message['rejected'] = rejected
+    payload = json.dumps(message)
+    if publish_retained(topic, payload):
+        log.info(f'Batch ACK published for sync batch {seq} ({len(session_ids)} sessions) → {topic}')
+        return True
+    return False
+
+def publish_capabilities():
+    """
+    Advertise the payload formats this processor can decode on the retained
+    steamdeck/playtime/capabilities topic. The Deck only switches to a binary
+    format for transports listed here.
+    """
+    payload = json.dumps({
+        'schema':     PAYLOAD_SCHEMA,
+        'formats':    available_formats(),
+        'transports': ['http', 'mqtt'] if config.get('mqtt_subscribe') else ['http'],
+    })
+    if publish_retained('steamdeck/playtime/capabilities', payload):
+        log.info(f'Capabilities published: {payload}')
+
+# ── Deck sync batches ──────────────────────────────────────────────────────────
+# After a long offline period the Deck sends its backlog in numbered batches
+# and waits for one ACK per batch before sending the next. A batch is ACKed
+# once every session queued from it has been processed; sessions that failed
+# are left out of the ACK so the Deck sends them again, and invalid sessions
+# are listed as rejected so it drops them.
+sync_batch_lock = threading.Lock()
+sync_batches    = {}  # seq → {'pending': set of session_ids, 'done': [session_ids], 'end_times': [timestamps], 'traces': {}, 'rejected': {}}
+
+def register_sync_batch(seq, session_ids):
+    """Track the sessions queued from a batch, adding to it if it is already in progress."""
+    with sync_batch_lock:
+        batch = sync_batches.setdefault(seq, {'pending': set(), 'done': [], 'end_times': [], 'traces': {}, 'rejected': {}})
+        batch['pending'].update(session_ids)
+
+def finish_sync_session(seq, session_id, processed, end_time=None, trace=None, rejected=None):
+    """
+    Mark one session of a batch as finished; publishes the batch ACK after the
+    last one. rejected is the reason an invalid session will never be processed.
+    """
+    with sync_batch_lock:
+        batch = sync_batches.get(seq)
+        if batch is None:
+            return
+        batch['pending'].discard(session_id)
+        if rejected:
+            batch['rejected'][session_id] = rejected
+        if processed and session_id not in batch['done']:
+            batch['done'].append(session_id)
+            if end_time is not None:
+                batch['end_times'].append(end_time)
+            if trace:
+                batch['traces'][session_id] = trace
+        if batch['pending']:
+            return
+        del sync_batches[seq]
+    if publish_batch_ack(seq, batch['done'], batch['traces'], batch['rejected']):
+        now = datetime.now().timestamp()
+        for ended in batch['end_times']:
+            session_delay_metric.observe(now - ended)
+
+def ack_deck_session(session_id, sync_seq=None, end_time=None, trace=None):
+    """
+    ACK a processed deck session, per session or as part of its sync batch.
+    end_time (session end, epoch seconds) feeds the ACK delay metric; re-ACKs
+    of already processed sessions leave it out. trace goes back to the Deck
+    with the ACK.
+    """
+    if trace is not None:
+        trace_stage(trace, 'acked')
+    if sync_seq is None:
+        if publish_ack(session_id, trace):
+            if end_time is not None:
+                session_delay_metric.observe(datetime.now().timestamp() - end_time)
+        else:
+            forget_deck_session(session_id)  # let the next identical payload retry it
+    else:
+        finish_sync_session(sync_seq, session_id, processed=True, end_time=end_time, trace=trace)
+
+def reject_deck_session(session_id, reason, sync_seq=None):
+    """ACK an invalid deck session as rejected, per session or as part of its sync batch."""
+    if sync_seq is None:
+        if not publish_ack(session_id, rejected=reason):
+            forget_deck_session(session_id)
+    else:
+        finish_sync_session(sync_seq, session_id, processed=False, rejected=reason)
 
 # ── Processing logic ───────────────────────────────────────────────────────────
 def process_stop_entry(entry):
@@ -352,6 +1893,11 @@ def process_stop_entry(entry):
     properly_closed = entry.get('properly_closed', False)
     entry_id        = entry['entry_id']
 
+    if processed_outcome(entry_id) is not None:
+        log.info(f'Stop entry {entry_id} for {game_name} was already applied, skipping')
+        remove_from_queue_file(entry_id)
+        return
+
     start_time_str = entry.get('start_time')
     stop_time_str  = entry.get('stop_time')
 
@@ -387,41 +1933,59 @@ def process_stop_entry(entry):
     existing_seconds = get_existing_seconds(game_name)
     new_seconds      = existing_seconds + session_seconds
 
-    updated = update_library_entry(
+    key, previous, updated = update_library_entry(
         game_name, new_seconds,
         start_time=start_time.isoformat(),
         stop_time=stop_time.isoformat()
     )
     log.info(f'Improperly closed: {game_name} — {session_seconds}s added to {existing_seconds}s existing')
 
-    write_to_influxdb(
-        game_name=game_name,
-        appid=appid,
-        game_type=game_type,
-        total_seconds=new_seconds,
-        session_seconds=session_seconds,
-        session_count=updated['session_count'],
-        first_played=updated['first_played'],
-        last_played=updated['last_played'],
-        start_time_dt=start_time
-    )
+    try:
+        write_to_influxdb(
+            game_name=game_name,
+            appid=appid,
+            game_type=game_type,
+            total_seconds=new_seconds,
+            session_seconds=session_seconds,
+            session_count=updated['session_count'],
+            first_played=updated['first_played'],
+            last_played=updated['last_played'],
+            start_time_dt=start_time,
+            session_id=entry_id,
+            deck=entry.get('deck'),
+            on_durable=lambda: remove_from_queue_file(entry_id)
+        )
+    except OSError:
+        # not logged, so not applied: the entry stays in the queue journal
+        restore_library_entry(key, previous)
+        raise
 
     mark_recently_stopped(game_name)
-    remove_from_queue_file(entry_id)
 
-def process_deck_session(session):
+def process_deck_session(session, sync_seq=None):
     """
     Process a single closed session from the Steam Deck local queue.
 
     ha_processed=True: session was already recorded by the HA game_stop
     automation (standby case). Skip library and InfluxDB write, just ACK.
 
-    ha_processed=False: normal properly closed session.
+    ha_processed=False: normal properly closed session, ACKed once the library
+    flush covering it has completed.
     Playtime source of truth is localconfig.vdf (values in minutes):
       total_seconds   = end_playtime * 60
       session_seconds = (end_playtime - start_playtime) * 60
     """
     session_id     = session['session_id']
+
+    outcome = processed_outcome(session_id)
+    if outcome is not None:
+        # applied and ACKed between the intake's processed check and its in-flight claim
+        log.info(f'Session {session_id} already processed ({outcome}), re-sending ACK')
+        sessions_metric.inc('already_processed')
+        ack_deck_session(session_id, sync_seq)
+        unmark_in_flight(session_id)
+        return
+
     game_name      = session['name']
     appid          = session.get('appid', '')
     ha_processed   = session.get('ha_processed', False)
@@ -429,13 +1993,17 @@ def process_deck_session(session):
     end_playtime   = int(session.get('end_playtime', 0))
     start_time     = datetime.fromtimestamp(int(session['start_time']))
     end_time       = datetime.fromtimestamp(int(session['end_time']))
+    trace          = session_trace(session)
+    trace_stage(trace, 'started')
 
     if ha_processed:
         log.info(
             f'Deck session already processed by HA, skipping write: '
             f'{game_name} [{session_id}]'
         )
-        publish_ack(session_id)
+        record_processed_session(session_id, 'ha_processed')
+        sessions_metric.inc('ha_processed')
+        ack_deck_session(session_id, sync_seq, end_time.timestamp(), trace)
         unmark_in_flight(session_id)
         return
 
@@ -444,7 +2012,9 @@ def process_deck_session(session):
             f'Deck session for {game_name} [{session_id}] skipped — '
             f'game was recently processed via game_stop (possible duplicate)'
         )
-        publish_ack(session_id)
+        record_processed_session(session_id, 'recently_stopped')
+        sessions_metric.inc('recently_stopped')
+        ack_deck_session(session_id, sync_seq, end_time.timestamp(), trace)
         unmark_in_flight(session_id)
         return
 
@@ -462,27 +2032,40 @@ def process_deck_session(session):
     except (ValueError, TypeError):
         game_type = 'Non-Steam'
 
-    updated = update_library_entry(
+    key, previous, updated = update_library_entry(
         game_name, total_seconds,
         start_time=start_time.isoformat(),
         stop_time=end_time.isoformat()
     )
+    trace_stage(trace, 'library')
 
-    write_to_influxdb(
-        game_name=game_name,
-        appid=appid,
-        game_type=game_type,
-        total_seconds=total_seconds,
-        session_seconds=session_seconds,
-        session_count=updated['session_count'],
-        first_played=updated['first_played'],
-        last_played=updated['last_played'],
-        start_time_dt=start_time
-    )
+    def finish():
+        sessions_metric.inc('applied')
+        ack_deck_session(session_id, sync_seq, end_time.timestamp(), trace)
+        unmark_in_flight(session_id)
+        log.info(f'Deck session processed and ACK sent: {game_name} [{session_id}]')
 
-    publish_ack(session_id)
-    unmark_in_flight(session_id)
-    log.info(f'Deck session processed and ACK sent: {game_name} [{session_id}]')
+    try:
+        write_to_influxdb(
+            game_name=game_name,
+            appid=appid,
+            game_type=game_type,
+            total_seconds=total_seconds,
+            session_seconds=session_seconds,
+            session_count=updated['session_count'],
+            first_played=updated['first_played'],
+            last_played=updated['last_played'],
+            start_time_dt=start_time,
+            extra_fields=session_extra_fields(session),
+            session_id=session_id,
+            deck=session.get('deck'),
+            on_durable=finish
+        )
+    except OSError:
+        # not logged, so not applied: left unACKed (see worker) for the Deck to resend
+        restore_library_entry(key, previous)
+        raise
+    trace_stage(trace, 'influx')
 
 def process_queue_entry(entry):
     """Route a queue entry to the correct handler based on state."""
@@ -494,33 +2077,464 @@ def process_queue_entry(entry):
     else:
         log.warning(f'Unknown entry state: {state}')
 
-# ── Worker thread ──────────────────────────────────────────────────────────────
-memory_queue = queue.Queue()
-
-def worker():
-    """Single worker thread — processes one queue entry at a time in order."""
-    log.info('Worker thread started')
+# ── Worker pool ────────────────────────────────────────────────────────────────
+# Entries are sharded by normalized game name over worker_shards queues, each
+# drained by its own thread. Everything for one game (start, game_stop, deck
+# sessions, library patches) lands on the same shard and is processed in
+# order, which the recently-stopped guard and session_count rely on; different
+# games no longer wait for each other's library, InfluxDB or ACK work.
+# At shutdown the workers stop between entries, before the library is flushed,
+# so nothing is applied in memory after the final flush. Entries still queued
+# are not lost: stop entries are in the queue journal and the Deck resends
+# sessions it has no ACK for.
+work_queues      = []
+worker_threads   = []
+workers_stopping = threading.Event()
+
+def entry_game_name(entry):
+    if 'session' in entry:
+        return entry['session'].get('name', '')
+    return entry.get('game_name', '')
+
+def dispatch(entry):
+    """Queue an entry on its game's shard."""
+    shard = zlib.crc32(normalize_game_name(entry_game_name(entry)).encode()) % len(work_queues)
+    work_queues[shard].put(entry)
+
+def start_workers():
+    shards = max(1, int(config.get('worker_shards', 4)))
+    for shard in range(shards):
+        work_queue = queue.Queue()
+        work_queues.append(work_queue)
+        thread = threading.Thread(target=worker, args=(shard, work_queue), daemon=True)
+        worker_threads.append(thread)
+        thread.start()
+
+def stop_workers(timeout=10):
+    """Let every worker finish its current entry and exit."""
+    workers_stopping.set()
+    for work_queue in work_queues:
+        work_queue.put(None)  # wake idle workers
+    deadline = time_module.monotonic() + timeout
+    for thread in worker_threads:
+        thread.join(max(0.0, deadline - time_module.monotonic()))
+    busy = sum(1 for thread in worker_threads if thread.is_alive())
+    if busy:
+        log.warning(f'{busy} worker(s) still busy after {timeout}s, flushing anyway')
+
+def worker(shard, work_queue):
+    """Worker thread for one shard — processes its entries one at a time in order."""
+    log.info(f'Worker thread {shard} started')
     while True:
-        entry = memory_queue.get()
+        entry = work_queue.get()
+        if entry is None or workers_stopping.is_set():
+            work_queue.task_done()
+            return
         try:
             if entry.get('_type') == 'deck_session':
-                process_deck_session(entry['session'])
+                process_deck_session(entry['session'], entry.get('sync_seq'))
+            elif entry.get('_type') == 'deck_ack':
+                ack_deck_session(entry['session']['session_id'], entry.get('sync_seq'))
+            elif entry.get('_type') == 'deck_reject':
+                reject_deck_session(entry['session']['session_id'], entry['reason'], entry.get('sync_seq'))
+            elif entry.get('_type') == 'library_patch':
+                entry['result'] = patch_library_entry(entry['game_name'], entry['patch'])
             else:
                 process_queue_entry(entry)
         except Exception as e:
-            session_id = entry.get('session', {}).get('session_id') or entry.get('entry_id')
+            session_id = entry.get('session', {}).get('session_id') or entry.get('entry_id') or entry.get('game_name')
             log.error(f'Error processing entry {session_id}: {e}')
             if entry.get('_type') == 'deck_session':
-                unmark_in_flight(entry['session'].get('session_id', ''))
+                failed_id = entry['session'].get('session_id', '')
+                sessions_metric.inc('failed')
+                unmark_in_flight(failed_id)
+                forget_deck_session(failed_id)
+                if entry.get('sync_seq') is not None:
+                    finish_sync_session(entry['sync_seq'], failed_id, processed=False)
         finally:
-            memory_queue.task_done()
+            if '_done' in entry:
+                entry['_done'].set()
+            work_queue.task_done()
+
+# ── Deck queue intake ──────────────────────────────────────────────────────────
+# The Deck republishes its retained queue every 20 s, usually unchanged. Each
+# payload is fingerprinted by its canonical session set; a payload identical
+# to the previous one is dropped without looking at its sessions, and in a
+# changed one only the sessions that are new or changed since the previous
+# payload are considered. Sessions whose processing or ACK failed are
+# forgotten so the next payload retries them, and every
+# deck_queue_full_pass_interval seconds a payload is walked in full anyway,
+# which re-sends ACKs for sessions the Deck still holds. Sync batch payloads
+# are always walked in full.
+deck_queue_lock        = threading.Lock()
+deck_queue_fingerprint = None
+deck_queue_seen        = {}  # session_id → signature in the previous payload
+deck_queue_full_pass   = None  # monotonic time of the last full walk
+deck_queue_stats       = {'payloads_processed': 0, 'payloads_coalesced': 0, 'sessions_unchanged': 0}
+
+SESSION_SIGNATURE_FIELDS = ('name', 'game_state', 'end_playtime', 'end_time', 'ha_processed')
+
+def session_signature(session):
+    """The fields that decide how a session is handled."""
+    return tuple(str(session.get(k)) for k in SESSION_SIGNATURE_FIELDS)
+
+def forget_deck_session(session_id):
+    """Make the next payload consider session_id again."""
+    global deck_queue_fingerprint
+    with deck_queue_lock:
+        deck_queue_seen.pop(session_id, None)
+        deck_queue_fingerprint = None
+
+def diff_deck_queue(sessions):
+    """
+    Return the previous payload's signatures to diff against ({} for a full
+    walk), or None when the payload is identical to the previous one.
+    """
+    global deck_queue_fingerprint, deck_queue_seen, deck_queue_full_pass
+    signatures  = {str(s.get('session_id')): session_signature(s) for s in sessions}
+    fingerprint = hash(frozenset(signatures.items()))
+    now = time_module.monotonic()
+    with deck_queue_lock:
+        full = (deck_queue_full_pass is None or
+                now - deck_queue_full_pass >= config.get('deck_queue_full_pass_interval', 300))
+        if not full and fingerprint == deck_queue_fingerprint and signatures == deck_queue_seen:
+            deck_queue_stats['payloads_coalesced'] += 1
+            return None
+        previous = {} if full else deck_queue_seen
+        deck_queue_seen        = signatures
+        deck_queue_fingerprint = fingerprint
+        if full:
+            deck_queue_full_pass = now
+        deck_queue_stats['payloads_processed'] += 1
+    return previous
+
+def deck_queue_status():
+    with deck_queue_lock:
+        return dict(deck_queue_stats)
+
+def enqueue_deck_queue(data, source='http'):
+    """
+    Queue the closed sessions of a Deck playtime queue payload for the worker.
+    The payload arrives on /process_deck_queue (HA bridge automation) or
+    directly from the MQTT subscription. Returns the counts for the response.
+
+    Closed sessions are processed unless:
+      - ha_processed=True: HA already recorded via game_stop, just ACK
+      - already in-flight: duplicate, skip
+      - recently stopped via game_stop: safety guard, ACK and skip
+      - already processed (processed session store): ACK again and skip
+      - invalid (unknown game_state, missing end data): ACK as rejected
+
+    Opened sessions are skipped — handled by game_stop or standby flow.
+
+    When the payload carries a sync batch (sync.seq), the sessions queued
+    from it are ACKed together with one batch ACK instead of one ACK each.
+    Resent sessions of a batch still in progress are skipped as in-flight.
+
+    The payload's deck id is attached to each queued session for the rollups.
+    """
+    sessions = data.get('active_sessions', [])
+    deck     = data.get('deck')
+    if not sessions:
+        return {'status': 'ok', 'processed': 0, 'skipped': 0}
+
+    sync     = data.get('sync') if isinstance(data.get('sync'), dict) else {}
+    sync_seq = sync.get('seq')
+    to_queue  = []
+    to_ack    = []
+    to_reject = []  # (session, reason)
+
+    if sync_seq is None:
+        previous = diff_deck_queue(sessions)
+        if previous is None:
+            log.debug(f'Deck queue via {source} unchanged, coalesced')
+            return {'status': 'ok', 'coalesced': True, 'processed': 0, 'skipped': 0}
+    else:
+        with deck_queue_lock:
+            deck_queue_stats['payloads_processed'] += 1
+        previous = {}
+
+    queued    = 0
+    skipped   = 0
+    opened    = 0
+    ha_skip   = 0
+    unchanged = 0
+
+    for session in sessions:
+        session_id   = session.get('session_id')
+        game_state   = session.get('game_state')
+        game_name    = session.get('name', 'unknown')
+        ha_processed = session.get('ha_processed', False)
+
+        if previous and previous.get(str(session_id)) == session_signature(session):
+            unchanged += 1
+            continue
+
+        if not session_id:
+            log.warning('Session missing session_id, skipping')
+            sessions_metric.inc('invalid')
+            skipped += 1
+            continue
+
+        if game_state == 'opened':
+            log.info(f'Deck session still open, skipping: {game_name} [{session_id}]')
+            opened += 1
+            continue
+
+        if game_state != 'closed':
+            log.warning(f'Unknown game_state "{game_state}" for session {session_id}, rejecting')
+            sessions_metric.inc('invalid')
+            to_reject.append((session, f'unknown game_state {game_state}'))
+            skipped += 1
+            continue
+
+        if session.get('end_playtime') is None or session.get('end_time') is None:
+            log.warning(f'Closed session {session_id} missing end data, rejecting')
+            sessions_metric.inc('invalid')
+            to_reject.append((session, 'missing end data'))
+            skipped += 1
+            continue
+
+        # In-flight first: a flush records a session as processed before its
+        # on_durable callback sends the ACK and ends the in-flight mark.
+        if is_in_flight(session_id):
+            log.info(f'Session {session_id} already in-flight, skipping duplicate')
+            sessions_metric.inc('duplicate')
+            skipped += 1
+            continue
+
+        outcome = processed_outcome(session_id)
+        if outcome is not None and processed_seconds_ago(session_id) < config.get('ack_resend_grace', 5):
+            # Resent before our ACK reached the Deck; look at it again in the next
+            # payload in case that ACK was lost
+            log.info(f'Session {session_id} processed moments ago, ACK already on its way')
+            forget_deck_session(session_id)
+            skipped += 1
+            continue
+        if outcome is not None:
+            log.info(f'Session {session_id} already processed ({outcome}), re-sending ACK')
+            sessions_metric.inc('already_processed')
+            to_ack.append(session)
+            continue
+
+        if not claim_in_flight(session_id):
+            log.info(f'Session {session_id} already in-flight, skipping duplicate')
+            sessions_metric.inc('duplicate')
+            skipped += 1
+            continue
+
+        trace_stage(session_trace(session), 'received')
+        if deck and not session.get('deck'):
+            session['deck'] = deck
+        to_queue.append(session)
+
+        if ha_processed:
+            log.info(f'Queued ha_processed session for ACK-only: {game_name} [{session_id}]')
+            ha_skip += 1
+        else:
+            log.info(f'Queued deck session for processing: {game_name} [{session_id}]')
+            queued += 1
+
+    if sync_seq is not None and (to_queue or to_ack or to_reject):
+        register_sync_batch(sync_seq, [s['session_id'] for s in to_queue + to_ack + [s for s, _ in to_reject]])
+    for session in to_queue:
+        dispatch({'_type': 'deck_session', 'session': session, 'sync_seq': sync_seq})
+    # ACKs are published by the workers: this may run on paho's network thread
+    for session in to_ack:
+        dispatch({'_type': 'deck_ack', 'session': session, 'sync_seq': sync_seq})
+    for session, reason in to_reject:
+        dispatch({'_type': 'deck_reject', 'session': session, 'sync_seq': sync_seq, 'reason': reason})
+    if unchanged:
+        with deck_queue_lock:
+            deck_queue_stats['sessions_unchanged'] += unchanged
+
+    log.info(
+        f'Deck queue received via {source}: {queued} queued, {ha_skip} ha_processed (ACK only), '
+        f'{len(to_ack)} already processed (ACK resent), {skipped} skipped ({len(to_reject)} rejected), '
+        f'{opened} still open, {unchanged} unchanged since the previous payload'
+        + (f' | sync batch {sync_seq}, {sync.get("remaining", 0)} more closed on the Deck'
+           if sync_seq is not None else '')
+    )
+    return {
+        'status':     'ok',
+        'processed':  queued,
+        'ha_skip':    ha_skip,
+        'acked':      len(to_ack),
+        'rejected':   len(to_reject),
+        'skipped':    skipped,
+        'unchanged':  unchanged,
+        'still_open': opened
+    }
+
+def decode_packed_payload(raw):
+    """Decode a queue_packed payload with whichever binary codec produces a payload naming that format."""
+    for fmt in available_formats():
+        if fmt == 'json':
+            continue
+        try:
+            data = decode_payload(raw, fmt)
+        except Exception:
+            continue
+        if isinstance(data, dict) and data.get('format') == fmt:
+            return data
+    raise ValueError('no available codec decodes the packed payload')
+
+def handle_deck_queue_message(topic, payload, retained):
+    """MQTT handler for the Deck queue topics. Runs on paho's network thread; only queues work."""
+    if not payload:
+        return  # retained message cleared by the Deck
+    try:
+        data = decode_packed_payload(payload) if topic.endswith('_packed') else decode_payload(payload)
+    except Exception as e:
+        log.error(f'Invalid Deck queue payload on {topic}: {e}')
+        return
+    enqueue_deck_queue(data, source='mqtt (retained)' if retained else 'mqtt')
+
+# ── Session traces ─────────────────────────────────────────────────────────────
+# A closed session carries a trace of [stage, unix time] pairs. The Deck adds
+# closed and published, the processor adds received (intake), started (worker),
+# library, influx and acked, and sends the trace back in the ACK. The Deck then
+# adds ack_received and removed and publishes the completed trace on
+# TRACE_TOPIC, where its hop latencies are aggregated for /metrics and /status.
+# Hops between Deck and processor stages include the clock offset of the two.
+TRACE_TOPIC = 'steamdeck/playtime/trace'
+
+trace_stats_lock = threading.Lock()
+trace_hops       = {}  # 'stage→stage' → deque of seconds
+
+def session_trace(session):
+    """The session's trace list, started empty if the Deck sent none."""
+    trace = session.get('trace')
+    if not isinstance(trace, list):
+        trace = session['trace'] = []
+    return trace
+
+def trace_stage(trace, stage):
+    trace.append([stage, round(datetime.now().timestamp(), 3)])
+
+def handle_trace_message(topic, payload, retained):
+    """MQTT handler for completed traces published by the Deck."""
+    try:
+        record = json.loads(payload)
+        trace  = [(str(stage), float(at)) for stage, at in record['trace']]
+    except (ValueError, TypeError, KeyError) as e:
+        log.warning(f'Invalid session trace on {topic}: {e}')
+        return
+    hops = [(f'{a[0]}→{b[0]}', b[1] - a[1]) for a, b in zip(trace, trace[1:])]
+    with trace_stats_lock:
+        for hop, seconds in hops:
+            trace_hops.setdefault(hop, deque(maxlen=200)).append(seconds)
+    for hop, seconds in hops:
+        trace_hop_metric.observe(max(0.0, seconds), hop)
+    if len(trace) > 1:
+        trace_hop_metric.observe(max(0.0, trace[-1][1] - trace[0][1]), 'total')
+    log.info(
+        f'Session trace {record.get("session_id")}: '
+        + ' | '.join(f'{hop} {seconds:.2f}s' for hop, seconds in hops)
+    )
+
+def trace_stats():
+    """Per-hop median, p95 and max (seconds) over the last 200 completed traces."""
+    with trace_stats_lock:
+        snapshot = {hop: sorted(values) for hop, values in trace_hops.items()}
+    return {
+        hop: {
+            'count': len(values),
+            'p50_s': round(values[len(values) // 2], 3),
+            'p95_s': round(values[min(len(values) - 1, int(len(values) * 0.95))], 3),
+            'max_s': round(values[-1], 3),
+        }
+        for hop, values in snapshot.items()
+    }
+
+# ── HTTP request stats ─────────────────────────────────────────────────────────
+HTTP_ROUTES = {'/game_start', '/game_stop', '/process_deck_queue', '/status', '/metrics', '/stats',
+               '/library', '/library/<game>'}
+
+http_stats_lock = threading.Lock()
+http_stats      = {}  # 'METHOD /path' → {'count', 'errors', 'latencies': deque of seconds}
+
+def record_request(method, path, status, seconds):
+    path = path.split('?', 1)[0]
+    if path.startswith('/library/'):
+        path = '/library/<game>'
+    key  = f'{method} {path if path in HTTP_ROUTES else "other"}'
+    with http_stats_lock:
+        stats = http_stats.setdefault(key, {'count': 0, 'errors': 0, 'latencies': deque(maxlen=500)})
+        stats['count'] += 1
+        if status >= 400:
+            stats['errors'] += 1
+        stats['latencies'].append(seconds)
+
+def request_stats():
+    """Per-route request count, error count and latency percentiles (ms) over the last 500 requests."""
+    with http_stats_lock:
+        snapshot = {key: (s['count'], s['errors'], sorted(s['latencies'])) for key, s in http_stats.items()}
+    result = {}
+    for key, (count, errors, latencies) in snapshot.items():
+        result[key] = {
+            'count':  count,
+            'errors': errors,
+            'p50_ms': round(latencies[len(latencies) // 2] * 1000, 2),
+            'p95_ms': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000, 2),
+            'max_ms': round(latencies[-1] * 1000, 2),
+        }
+    return result
+
+def render_metrics():
+    """The /metrics page: the registered metrics plus values read at scrape time."""
+    families = [metric.render() for metric in METRICS]
+    with http_stats_lock:
+        http_counts = sorted((key, s['count'], s['errors']) for key, s in http_stats.items())
+    families.append(format_metric('steam_queue_http_requests_total', 'counter', 'HTTP requests by route',
+                                  [('', {'route': key}, count) for key, count, _ in http_counts]))
+    families.append(format_metric('steam_queue_http_errors_total', 'counter', 'HTTP responses with status >= 400',
+                                  [('', {'route': key}, errors) for key, _, errors in http_counts]))
+    families.append(format_metric('steam_queue_worker_queue_depth', 'gauge', 'Entries waiting per worker shard',
+                                  [('', {'shard': i}, q.qsize()) for i, q in enumerate(work_queues)]))
+    with in_flight_lock:
+        in_flight = len(in_flight_sessions)
+    families.append(format_metric('steam_queue_in_flight_sessions', 'gauge', 'Deck sessions queued or being processed',
+                                  [('', {}, in_flight)]))
+    deck_queue = deck_queue_status()
+    families.append(format_metric('steam_queue_deck_payloads_total', 'counter', 'Deck queue payloads received',
+                                  [('', {'result': 'processed'}, deck_queue['payloads_processed']),
+                                   ('', {'result': 'coalesced'}, deck_queue['payloads_coalesced'])]))
+    influx = influx_writer.status()
+    families.append(format_metric('steam_queue_influxdb_points_total', 'counter', 'InfluxDB points by result',
+                                  [('', {'result': 'written'}, influx['written']),
+                                   ('', {'result': 'dropped'}, influx['dropped'])]))
+    families.append(format_metric('steam_queue_influxdb_write_failures_total', 'counter',
+                                  'InfluxDB batch writes that failed and were retried',
+                                  [('', {}, influx['failures'])]))
+    families.append(format_metric('steam_queue_influxdb_buffered_points', 'gauge',
+                                  'InfluxDB points waiting to be written', [('', {}, influx['buffered'])]))
+    mqtt = mqtt_connection.status()
+    families.append(format_metric('steam_queue_mqtt_publishes_total', 'counter', 'MQTT publishes by result',
+                                  [('', {'result': 'confirmed'}, mqtt['confirmed']),
+                                   ('', {'result': 'unconfirmed'}, mqtt['unconfirmed'])]))
+    families.append(format_metric('steam_queue_mqtt_connected', 'gauge', '1 while the MQTT connection is up',
+                                  [('', {}, int(mqtt['connected']))]))
+    return '\n'.join(families) + '\n'
 
 # ── HTTP request handler ───────────────────────────────────────────────────────
 class RequestHandler(BaseHTTPRequestHandler):
+    # Keep-alive: HA's curl calls and the Deck bridge can reuse the connection.
+    # Every response carries Content-Length, which HTTP/1.1 requires for this.
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out as separate writes; without TCP_NODELAY a
+    # kept-alive connection waits ~40 ms for the client's delayed ACK.
+    disable_nagle_algorithm = True
+    # Idle/stalled connections are dropped after this many seconds (http_timeout)
+    timeout = 10
 
     def log_message(self, format, *args):
         log.info(f'HTTP {format % args}')
 
+    def parse_request(self):
+        self.request_started = time_module.monotonic()
+        return super().parse_request()
+
     def send_json(self, code, data):
         body = json.dumps(data).encode()
         self.send_response(code)
@@ -528,13 +2542,29 @@ class RequestHandler(BaseHTTPRequestHandler):
         self.send_header('Content-Length', len(body))
         self.end_headers()
         self.wfile.write(body)
+        record_request(self.command, self.path, code, time_module.monotonic() - self.request_started)
+
+    def send_text(self, code, text, content_type='text/plain; charset=utf-8'):
+        body = text.encode()
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', len(body))
+        self.end_headers()
+        self.wfile.write(body)
+        record_request(self.command, self.path, code, time_module.monotonic() - self.request_started)
 
     def read_body(self):
         length = int(self.headers.get('Content-Length', 0))
-        return json.loads(self.rfile.read(length)) if length else {}
+        raw    = self.rfile.read(length) if length else b''
+        ctype  = self.headers.get('Content-Type', '').split(';')[0].strip().lower()
+        return decode_payload(raw, PAYLOAD_CONTENT_TYPES.get(ctype, 'json'))
 
     def do_POST(self):
-        data = self.read_body()
+        try:
+            data = self.read_body()
+        except Exception as e:
+            self.send_json(400, {'error': f'Invalid payload: {e}'})
+            return
         if self.path == '/game_start':
             self.handle_game_start(data)
         elif self.path == '/game_stop':
@@ -545,90 +2575,74 @@ class RequestHandler(BaseHTTPRequestHandler):
             self.send_json(404, {'error': 'Not found'})
 
     def do_GET(self):
-        if self.path == '/status':
+        path, _, query = self.path.partition('?')
+        if path == '/status':
             entries = read_queue_file()
+            with in_flight_lock:
+                in_flight = list(in_flight_sessions)
+                stopped   = list(recently_stopped_games.keys())
             self.send_json(200, {
                 'queue':              entries,
-                'memory_queue_size':  memory_queue.qsize(),
-                'in_flight_sessions': list(in_flight_sessions),
-                'recently_stopped':   list(recently_stopped_games.keys())
+                'memory_queue_size':  sum(q.qsize() for q in work_queues),
+                'shard_queue_depths': [q.qsize() for q in work_queues],
+                'in_flight_sessions': in_flight,
+                'recently_stopped':   stopped,
+                'processed_sessions': len(processed_sessions),
+                'deck_queue':         deck_queue_status(),
+                'trace_hops':         trace_stats(),
+                'library_duplicates': dict(library_duplicates),
+                'http':               request_stats(),
+                'mqtt':               mqtt_connection.status(),
+                'influxdb':           influx_writer.status()
             })
+        elif path == '/metrics':
+            self.send_text(200, render_metrics(), 'text/plain; version=0.0.4; charset=utf-8')
+        elif path == '/stats':
+            try:
+                self.send_json(200, query_stats(urllib.parse.parse_qs(query)))
+            except ValueError as e:
+                self.send_json(400, {'error': str(e)})
+        elif path == '/library':
+            fields = [f for value in urllib.parse.parse_qs(query).get('fields', []) for f in value.split(',') if f]
+            self.send_json(200, {'games': project_library(fields)})
+        elif path.startswith('/library/'):
+            game_name = urllib.parse.unquote(path[len('/library/'):])
+            with library_file_lock:
+                key   = find_library_key(game_name)
+                entry = library_games.get(key) if key is not None else None
+                entry = dict(entry) if isinstance(entry, dict) else entry
+            if key is None:
+                self.send_json(404, {'error': f'{game_name} is not in the library'})
+            else:
+                self.send_json(200, {'game': key, 'entry': entry})
         else:
             self.send_json(404, {'error': 'Not found'})
 
-    def handle_deck_queue(self, data):
-        """
-        Receives the full playtime queue payload from the Steam Deck via MQTT.
-
-        Closed sessions are processed unless:
-          - ha_processed=True: HA already recorded via game_stop, just ACK
-          - already in-flight: duplicate, skip
-          - recently stopped via game_stop: safety guard, ACK and skip
-
-        Opened sessions are skipped — handled by game_stop or standby flow.
-        """
-        sessions = data.get('active_sessions', [])
-        if not sessions:
-            self.send_json(200, {'status': 'ok', 'processed': 0, 'skipped': 0})
+    def do_PATCH(self):
+        path = self.path.split('?', 1)[0]
+        if not path.startswith('/library/') or len(path) == len('/library/'):
+            self.send_json(404, {'error': 'Not found'})
             return
+        try:
+            data = self.read_body()
+            validate_library_patch(data)
+        except Exception as e:
+            self.send_json(400, {'error': f'Invalid payload: {e}'})
+            return
+        game_name = urllib.parse.unquote(path[len('/library/'):])
+        # Applied on the game's shard, in order with its sessions
+        entry = {'_type': 'library_patch', 'game_name': game_name, 'patch': data, '_done': threading.Event()}
+        dispatch(entry)
+        if not entry['_done'].wait(self.timeout):
+            self.send_json(503, {'error': 'Timed out waiting for the worker, the change may still be applied'})
+        elif 'result' not in entry:
+            self.send_json(500, {'error': 'Library update failed, see the log'})
+        else:
+            key, updated = entry['result']
+            self.send_json(200, {'status': 'ok', 'game': key, 'entry': updated})
 
-        queued  = 0
-        skipped = 0
-        opened  = 0
-        ha_skip = 0
-
-        for session in sessions:
-            session_id   = session.get('session_id')
-            game_state   = session.get('game_state')
-            game_name    = session.get('name', 'unknown')
-            ha_processed = session.get('ha_processed', False)
-
-            if not session_id:
-                log.warning('Session missing session_id, skipping')
-                skipped += 1
-                continue
-
-            if game_state == 'opened':
-                log.info(f'Deck session still open, skipping: {game_name} [{session_id}]')
-                opened += 1
-                continue
-
-            if game_state != 'closed':
-                log.warning(f'Unknown game_state "{game_state}" for session {session_id}, skipping')
-                skipped += 1
-                continue
-
-            if session.get('end_playtime') is None or session.get('end_time') is None:
-                log.warning(f'Closed session {session_id} missing end data, skipping')
-                skipped += 1
-                continue
-
-            if is_in_flight(session_id):
-                log.info(f'Session {session_id} already in-flight, skipping duplicate')
-                skipped += 1
-                continue
-
-            mark_in_flight(session_id)
-            memory_queue.put({'_type': 'deck_session', 'session': session})
-
-            if ha_processed:
-                log.info(f'Queued ha_processed session for ACK-only: {game_name} [{session_id}]')
-                ha_skip += 1
-            else:
-                log.info(f'Queued deck session for processing: {game_name} [{session_id}]')
-                queued += 1
-
-        log.info(
-            f'Deck queue received: {queued} queued, {ha_skip} ha_processed (ACK only), '
-            f'{skipped} skipped, {opened} still open'
-        )
-        self.send_json(200, {
-            'status':     'ok',
-            'processed':  queued,
-            'ha_skip':    ha_skip,
-            'skipped':    skipped,
-            'still_open': opened
-        })
+    def handle_deck_queue(self, data):
+        self.send_json(200, enqueue_deck_queue(data))
 
     def handle_game_start(self, data):
         required = ['game_name', 'appid', 'game_type', 'start_time']
@@ -650,10 +2664,10 @@ class RequestHandler(BaseHTTPRequestHandler):
         }
 
         append_to_queue_file(entry)
-        memory_queue.put(entry)
+        dispatch(entry)
 
-        log.info(f'Game start received: {data["game_name"]} [{entry_id}]')
-        self.send_json(200, {'status': 'ok', 'entry_id': entry_id})
+        log.info(f'Game start received: {data["game_name"]} [{entry["entry_id"]}]')
+        self.send_json(200, {'status': 'ok', 'entry_id': entry['entry_id']})
 
     def handle_game_stop(self, data):
         """
@@ -675,21 +2689,16 @@ class RequestHandler(BaseHTTPRequestHandler):
         start_time      = data.get('start_time', stop_time)
 
         with queue_file_lock:
-            entries = read_queue_file()
-            matched = None
-            for i, e in enumerate(entries):
-                if (e.get('state') == 'start'
-                        and e.get('game_name', '').lower() == game_name.lower()):
-                    entries[i]['state']          = 'stop'
-                    entries[i]['stop_time']       = stop_time
-                    entries[i]['start_time']      = start_time
-                    entries[i]['properly_closed'] = properly_closed
-                    matched = entries[i]
-                    break
-
+            matched = find_start_entry(game_name)
             if matched:
-                write_queue_file(entries)
-                memory_queue.put(matched)
+                matched['state']           = 'stop'
+                matched['stop_time']       = stop_time
+                matched['start_time']      = start_time
+                matched['properly_closed'] = properly_closed
+                if data.get('deck'):
+                    matched['deck'] = data['deck']
+                update_queue_entry(matched)
+                dispatch(matched)
                 log.info(
                     f'Game stop received: {game_name} | properly_closed={properly_closed} | '
                     f'start={start_time} stop={stop_time}'
@@ -700,7 +2709,7 @@ class RequestHandler(BaseHTTPRequestHandler):
                     f'No matching start entry for stop: {game_name} — '
                     f'creating minimal stop entry'
                 )
-                entry_id = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_nostartmatch"
+                entry_id = unique_entry_id(f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_nostartmatch")
                 fallback_entry = {
                     'entry_id':        entry_id,
                     'game_name':       game_name,
@@ -711,49 +2720,314 @@ class RequestHandler(BaseHTTPRequestHandler):
                     'stop_time':       stop_time,
                     'properly_closed': properly_closed
                 }
-                entries.append(fallback_entry)
-                write_queue_file(entries)
-                memory_queue.put(fallback_entry)
+                if data.get('deck'):
+                    fallback_entry['deck'] = data['deck']
+                update_queue_entry(fallback_entry)
+                dispatch(fallback_entry)
                 self.send_json(200, {'status': 'ok', 'entry_id': entry_id})
 
+# ── Backfill ───────────────────────────────────────────────────────────────────
+class RateLimiter:
+    """Token bucket shared by the backfill workers; rate is in points per second (0 = unlimited)."""
+
+    def __init__(self, rate):
+        self.rate   = rate
+        self.tokens = rate
+        self.last   = time_module.monotonic()
+        self.lock   = threading.Lock()
+
+    def acquire(self, points):
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now         = time_module.monotonic()
+                self.tokens = min(max(self.rate, points), self.tokens + (now - self.last) * self.rate)
+                self.last   = now
+                if self.tokens >= points:
+                    self.tokens -= points
+                    return
+                delay = (points - self.tokens) / self.rate
+            time_module.sleep(delay)
+
+def read_backfill_batches(path, offset, batch_size, since=None):
+    """Yield (end_offset, lines) batches of playtime lines from the session log, starting at byte offset."""
+    lines = []
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while True:
+            raw = f.readline()
+            if not raw:
+                break
+            offset += len(raw)
+            if not raw.endswith(b'\n'):
+                break  # partially written last record
+            try:
+                record = json.loads(raw)
+            except json.JSONDecodeError:
+                log.warning(f'Skipping malformed session log line at byte {offset - len(raw)}')
+                continue
+            if since and record.get('start_time', 0) < since:
+                continue
+            lines.append(playtime_line(record))
+            if len(lines) >= batch_size:
+                yield offset, lines
+                lines = []
+    if lines:
+        yield offset, lines
+
+def run_backfill(args):
+    """
+    Replay the session log into InfluxDB. Batches are posted by args.concurrency
+    workers, each on its own keep-alive connection, within args.rate points/s.
+    The checkpoint records the log offset up to which every batch is written,
+    so an interrupted run resumes there. A dry run reads the whole log and
+    leaves the checkpoint alone.
+    """
+    if not influx_writer.configured():
+        log.error('InfluxDB not configured, nothing to backfill')
+        return 1
+    log_path = session_log_path()
+    if not os.path.exists(log_path):
+        log.error(f'Session log {log_path} not found')
+        return 1
+
+    checkpoint_path = args.checkpoint or log_path + '.backfill'
+    checkpoint      = {'offset': 0, 'points': 0}
+    if not args.restart and not args.dry_run and os.path.exists(checkpoint_path):
+        with open(checkpoint_path, 'r') as f:
+            checkpoint = json.load(f)
+        log.info(f'Resuming backfill at byte {checkpoint["offset"]} ({checkpoint["points"]} points already written)')
+
+    def save_checkpoint():
+        if args.dry_run:
+            return
+        tmp_path = checkpoint_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp_path, checkpoint_path)
+
+    since     = datetime.fromisoformat(args.since).timestamp() if args.since else None
+    total     = os.path.getsize(log_path)
+    limiter   = RateLimiter(args.rate)
+    local     = threading.local()
+    started   = time_module.monotonic()
+    written   = 0
+    last_note = 0
+
+    def post_batch(lines):
+        if not hasattr(local, 'writer'):
+            local.writer = InfluxWriter()
+        limiter.acquire(len(lines))
+        body = ''.join(line + '\n' for line in lines)
+        for attempt in range(args.retries + 1):
+            result = 'ok' if args.dry_run else local.writer.post(body)
+            if result != 'retry':
+                return result
+            time_module.sleep(min(2 ** attempt, 60))
+        raise RuntimeError(f'InfluxDB write failed after {args.retries} retries: {local.writer.stats["last_error"]}')
+
+    # Batches finish out of order; the checkpoint only moves past a batch once
+    # every batch before it has been written.
+    pending  = {}  # future → (seq, end_offset, points)
+    finished = {}  # seq → (end_offset, points)
+    next_seq = 0
+    done_seq = 0
+    batches  = read_backfill_batches(log_path, checkpoint['offset'], args.batch_size, since)
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        try:
+            while True:
+                while len(pending) < args.concurrency * 2:
+                    batch = next(batches, None)
+                    if batch is None:
+                        break
+                    end_offset, lines = batch
+                    pending[pool.submit(post_batch, lines)] = (next_seq, end_offset, len(lines))
+                    next_seq += 1
+                if not pending:
+                    break
+                completed, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in completed:
+                    seq, end_offset, points = pending.pop(future)
+                    if future.result() == 'rejected':
+                        log.error(f'Batch ending at byte {end_offset} rejected by InfluxDB, skipped')
+                    finished[seq] = (end_offset, points)
+                while done_seq in finished:
+                    end_offset, points = finished.pop(done_seq)
+                    checkpoint['offset'] = end_offset
+                    checkpoint['points'] += points
+                    written  += points
+                    done_seq += 1
+                save_checkpoint()
+                if time_module.monotonic() - last_note >= args.progress_interval:
+                    last_note = time_module.monotonic()
+                    elapsed   = last_note - started
+                    log.info(
+                        f'Backfill: {checkpoint["offset"] * 100 // max(total, 1)}% '
+                        f'({checkpoint["points"]} points, {written / max(elapsed, 0.001):.0f} points/s)'
+                    )
+        except (Exception, KeyboardInterrupt) as e:
+            for future in pending:
+                future.cancel()
+            save_checkpoint()
+            log.error(f'Backfill stopped at byte {checkpoint["offset"]}: {e!r} — run it again to resume')
+            return 1
+
+    elapsed = time_module.monotonic() - started
+    log.info(f'Backfill complete: {written} points in {elapsed:.1f}s ({checkpoint["points"]} in total)')
+    if not args.dry_run and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    return 0
+
+def run_rollup_rebuild(args):
+    """
+    Rewrite the playtime_daily and playtime_monthly points from the session
+    log, for history from before the rollup measurements existed or after
+    dropping them. The points replace the existing ones, so it is safe to run
+    again or while the processor is running.
+    """
+    if not influx_writer.configured():
+        log.error('InfluxDB not configured, nothing to rebuild')
+        return 1
+    if not os.path.exists(session_log_path()):
+        log.error(f'Session log {session_log_path()} not found')
+        return 1
+
+    rebuild_stats()
+    since = datetime.fromisoformat(args.since) if args.since else None
+    lines = []
+    for period, (_, key_format) in ROLLUP_MEASUREMENTS.items():
+        first_key = since.strftime(key_format) if since else ''
+        for key, bucket in sorted(stats[period].items()):
+            if key < first_key:
+                continue
+            for game, entry in bucket['games'].items():
+                game_type = stats['games'][game].get('game_type', 'unknown')
+                lines.append(rollup_line(period, key, game, game_type, entry))
+
+    limiter = RateLimiter(args.rate)
+    writer  = InfluxWriter()
+    started = time_module.monotonic()
+    for offset in range(0, len(lines), args.batch_size):
+        batch = lines[offset:offset + args.batch_size]
+        limiter.acquire(len(batch))
+        body = ''.join(line + '\n' for line in batch)
+        for attempt in range(args.retries + 1):
+            result = 'ok' if args.dry_run else writer.post(body)
+            if result != 'retry':
+                break
+            time_module.sleep(min(2 ** attempt, 60))
+        else:
+            log.error(f'InfluxDB write failed after {args.retries} retries: {writer.stats["last_error"]} — run it again')
+            return 1
+        if result == 'rejected':
+            log.error(f'Batch of {len(batch)} rollup points rejected by InfluxDB, skipped')
+        log.info(f'Rollup rebuild: {offset + len(batch)}/{len(lines)} points')
+
+    log.info(f'Rollup rebuild complete: {len(lines)} points in {time_module.monotonic() - started:.1f}s')
+    return 0
+
 # ── Startup ────────────────────────────────────────────────────────────────────
 def recover_unprocessed_entries():
+    """Replay the queue journal and requeue the stop entries that were not processed yet."""
+    open_queue_journal()
     entries      = read_queue_file()
-    stop_entries = [e for e in entries if e.get('state') == 'stop']
+    stop_entries = []
+    for entry in entries:
+        if entry.get('state') != 'stop':
+            continue
+        if processed_outcome(entry.get('entry_id')) is not None:
+            # applied before a crash, but the journal removal had not happened yet
+            remove_from_queue_file(entry['entry_id'])
+            continue
+        stop_entries.append(entry)
     if stop_entries:
-        log.info(f'Recovering {len(stop_entries)} unprocessed stop entries from queue file')
+        log.info(f'Recovering {len(stop_entries)} unprocessed stop entries from the queue journal')
         for entry in stop_entries:
-            memory_queue.put(entry)
+            dispatch(entry)
     start_entries = [e for e in entries if e.get('state') == 'start']
     if start_entries:
         log.info(f'{len(start_entries)} unfinished start entries found (games open at shutdown)')
 
+def handle_sigterm(signum, frame):
+    raise KeyboardInterrupt
+
 def main():
     load_config()
 
     os.makedirs(os.path.dirname(config['queue_file']), exist_ok=True)
 
-    if not os.path.exists(config['queue_file']):
-        write_queue_file([])
-        log.info('Created empty queue file')
-
+    open_processed_sessions()
+    load_stats()
+    replay_session_log()
+    start_workers()
     recover_unprocessed_entries()
-
-    worker_thread = threading.Thread(target=worker, daemon=True)
-    worker_thread.start()
-
-    class ReusableHTTPServer(HTTPServer):
+    threading.Thread(target=queue_compactor, daemon=True).start()
+    with library_file_lock:
+        load_library()  # logs near-duplicate game names once at startup
+    if config.get('mqtt_subscribe'):
+        for topic in DECK_QUEUE_TOPICS:
+            mqtt_connection.subscribe(topic, handle_deck_queue_message)
+    mqtt_connection.subscribe(TRACE_TOPIC, handle_trace_message)
+    mqtt_connection.start()
+    influx_writer.start()
+    publish_capabilities()
+
+    class ReusableHTTPServer(ThreadingHTTPServer):
         allow_reuse_address = True
+        daemon_threads      = True
+
+    # Requests are served concurrently; all mutations still go through the
+    # per-game ordered worker shards.
+    RequestHandler.timeout = config.get('http_timeout', 10)
 
     port   = config.get('port', 8098)
     server = ReusableHTTPServer(('127.0.0.1', port), RequestHandler)
     log.info(f'Steam queue processor listening on http://127.0.0.1:{port}')
 
+    # HA restarts stop the processor with SIGTERM — take the same shutdown path
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
     try:
         server.serve_forever()
     except KeyboardInterrupt:
         log.info('Shutting down')
         server.shutdown()
+    finally:
+        stop_workers(config.get('shutdown_timeout', 10))
+        flush_library()
+        influx_writer.stop()
+        mqtt_connection.stop()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Steam Deck queue processor')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('serve', help='run the processor service (default)')
+    backfill = commands.add_parser('backfill', help='replay the session log into InfluxDB')
+    backfill.add_argument('--batch-size', type=int, default=5000, help='points per write request')
+    backfill.add_argument('--concurrency', type=int, default=2, help='parallel write requests')
+    backfill.add_argument('--rate', type=float, default=0, help='max points per second (0 = unlimited)')
+    backfill.add_argument('--since', help='only sessions starting at or after this ISO date')
+    backfill.add_argument('--retries', type=int, default=5, help='retries per batch before stopping')
+    backfill.add_argument('--checkpoint', help='checkpoint file (default: <session log>.backfill)')
+    backfill.add_argument('--restart', action='store_true', help='ignore the checkpoint and start over')
+    backfill.add_argument('--progress-interval', type=float, default=5, help='seconds between progress lines')
+    backfill.add_argument('--dry-run', action='store_true', help='generate the points without writing them')
+    rollups = commands.add_parser('rebuild-rollups',
+                                  help='rewrite playtime_daily and playtime_monthly from the session log')
+    rollups.add_argument('--batch-size', type=int, default=5000, help='points per write request')
+    rollups.add_argument('--rate', type=float, default=0, help='max points per second (0 = unlimited)')
+    rollups.add_argument('--since', help='only days and months from this ISO date on')
+    rollups.add_argument('--retries', type=int, default=5, help='retries per batch before stopping')
+    rollups.add_argument('--dry-run', action='store_true', help='generate the points without writing them')
+    return parser.parse_args(argv)
 
 if __name__ == '__main__':
+    args = parse_args()
+    if args.command == 'backfill':
+        load_config()
+        exit(run_backfill(args))
+    if args.command == 'rebuild-rollups':
+        load_config()
+        exit(run_rollup_rebuild(args))
     main()
@@ -10,11 +10,30 @@ import time
 import ssl
 import json
 import math
+import base64
+import copy
+import fcntl
+import queue
+import select
+import signal
+import socket
+import threading
 import requests
 import psutil
 import vdf
+from array import array
 from urllib.parse import quote
 
+# Optional binary payload codecs (see PAYLOAD_FORMAT)
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
 # ===========================
 # Configuration
 # ===========================
@@ -29,6 +48,12 @@ TRACE_LOG_PATH   = "/home/deck/scripts/game_trace.log"
 STEAM_APPS_PATH  = "/home/deck/.steam/steam/steamapps"
 QUEUE_PATH       = "/home/deck/scripts/playtime_queue.json"
 LAST_RUN_PATH    = "/home/deck/scripts/last_run.json"
+TITLE_INDEX_PATH = "/home/deck/scripts/title_index.json"
+TELEMETRY_PATH   = "/home/deck/scripts/session_telemetry.json"
+REJECTED_PATH    = "/home/deck/scripts/rejected_sessions.json"
+LOCK_PATH        = "/home/deck/scripts/steamdeck_mqtt.lock"
+CONTROL_SOCKET   = "/home/deck/scripts/steamdeck_mqtt.sock"
+STATUS_SOCKET    = "/home/deck/scripts/steamdeck_status.sock"
 STEAM_USER_PATH  = os.path.expanduser("~/.local/share/Steam/userdata")
 
 
@@ -36,6 +61,70 @@ STEAM_USER_PATH  = os.path.expanduser("~/.local/share/Steam/userdata")
 # the Deck was assumed to be in standby.
 GAP_THRESHOLD_SECONDS = 30
 
+# Single instance: the first invocation holds LOCK_PATH and serves requests
+# from later invocations (timer tick, boot/resume, offline) on CONTROL_SOCKET.
+# Requests arriving within COALESCE_SECONDS of each other are merged into one
+# run. In --daemon mode the instance keeps running and ticks by itself.
+UPDATE_INTERVAL_SECONDS = 20
+COALESCE_SECONDS        = 0.5
+HANDOFF_TIMEOUT_SECONDS = 15
+CACHE_REFRESH_SECONDS   = 600
+
+# Read-only status API served by the --daemon instance on STATUS_SOCKET, so
+# other tools (Decky plugins, shell prompts) share its scan instead of running
+# their own. Sends to subscribers never block: a subscriber whose socket
+# buffer is full (not reading) is dropped.
+STATUS_MAX_SUBSCRIBERS = 16
+
+# Backlog sync: closed sessions are published SYNC_BATCH_SIZE at a time and
+# the next batch only goes out once HA has ACKed the previous one. A run waits
+# at most SYNC_ACK_TIMEOUT seconds per batch; unACKed batches are resent on
+# the next run.
+SYNC_BATCH_SIZE          = 10
+SYNC_ACK_TIMEOUT         = 5
+SYNC_MAX_BATCHES_PER_RUN = 20
+
+# Payload format for the queue processor: "json", "msgpack" or "cbor".
+# The retained steamdeck/playtime/queue topic that HA templates read is always
+# JSON. A binary format is only used once the queue processor advertises it on
+# steamdeck/playtime/capabilities; closed sessions then travel on
+# steamdeck/playtime/queue_packed and the JSON topic carries only open sessions.
+# msgpack needs `pip install msgpack`, cbor needs `pip install cbor2`.
+PAYLOAD_FORMAT = "json"
+PAYLOAD_SCHEMA = 1
+
+# Sent with every queue payload so the queue processor can keep per-Deck
+# playtime totals. Give each Deck its own id if you have more than one.
+DECK_ID = socket.gethostname()
+
+# Learned exe path → title index. Least recently seen entries are evicted
+# once the index grows past this size; manual overrides are never evicted.
+TITLE_INDEX_MAX_ENTRIES   = 500
+TITLE_INDEX_TOUCH_SECONDS = 3600
+
+# Per-session performance telemetry. A sample is taken at most once every
+# TELEMETRY_SAMPLE_SECONDS while a session is open; only the most recent
+# TELEMETRY_RING_SIZE samples per metric are kept for the p95 calculation,
+# mean/max/energy are exact over the whole session. The in-progress state is
+# written to disk at most once every TELEMETRY_SAVE_SECONDS and at exit.
+TELEMETRY_ENABLED        = True
+TELEMETRY_SAMPLE_SECONDS = 20
+TELEMETRY_RING_SIZE      = 720
+TELEMETRY_SAVE_SECONDS   = 300
+
+# MangoHud frametime logs. Point this at MangoHud's output_folder; logs that
+# were started during a session are summarized when the session closes.
+MANGOHUD_ENABLED   = True
+MANGOHUD_LOG_DIRS  = [os.path.expanduser("~/mangologs")]
+FRAMETIME_ACCURACY = 0.01
+
+# Session tracing. Every closed session carries a "trace" of [stage, unix time]
+# pairs: closed and published are added here, the queue processor adds its
+# stages and returns the trace in the ACK, and ack_received and removed are
+# added when the ACK is applied. The completed trace is logged and published
+# to steamdeck/playtime/trace, where the queue processor aggregates it.
+TRACE_ENABLED = True
+
 os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
 
 # ===========================
@@ -284,6 +373,13 @@ def close_session(q, session, ha_processed, end_time_override=None):
     session["ha_processed"] = ha_processed
     session["end_time"]     = now
     session["end_playtime"] = playtime
+    add_trace_stage(session, "closed")
+    telemetry = finish_session_telemetry(session)
+    if telemetry:
+        session["telemetry"] = telemetry
+    frametimes = collect_session_frametimes(session)
+    if frametimes:
+        session["frametimes"] = frametimes
     save_queue(q)
     print_log(
         f"Queue: closed session '{session['name']}' "
@@ -292,16 +388,16 @@ def close_session(q, session, ha_processed, end_time_override=None):
     )
 
 def remove_session(q, session_id):
-    """Remove a session from the queue by session_id."""
-    before = len(q["active_sessions"])
-    q["active_sessions"] = [
-        s for s in q["active_sessions"]
-        if s["session_id"] != session_id
-    ]
-    after = len(q["active_sessions"])
-    if before != after:
+    """Remove a session from the queue by session_id. Returns the removed session, or None."""
+    removed = next((s for s in q["active_sessions"] if s["session_id"] == session_id), None)
+    if removed is not None:
+        q["active_sessions"] = [
+            s for s in q["active_sessions"]
+            if s["session_id"] != session_id
+        ]
         save_queue(q)
         print_log(f"Queue: removed session {session_id}")
+    return removed
 
 def update_queue_for_game(q, detected_game, detected_appid, last_run, online):
     """
@@ -463,9 +559,15 @@ def build_shortcuts_cache():
     print_log(f"Shortcuts cache: {len(combined)} entries")
     return combined
 
-# Build caches once at startup
-ACF_CACHE       = build_acf_cache()
-SHORTCUTS_CACHE = build_shortcuts_cache()
+# Built by refresh_caches() once the script owns the instance lock, so an
+# invocation that only hands its request to a running instance skips the scan
+ACF_CACHE       = {}
+SHORTCUTS_CACHE = {}
+
+def refresh_caches():
+    global ACF_CACHE, SHORTCUTS_CACHE
+    ACF_CACHE       = build_acf_cache()
+    SHORTCUTS_CACHE = build_shortcuts_cache()
 
 EMULATOR_SUFFIXES = re.compile(
     r'\s*\((?:Ryujinx|Yuzu|RPCS3|PCSX2|Dolphin|Citra|mGBA|melonDS|DuckStation|'
@@ -674,13 +776,218 @@ def resolve_game_title(raw_name, appid=None):
 
     return final_name
 
+# ===========================
+# Title Index (exe path → title)
+# ===========================
+
+_title_index         = None
+_title_index_mtime   = None
+_title_index_changes = {}  # key → learned entry, or None if evicted, since the last save
+
+def _title_index_file_mtime():
+    try:
+        return os.stat(TITLE_INDEX_PATH).st_mtime_ns
+    except OSError:
+        return None
+
+def normalize_exe_path(path):
+    """Normalize an executable path for use as a title index key."""
+    path = re.sub(r'/+', '/', path.replace("\\", "/"))
+    return os.path.normpath(path).lower()
+
+def title_index_key(exe_path, appid=None):
+    norm = normalize_exe_path(exe_path)
+    return f"{appid}|{norm}" if appid else norm
+
+def _normalize_index_key(key):
+    appid, sep, path = key.rpartition("|")
+    return title_index_key(path, appid) if sep else title_index_key(key)
+
+def load_title_index():
+    """
+    Load title_index.json, again whenever the file changed on disk since it was
+    last read or written (e.g. overrides added by hand while the daemon runs).
+
+    "entries" holds titles learned from earlier detections, keyed by normalized
+    exe path (prefixed with "<appid>|" when the appid is known).
+    "overrides" holds manual entries in the same key format, either a title
+    string or a dict with "title" and optional "game_type". Override keys are
+    normalized on load so they can be written with any casing or slashes.
+
+    On a reload the file is taken as it is, and the learned entries changed in
+    memory since the last save are applied on top (evicted ones stay out).
+    """
+    global _title_index, _title_index_mtime
+    mtime = _title_index_file_mtime()
+    if _title_index is not None and mtime == _title_index_mtime:
+        return _title_index
+    data = {}
+    if mtime is not None:
+        try:
+            with open(TITLE_INDEX_PATH, "r") as f:
+                content = f.read().strip()
+                if content:
+                    data = json.loads(content)
+        except Exception as e:
+            print_log(f"Title index read error: {e}")
+    entries   = data.get("entries")   if isinstance(data.get("entries"), dict)   else {}
+    overrides = data.get("overrides") if isinstance(data.get("overrides"), dict) else {}
+    overrides = {_normalize_index_key(k): v for k, v in overrides.items()}
+    _title_index_mtime = mtime
+    if _title_index is None:
+        _title_index = {"entries": entries, "overrides": overrides}
+        return _title_index
+
+    for key, entry in _title_index_changes.items():
+        if entry is None:
+            entries.pop(key, None)
+        else:
+            entries[key] = entry
+    # Update in place: callers may hold the dict from an earlier call
+    _title_index["entries"]   = entries
+    _title_index["overrides"] = overrides
+    return _title_index
+
+def save_title_index(index):
+    """Write the index, first merging changes made to the file since it was read."""
+    global _title_index_mtime
+    load_title_index()  # merges into index, which is the loaded dict
+    tmp = TITLE_INDEX_PATH + ".tmp"
+    try:
+        with open(tmp, "w") as f:
+            json.dump(index, f, indent=2)
+        os.replace(tmp, TITLE_INDEX_PATH)
+        _title_index_mtime = _title_index_file_mtime()
+        _title_index_changes.clear()
+    except Exception as e:
+        print_log(f"Title index save error: {e}")
+
+def lookup_title_index(exe_path, appid=None):
+    """
+    Return {"title", "game_type"} for a previously resolved exe path, or None.
+    Overrides win over learned entries; an appid-specific key wins over the
+    bare path key.
+    """
+    index = load_title_index()
+    keys  = [title_index_key(exe_path, appid)]
+    if appid:
+        keys.append(title_index_key(exe_path))
+
+    for key in keys:
+        override = index["overrides"].get(key)
+        if isinstance(override, str) and override:
+            return {"title": override, "game_type": None}
+        if isinstance(override, dict) and override.get("title"):
+            return override
+
+    for key in keys:
+        entry = index["entries"].get(key)
+        if entry and entry.get("title"):
+            now = int(time.time())
+            if now - entry.get("last_seen", 0) > TITLE_INDEX_TOUCH_SECONDS:
+                entry["last_seen"] = now
+                _title_index_changes[key] = entry
+                save_title_index(index)
+            return entry
+    return None
+
+def remember_title(exe_path, appid, title, game_type):
+    """Store a resolved title for an exe path, evicting the least recently seen entries."""
+    index   = load_title_index()
+    entries = index["entries"]
+    key     = title_index_key(exe_path, appid)
+    current = entries.get(key)
+    if current and current.get("title") == title and current.get("game_type") == game_type:
+        return
+
+    entries[key] = _title_index_changes[key] = {
+        "title":     title,
+        "appid":     appid or "",
+        "game_type": game_type,
+        "last_seen": int(time.time()),
+    }
+    excess = len(entries) - TITLE_INDEX_MAX_ENTRIES
+    if excess > 0:
+        for stale in sorted(entries, key=lambda k: entries[k].get("last_seen", 0))[:excess]:
+            del entries[stale]
+            _title_index_changes[stale] = None
+    save_title_index(index)
+    print_log(f"Title index: '{key}' → {title}")
+
 # ===========================
 # Game Detection
 # ===========================
 
+PROCESS_ATTRS = ['pid', 'cmdline', 'cpu_percent', 'create_time']
+
+# Process objects reused between scans so cpu_percent has a previous sample
+_tree_processes = {}
+# Reaper roots found by the last scan, reused by telemetry samples
+_game_roots     = []
+
+def find_game_roots():
+    """
+    Locate Steam's `reaper ... AppId=` launcher processes.
+
+    Only process names are read for the full process list, which is far cheaper
+    than reading every cmdline. Returns (roots, gamescope_running).
+    """
+    global _game_roots
+    roots     = []
+    gamescope = False
+    for proc in psutil.process_iter(['name']):
+        name = proc.info.get('name') or ""
+        if "gamescope" in name:
+            gamescope = True
+        elif name == "reaper":
+            try:
+                if re.search(r'AppId=\d+', " ".join(proc.cmdline()), re.IGNORECASE):
+                    roots.append(proc)
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue
+    _game_roots = roots
+    return roots, gamescope
+
+def iter_game_processes(roots):
+    """
+    Yield process info dicts for detection.
+
+    With reaper roots present only the roots and their descendants are scanned,
+    so the cost follows the size of the game's process tree. Without roots
+    (Desktop Mode, standalone emulators) every process on the system is scanned.
+    """
+    if not roots:
+        for proc in psutil.process_iter(PROCESS_ATTRS):
+            yield proc.info
+        return
+
+    seen = set()
+    for root in roots:
+        try:
+            tree = [root] + root.children(recursive=True)
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            continue
+        for proc in tree:
+            if proc.pid in seen:
+                continue
+            seen.add(proc.pid)
+            cached = _tree_processes.get(proc.pid)
+            if cached is not None and cached == proc:
+                proc = cached
+            else:
+                _tree_processes[proc.pid] = proc
+            try:
+                yield proc.as_dict(attrs=PROCESS_ATTRS)
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue
+
+    for pid in [p for p in _tree_processes if p not in seen]:
+        del _tree_processes[pid]
+
 def detect_game():
     possible_matches = []
-    is_desktop_mode = not get_output("ps -A | grep gamescope")
+    roots, gamescope_running = find_game_roots()
+    is_desktop_mode = not gamescope_running
 
     ignore_list = [
         "steam.exe", "services.exe", "explorer.exe", "winedevice.exe",
@@ -709,15 +1016,15 @@ def detect_game():
         "lib64", "proc", "sys", "dev", "tmp", "var", "etc",
     }
 
-    for proc in psutil.process_iter(['pid', 'cmdline', 'cpu_percent', 'create_time']):
+    for info in iter_game_processes(roots):
         try:
-            cmdline = proc.info.get('cmdline')
+            cmdline = info.get('cmdline')
             if not cmdline:
                 continue
 
             full_cmd       = " ".join(cmdline)
             full_cmd_lower = full_cmd.lower()
-            pid            = proc.info.get('pid')
+            pid            = info.get('pid')
 
             reaper_match = re.search(r'reaper.*AppId=(\d+)', full_cmd, re.IGNORECASE)
             if reaper_match:
@@ -741,8 +1048,8 @@ def detect_game():
                             'appid':     appid,
                             'game_type': "Non-Steam",
                             'resolved':  True,
-                            'cpu':       proc.info['cpu_percent'],
-                            'time':      proc.info['create_time'],
+                            'cpu':       info['cpu_percent'],
+                            'time':      info['create_time'],
                         })
                 continue
 
@@ -759,8 +1066,8 @@ def detect_game():
                         'appid':     None,
                         'game_type': "ExoDOS",
                         'resolved':  False,
-                        'cpu':       proc.info['cpu_percent'],
-                        'time':      proc.info['create_time'],
+                        'cpu':       info['cpu_percent'],
+                        'time':      info['create_time'],
                     })
                 continue
 
@@ -791,8 +1098,8 @@ def detect_game():
                     'appid':     appid,
                     'game_type': "Steam Native",
                     'resolved':  True,
-                    'cpu':       proc.info['cpu_percent'],
-                    'time':      proc.info['create_time'],
+                    'cpu':       info['cpu_percent'],
+                    'time':      info['create_time'],
                 })
                 continue
 
@@ -813,8 +1120,8 @@ def detect_game():
                     'appid':     appid,
                     'game_type': "Non-Steam",
                     'resolved':  True,
-                    'cpu':       proc.info['cpu_percent'],
-                    'time':      proc.info['create_time'],
+                    'cpu':       info['cpu_percent'],
+                    'time':      info['create_time'],
                 })
                 continue
 
@@ -832,8 +1139,8 @@ def detect_game():
                     'appid':     None,
                     'game_type': "ROM",
                     'resolved':  False,
-                    'cpu':       proc.info['cpu_percent'],
-                    'time':      proc.info['create_time'],
+                    'cpu':       info['cpu_percent'],
+                    'time':      info['create_time'],
                 })
                 continue
 
@@ -850,7 +1157,21 @@ def detect_game():
                         full_cmd
                     )
                     if path_match:
-                        full_path   = path_match.group(0).replace("\\", "/")
+                        full_path = path_match.group(0).replace("\\", "/")
+
+                        # Learned or overridden title for this exe — skip the folder heuristics
+                        index_hit = lookup_title_index(full_path, appid)
+                        if index_hit:
+                            possible_matches.append({
+                                'title':     index_hit['title'],
+                                'appid':     appid,
+                                'game_type': index_hit.get('game_type') or "Non-Steam",
+                                'resolved':  True,
+                                'cpu':       info['cpu_percent'],
+                                'time':      info['create_time'],
+                            })
+                            continue
+
                         parts       = [p for p in full_path.split("/") if p]
                         parts_lower = [p.lower() for p in parts]
                         game_folder = None
@@ -888,8 +1209,9 @@ def detect_game():
                                 'appid':     appid,
                                 'game_type': game_type,
                                 'resolved':  bool(acf_hit),
-                                'cpu':       proc.info['cpu_percent'],
-                                'time':      proc.info['create_time'],
+                                'exe_path':  full_path,
+                                'cpu':       info['cpu_percent'],
+                                'time':      info['create_time'],
                             })
 
         except (psutil.NoSuchProcess, psutil.AccessDenied):
@@ -907,11 +1229,450 @@ def detect_game():
     write_trace(best['title'], best['game_type'], best['cpu'])
 
     if best.get('resolved'):
-        return best['title'], best.get('appid'), best['game_type']
+        resolved_title = best['title']
+    else:
+        resolved_title = resolve_game_title(best['title'], appid=best.get('appid'))
+
+    if best.get('exe_path'):
+        remember_title(best['exe_path'], best.get('appid'), resolved_title, best['game_type'])
 
-    resolved_title = resolve_game_title(best['title'], appid=best.get('appid'))
     return resolved_title, best.get('appid'), best['game_type']
 
+# ===========================
+# Session Telemetry
+# ===========================
+
+TELEMETRY_METRICS = ("cpu_percent", "power_w", "gpu_busy", "cpu_temp_c", "gpu_temp_c")
+
+class MetricRing:
+    """
+    Fixed-size float ring buffer for one telemetry metric.
+
+    Samples live in a preallocated array('f') so memory stays constant for
+    multi-hour sessions. count/total/peak are kept for every sample ever added,
+    the ring itself only feeds the percentile.
+    """
+
+    def __init__(self, size=TELEMETRY_RING_SIZE):
+        self.values = array("f", bytes(4 * size))
+        self.size   = size
+        self.pos    = 0
+        self.filled = 0
+        self.count  = 0
+        self.total  = 0.0
+        self.peak   = None
+
+    def add(self, value):
+        self.values[self.pos] = value
+        self.pos    = (self.pos + 1) % self.size
+        self.filled = min(self.filled + 1, self.size)
+        self.count += 1
+        self.total += value
+        self.peak   = value if self.peak is None else max(self.peak, value)
+
+    def percentile(self, pct):
+        if not self.filled:
+            return None
+        ordered = sorted(self.values[:self.filled])
+        idx     = min(len(ordered) - 1, max(0, math.ceil(pct / 100 * len(ordered)) - 1))
+        return ordered[idx]
+
+    def summary(self):
+        if not self.count:
+            return None
+        return {
+            "mean": round(self.total / self.count, 2),
+            "p95":  round(self.percentile(95), 2),
+            "max":  round(self.peak, 2),
+        }
+
+    def to_dict(self):
+        return {
+            "values": base64.b64encode(self.values.tobytes()).decode("ascii"),
+            "pos":    self.pos,
+            "filled": self.filled,
+            "count":  self.count,
+            "total":  self.total,
+            "peak":   self.peak,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        ring = cls()
+        try:
+            values = array("f")
+            values.frombytes(base64.b64decode(data["values"]))
+            if len(values) == ring.size:
+                ring.values = values
+                ring.pos    = int(data["pos"]) % ring.size
+                ring.filled = min(int(data["filled"]), ring.size)
+            ring.count = int(data["count"])
+            ring.total = float(data["total"])
+            ring.peak  = data["peak"]
+        except Exception:
+            pass
+        return ring
+
+def _read_sysfs_number(path):
+    try:
+        with open(path, "r") as f:
+            return float(f.read().strip())
+    except Exception:
+        return None
+
+def read_battery_power_w():
+    """Battery power draw in watts from /sys/class/power_supply, or None."""
+    for supply in glob.glob("/sys/class/power_supply/*"):
+        try:
+            with open(os.path.join(supply, "type"), "r") as f:
+                if f.read().strip() != "Battery":
+                    continue
+        except Exception:
+            continue
+        power = _read_sysfs_number(os.path.join(supply, "power_now"))
+        if power is not None:
+            return power / 1_000_000
+        current = _read_sysfs_number(os.path.join(supply, "current_now"))
+        voltage = _read_sysfs_number(os.path.join(supply, "voltage_now"))
+        if current is not None and voltage is not None:
+            return current * voltage / 1_000_000_000_000
+    return None
+
+def read_gpu_busy_percent():
+    for path in glob.glob("/sys/class/drm/card*/device/gpu_busy_percent"):
+        value = _read_sysfs_number(path)
+        if value is not None:
+            return value
+    return None
+
+def read_hwmon_temps():
+    """Return (cpu_temp_c, gpu_temp_c) from hwmon, None where unavailable."""
+    cpu_temp = gpu_temp = None
+    for hwmon in glob.glob("/sys/class/hwmon/hwmon*"):
+        try:
+            with open(os.path.join(hwmon, "name"), "r") as f:
+                name = f.read().strip()
+        except Exception:
+            continue
+        temp = _read_sysfs_number(os.path.join(hwmon, "temp1_input"))
+        if temp is None:
+            continue
+        temp /= 1000
+        if name == "amdgpu":
+            gpu_temp = temp
+        elif name in ("k10temp", "acpitz") and cpu_temp is None:
+            cpu_temp = temp
+    return cpu_temp, gpu_temp
+
+def read_game_cpu_seconds():
+    """
+    Total user+system CPU seconds of every process under the reaper roots of
+    the last game detection scan, without scanning the process list again.
+    """
+    roots = [root for root in _game_roots if root.is_running()]
+    if not roots:
+        return None
+    total = 0.0
+    seen  = set()
+    for root in roots:
+        try:
+            tree = [root] + root.children(recursive=True)
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            continue
+        for proc in tree:
+            if proc.pid in seen:
+                continue
+            seen.add(proc.pid)
+            try:
+                times  = proc.cpu_times()
+                total += times.user + times.system
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue
+    return total
+
+_telemetry_state   = None
+_telemetry_saved   = 0      # when the state was last written to TELEMETRY_PATH
+_telemetry_unsaved = False  # samples taken since then
+
+def load_telemetry_state(session_id):
+    """Return the telemetry state for session_id, starting fresh for a new session."""
+    global _telemetry_state
+    if _telemetry_state is None and os.path.exists(TELEMETRY_PATH):
+        try:
+            with open(TELEMETRY_PATH, "r") as f:
+                _telemetry_state = json.load(f)
+        except Exception as e:
+            print_log(f"Telemetry load error: {e}")
+    if not _telemetry_state or _telemetry_state.get("session_id") != session_id:
+        _telemetry_state = {
+            "session_id":  session_id,
+            "last_sample": None,
+            "cpu_seconds": None,
+            "power_w":     None,
+            "energy_wh":   0.0,
+            "metrics":     {},
+        }
+    return _telemetry_state
+
+def save_telemetry_state(force=False):
+    """
+    Write unsaved telemetry samples, at most once every TELEMETRY_SAVE_SECONDS
+    unless forced (at exit), instead of rewriting the ring buffers every sample.
+    """
+    global _telemetry_saved, _telemetry_unsaved
+    now = time.time()
+    if _telemetry_state is None or not _telemetry_unsaved:
+        return
+    if not force and now - _telemetry_saved < TELEMETRY_SAVE_SECONDS:
+        return
+    tmp = TELEMETRY_PATH + ".tmp"
+    try:
+        with open(tmp, "w") as f:
+            json.dump(_telemetry_state, f)
+        os.replace(tmp, TELEMETRY_PATH)
+        _telemetry_saved   = now
+        _telemetry_unsaved = False
+    except Exception as e:
+        print_log(f"Telemetry save error: {e}")
+
+def sample_session_telemetry(session, now=None):
+    """
+    Take one telemetry sample for the open session, at most once every
+    TELEMETRY_SAMPLE_SECONDS. Energy is integrated from battery power with the
+    trapezoid rule; intervals longer than three sample periods (standby, missed
+    runs) are not integrated.
+    """
+    global _telemetry_unsaved
+    if not TELEMETRY_ENABLED or not session:
+        return
+    now   = now if now is not None else time.time()
+    state = load_telemetry_state(session["session_id"])
+    last  = state.get("last_sample")
+    if last is not None and now - last < TELEMETRY_SAMPLE_SECONDS:
+        return
+
+    rings  = {name: MetricRing.from_dict(data) for name, data in state["metrics"].items()}
+    latest = {}
+    def add(name, value):
+        if value is not None:
+            rings.setdefault(name, MetricRing()).add(value)
+            latest[name] = round(value, 2)
+
+    elapsed    = (now - last) if last is not None else None
+    contiguous = elapsed is not None and elapsed <= TELEMETRY_SAMPLE_SECONDS * 3
+
+    cpu_seconds = read_game_cpu_seconds()
+    prev_cpu    = state.get("cpu_seconds")
+    if contiguous and cpu_seconds is not None and prev_cpu is not None and cpu_seconds >= prev_cpu:
+        add("cpu_percent", (cpu_seconds - prev_cpu) / elapsed * 100)
+
+    power      = read_battery_power_w()
+    prev_power = state.get("power_w")
+    add("power_w", power)
+    if contiguous and power is not None and prev_power is not None:
+        state["energy_wh"] += (power + prev_power) / 2 * elapsed / 3600
+
+    add("gpu_busy", read_gpu_busy_percent())
+    cpu_temp, gpu_temp = read_hwmon_temps()
+    add("cpu_temp_c", cpu_temp)
+    add("gpu_temp_c", gpu_temp)
+
+    state["last_sample"] = now
+    state["cpu_seconds"] = cpu_seconds
+    state["power_w"]     = power
+    state["metrics"]     = {name: ring.to_dict() for name, ring in rings.items()}
+    _telemetry_unsaved   = True
+    save_telemetry_state()
+    latest["energy_wh"] = round(state["energy_wh"], 3)
+    latest["sampled"]   = int(now)
+    update_status(telemetry=latest)
+
+def finish_session_telemetry(session):
+    """Summarize and discard the telemetry of a closing session, or None without samples."""
+    global _telemetry_state, _telemetry_unsaved
+    if not TELEMETRY_ENABLED:
+        return None
+    state = load_telemetry_state(session.get("session_id"))
+    _telemetry_state   = None
+    _telemetry_unsaved = False
+    update_status(telemetry=None)
+    try:
+        os.remove(TELEMETRY_PATH)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print_log(f"Telemetry cleanup error: {e}")
+
+    summary = {}
+    samples = 0
+    for name in TELEMETRY_METRICS:
+        data = state["metrics"].get(name)
+        if not data:
+            continue
+        ring = MetricRing.from_dict(data)
+        stats = ring.summary()
+        if stats:
+            summary[name] = stats
+            samples = max(samples, ring.count)
+    if not summary:
+        return None
+    summary["sample_count"] = samples
+    summary["energy_wh"]    = round(state.get("energy_wh", 0.0), 3)
+    return summary
+
+# ===========================
+# MangoHud Frametimes
+# ===========================
+
+class FrametimeSketch:
+    """
+    Streaming quantile sketch for frametimes (log-spaced buckets, DDSketch style).
+
+    Every quantile is within `relative_accuracy` of the exact value and memory
+    only depends on the spread of frametimes, not on the number of frames, so
+    hours-long logs are summarized in a few hundred buckets.
+    """
+
+    def __init__(self, relative_accuracy=FRAMETIME_ACCURACY):
+        self.gamma     = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets   = {}
+        self.count     = 0
+        self.total     = 0.0
+
+    def add(self, value):
+        if value <= 0:
+            return
+        idx = math.ceil(math.log(value) / self.log_gamma)
+        self.buckets[idx] = self.buckets.get(idx, 0) + 1
+        self.count += 1
+        self.total += value
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank    = q * (self.count - 1)
+        running = 0
+        for idx in sorted(self.buckets):
+            running += self.buckets[idx]
+            if running > rank:
+                return 2 * self.gamma ** idx / (self.gamma + 1)
+        return None
+
+    def summary(self):
+        """FPS average, 1% / 0.1% lows (FPS at the p99 / p99.9 frametime) and p99 frametime."""
+        if not self.count:
+            return None
+        p99  = self.quantile(0.99)
+        p999 = self.quantile(0.999)
+        return {
+            "fps_avg":          round(1000 * self.count / self.total, 2),
+            "fps_1pct_low":     round(1000 / p99, 2),
+            "fps_01pct_low":    round(1000 / p999, 2),
+            "frametime_p99_ms": round(p99, 3),
+            "frame_count":      self.count,
+        }
+
+def iter_mangohud_frametimes(path):
+    """
+    Stream frametimes (ms) from a MangoHud CSV log line by line.
+    Everything before the header row containing a "frametime" column (the
+    system info block of newer MangoHud versions) is skipped.
+    """
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        column = None
+        for line in f:
+            if column is None:
+                header = [h.strip().lower() for h in line.split(",")]
+                if "frametime" in header:
+                    column = header.index("frametime")
+                continue
+            fields = line.split(",")
+            if len(fields) <= column:
+                continue
+            try:
+                value = float(fields[column])
+            except ValueError:
+                continue
+            if value > 0:
+                yield value
+
+def _mangohud_log_started(path, st):
+    """Start time of a log from its <program>_<YYYY-MM-DD_HH-MM-SS>.csv name, else its ctime."""
+    match = re.search(r'(\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2})', os.path.basename(path))
+    if match:
+        try:
+            return datetime.datetime.strptime(match.group(1), "%Y-%m-%d_%H-%M-%S").timestamp()
+        except ValueError:
+            pass
+    return st.st_ctime
+
+def find_mangohud_logs(start_time, end_time):
+    """MangoHud logs started during [start_time, end_time] and written to after start_time."""
+    logs = []
+    for log_dir in MANGOHUD_LOG_DIRS:
+        for path in glob.glob(os.path.join(log_dir, "*.csv")):
+            if path.endswith("_summary.csv"):
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            started = _mangohud_log_started(path, st)
+            if start_time - 5 <= started <= end_time and st.st_mtime >= start_time:
+                logs.append(path)
+    return sorted(logs)
+
+def summarize_mangohud_logs(paths):
+    sketch = FrametimeSketch()
+    for path in paths:
+        try:
+            for frametime in iter_mangohud_frametimes(path):
+                sketch.add(frametime)
+        except Exception as e:
+            print_log(f"MangoHud log read error ({path}): {e}")
+    summary = sketch.summary()
+    if summary:
+        summary["log_count"] = len(paths)
+    return summary
+
+def collect_session_frametimes(session):
+    """Frametime summary of the MangoHud logs written during a closing session, or None."""
+    if not MANGOHUD_ENABLED or session.get("start_time") is None:
+        return None
+    logs = find_mangohud_logs(session["start_time"], session.get("end_time") or time.time())
+    if not logs:
+        return None
+    summary = summarize_mangohud_logs(logs)
+    if summary:
+        print_log(
+            f"MangoHud: {summary['frame_count']} frames from {len(logs)} log(s), "
+            f"avg {summary['fps_avg']} FPS, 1% low {summary['fps_1pct_low']} FPS"
+        )
+    return summary
+
+MANGOHUD_SAMPLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "samples", "mangohud_sample.csv")
+
+def check_mangohud_sample(path=MANGOHUD_SAMPLE):
+    """
+    Summarize a sample log and compare the result with <name>_expected.json
+    next to it. Counts must match exactly; FPS and frametimes within
+    FRAMETIME_ACCURACY, the sketch's quantile guarantee. Returns True if all match.
+    """
+    with open(os.path.splitext(path)[0] + "_expected.json", "r") as f:
+        expected = json.load(f)
+    summary = summarize_mangohud_logs([path]) or {}
+    ok = True
+    for key, want in expected.items():
+        got = summary.get(key)
+        if isinstance(want, int):
+            match = got == want
+        else:
+            match = got is not None and abs(got - want) <= want * FRAMETIME_ACCURACY
+        ok = ok and match
+        print(f"{'ok' if match else 'MISMATCH':8} {key}: {got} (expected {want})")
+    return ok
+
 # ===========================
 # Network
 # ===========================
@@ -923,18 +1684,195 @@ def is_network_online():
         for line in output.splitlines()
     )
 
+# ===========================
+# Payload Encoding
+# ===========================
+
+def codec_available(fmt):
+    return (fmt == "json"
+            or (fmt == "msgpack" and msgpack is not None)
+            or (fmt == "cbor" and cbor2 is not None))
+
+def encode_payload(obj, fmt="json"):
+    """Serialize a payload. JSON is written compact — HA templates don't need the indentation."""
+    if fmt == "msgpack":
+        return msgpack.packb(obj, use_bin_type=True)
+    if fmt == "cbor":
+        return cbor2.dumps(obj)
+    return json.dumps(obj, separators=(",", ":"))
+
+_processor_capabilities = {}
+
+def negotiated_format():
+    """
+    PAYLOAD_FORMAT if the queue processor has advertised that it reads it over
+    MQTT with a compatible schema and the codec is installed here, else "json".
+    """
+    caps = _processor_capabilities
+    if (PAYLOAD_FORMAT != "json"
+            and codec_available(PAYLOAD_FORMAT)
+            and PAYLOAD_FORMAT in caps.get("formats", [])
+            and "mqtt" in caps.get("transports", [])
+            and caps.get("schema", 0) >= PAYLOAD_SCHEMA):
+        return PAYLOAD_FORMAT
+    return "json"
+
+# ===========================
+# Session Trace
+# ===========================
+
+def add_trace_stage(session, stage, at=None):
+    """Append [stage, unix time] to the session's trace."""
+    if not TRACE_ENABLED:
+        return
+    session.setdefault("trace", []).append([stage, round(at if at is not None else time.time(), 3)])
+
+def stamp_published(q, batch):
+    """Add the published stage to the batch's sessions the first time they go out."""
+    if not batch or not TRACE_ENABLED:
+        return
+    unstamped = [
+        s for s in q["active_sessions"]
+        if s["session_id"] in batch["session_ids"]
+        and not any(stage == "published" for stage, _ in s.get("trace", []))
+    ]
+    for session in unstamped:
+        add_trace_stage(session, "published")
+    if unstamped:
+        save_queue(q)
+
+def parse_ack_trace(payload):
+    """The trace carried by a per-session ACK ({"session_id", "trace"}), or None for a bare session_id."""
+    if not payload.startswith("{"):
+        return None
+    try:
+        trace = json.loads(payload).get("trace")
+    except (ValueError, AttributeError):
+        return None
+    return trace if isinstance(trace, list) else None
+
+def parse_ack_rejection(payload):
+    """The reason of a per-session ACK rejecting the session ({"session_id", "rejected"}), or None."""
+    if not payload.startswith("{"):
+        return None
+    try:
+        rejected = json.loads(payload).get("rejected")
+    except (ValueError, AttributeError):
+        return None
+    return str(rejected) if rejected else None
+
+def finish_session_trace(client, session, ack_trace, received_at):
+    """
+    Complete the trace of a session removed after its ACK, log its hop
+    latencies and publish it to steamdeck/playtime/trace. ack_trace is the
+    trace returned by the queue processor; without one (older processor) only
+    the Deck's own stages are reported.
+    """
+    if not TRACE_ENABLED or session is None:
+        return
+    trace = list(ack_trace or session.get("trace") or [])
+    trace.append(["ack_received", round(received_at, 3)])
+    trace.append(["removed", round(time.time(), 3)])
+    hops   = [(f"{a[0]}→{b[0]}", round(b[1] - a[1], 3)) for a, b in zip(trace, trace[1:])]
+    record = {
+        "session_id": session["session_id"],
+        "name":       session.get("name"),
+        "trace":      trace,
+        "hops":       dict(hops),
+        "total":      round(trace[-1][1] - trace[0][1], 3),
+    }
+    client.publish(f"{BASE_TOPIC}/playtime/trace", json.dumps(record))
+    print_log(
+        f"Trace {session['session_id']}: total {record['total']:.1f}s | "
+        + " | ".join(f"{hop} {seconds:.1f}s" for hop, seconds in hops)
+    )
+    update_status(last_trace=record)
+
 # ===========================
 # MQTT ACK handling
 # ===========================
 
+def quarantine_session(q, session_id, reason):
+    """
+    Move a session the queue processor rejected as invalid from the queue to
+    rejected_sessions.json, so it is no longer resent but can still be
+    inspected (and fixed and put back in the queue by hand).
+    """
+    session = next((s for s in q["active_sessions"] if s["session_id"] == session_id), None)
+    if session is None:
+        return
+    rejected = []
+    if os.path.exists(REJECTED_PATH):
+        try:
+            with open(REJECTED_PATH, "r") as f:
+                rejected = json.load(f)
+        except Exception as e:
+            print_log(f"Rejected sessions read error: {e}")
+    if not isinstance(rejected, list):
+        rejected = []
+    rejected.append({"session": session, "reason": reason, "rejected_at": int(time.time())})
+    tmp = REJECTED_PATH + ".tmp"
+    try:
+        with open(tmp, "w") as f:
+            json.dump(rejected, f, indent=2)
+        os.replace(tmp, REJECTED_PATH)
+    except Exception as e:
+        print_log(f"Rejected sessions write error, keeping {session_id} in the queue: {e}")
+        return
+    remove_session(q, session_id)
+    print_log(f"Queue: session {session_id} rejected by the queue processor ({reason}), moved to {REJECTED_PATH}")
+
+def parse_batch_ack(msg):
+    """
+    Return (seq, session_ids, traces, received_at, rejected) for a
+    steamdeck/playtime/batch_ack/<seq> message, or None. rejected maps the
+    sessions the processor rejected as invalid to the reason.
+    """
+    payload = msg.payload.decode("utf-8", errors="replace").strip()
+    parts   = msg.topic.split("/")
+    if not payload or len(parts) != 4 or not parts[3].isdigit():
+        return None
+    try:
+        message     = json.loads(payload)
+        session_ids = message.get("session_ids", [])
+        traces      = message.get("traces") or {}
+        rejected    = message.get("rejected") or {}
+        rejected    = {str(sid): str(reason) for sid, reason in rejected.items()}
+    except (ValueError, AttributeError):
+        return None
+    return int(parts[3]), [str(sid) for sid in session_ids], traces, time.time(), rejected
+
+def apply_batch_ack(client, q, seq, session_ids, traces=None, received_at=None, rejected=None):
+    """
+    Remove the sessions of an ACKed batch, quarantine the rejected ones, close
+    the batch and clear its retained ACK.
+    """
+    print_log(
+        f"Batch ACK received for sync batch {seq} ({len(session_ids)} session(s)"
+        + (f", {len(rejected)} rejected)" if rejected else ")")
+    )
+    received_at = received_at if received_at is not None else time.time()
+    for session_id in session_ids:
+        session = remove_session(q, session_id)
+        finish_session_trace(client, session, (traces or {}).get(session_id), received_at)
+    for session_id, reason in (rejected or {}).items():
+        quarantine_session(q, session_id, reason)
+    if (q.get("sync") or {}).get("seq") == seq:
+        q.pop("sync", None)
+        save_queue(q)
+    client.publish(f"{BASE_TOPIC}/playtime/batch_ack/{seq}", payload="", retain=True)
+
 def process_acks(client, q):
     """
-    Read retained ACK messages from steamdeck/playtime/ack/#.
+    Read retained ACK messages from steamdeck/playtime/ack/# and
+    steamdeck/playtime/batch_ack/#.
     For each ACK:
-      - Remove the session from the local queue
+      - Remove the session (or every session of the batch) from the local queue,
+        moving sessions rejected as invalid to rejected_sessions.json
       - Clear the retained ACK topic on MQTT
     """
     acked_session_ids = []
+    batch_acks        = []
 
     def on_message(c, userdata, msg):
         topic   = msg.topic
@@ -942,20 +1880,36 @@ def process_acks(client, q):
         if not payload:
             return
         parts = topic.split("/")
-        if len(parts) == 4 and parts[3]:
+        if topic == f"{BASE_TOPIC}/playtime/capabilities":
+            try:
+                _processor_capabilities.clear()
+                _processor_capabilities.update(json.loads(payload))
+            except (ValueError, TypeError):
+                pass
+        elif len(parts) == 4 and parts[2] == "batch_ack":
+            batch_ack = parse_batch_ack(msg)
+            if batch_ack:
+                batch_acks.append(batch_ack)
+        elif len(parts) == 4 and parts[3]:
             session_id = parts[3]
             print_log(f"ACK received for session {session_id}")
-            acked_session_ids.append(session_id)
+            acked_session_ids.append((session_id, parse_ack_trace(payload), parse_ack_rejection(payload), time.time()))
 
     client.on_message = on_message
     client.subscribe(f"{BASE_TOPIC}/playtime/ack/#")
+    client.subscribe(f"{BASE_TOPIC}/playtime/batch_ack/#")
+    client.subscribe(f"{BASE_TOPIC}/playtime/capabilities")
 
     client.loop_start()
     time.sleep(0.5)
     client.loop_stop()
 
-    for session_id in acked_session_ids:
-        remove_session(q, session_id)
+    for session_id, ack_trace, rejected, received_at in acked_session_ids:
+        if rejected:
+            quarantine_session(q, session_id, rejected)
+        else:
+            session = remove_session(q, session_id)
+            finish_session_trace(client, session, ack_trace, received_at)
         client.publish(
             f"{BASE_TOPIC}/playtime/ack/{session_id}",
             payload="",
@@ -963,6 +1917,128 @@ def process_acks(client, q):
         )
         print_log(f"Cleared ACK topic for session {session_id}")
 
+    for batch_ack in batch_acks:
+        apply_batch_ack(client, q, *batch_ack)
+
+    return q
+
+# ===========================
+# Backlog Sync
+# ===========================
+
+def current_sync_batch(q):
+    """
+    Return the outstanding sync batch {"seq", "session_ids"}, starting a new one
+    from the oldest closed sessions when none is open. The batch is stored in
+    the queue file so an interrupted sync resumes with the same batch.
+    Returns None when there are no closed sessions.
+    """
+    closed_ids = [s["session_id"] for s in q["active_sessions"] if s.get("game_state") == "closed"]
+    batch      = q.get("sync")
+    if batch:
+        pending = [sid for sid in batch.get("session_ids", []) if sid in closed_ids]
+        if pending:
+            batch["session_ids"] = pending
+            return batch
+    if not closed_ids:
+        if q.pop("sync", None):
+            save_queue(q)
+        return None
+    seq = q.get("sync_seq", 1)
+    q["sync_seq"] = seq + 1
+    q["sync"]     = {"seq": seq, "session_ids": closed_ids[:SYNC_BATCH_SIZE]}
+    save_queue(q)
+    return q["sync"]
+
+def build_queue_payload(q, batch, include_closed=True):
+    """
+    Queue payload: every open session plus the closed sessions of the current
+    batch, with the batch's sequence number. With include_closed=False only
+    the open sessions are included (JSON view when closed sessions go packed).
+    """
+    batch_ids = set(batch["session_ids"]) if batch and include_closed else set()
+    sessions  = [
+        s for s in q["active_sessions"]
+        if s.get("game_state") != "closed" or s["session_id"] in batch_ids
+    ]
+    payload = {"schema": PAYLOAD_SCHEMA, "deck": DECK_ID, "active_sessions": sessions}
+    if batch and include_closed:
+        closed = sum(1 for s in q["active_sessions"] if s.get("game_state") == "closed")
+        payload["sync"] = {
+            "seq":       batch["seq"],
+            "size":      len(batch_ids),
+            "remaining": closed - len(batch_ids),
+        }
+    return payload
+
+def publish_queue(client, q, batch):
+    """
+    Publish the queue for the current batch. In JSON mode everything goes on
+    steamdeck/playtime/queue. With a negotiated binary format the batch goes
+    on steamdeck/playtime/queue_packed and the JSON topic keeps the open
+    sessions for HA templates. Returns the published payload dict.
+    """
+    stamp_published(q, batch)
+    fmt     = negotiated_format()
+    payload = build_queue_payload(q, batch)
+    if fmt == "json":
+        client.publish(f"{BASE_TOPIC}/playtime/queue", encode_payload(payload), retain=True)
+        if q.pop("packed", None):
+            # Switched back to JSON — drop the stale retained packed batch
+            client.publish(f"{BASE_TOPIC}/playtime/queue_packed", payload="", retain=True)
+            save_queue(q)
+        return payload
+    if not q.get("packed"):
+        q["packed"] = True
+        save_queue(q)
+    payload["format"] = fmt
+    client.publish(f"{BASE_TOPIC}/playtime/queue_packed", encode_payload(payload, fmt), retain=True)
+    client.publish(
+        f"{BASE_TOPIC}/playtime/queue",
+        encode_payload(build_queue_payload(q, batch, include_closed=False)),
+        retain=True
+    )
+    return payload
+
+def sync_queue(client, q):
+    """
+    Publish the queue batch by batch. Every batch waits for its batch ACK before
+    the next one is published, so reconnecting after a long offline period sends
+    the backlog in bounded messages. Stops at the first batch that is not ACKed
+    within SYNC_ACK_TIMEOUT; it is resent on the next run.
+    Requires the MQTT network loop to be running.
+    """
+    batch_acks = {}
+
+    def on_message(c, userdata, msg):
+        batch_ack = parse_batch_ack(msg)
+        if batch_ack:
+            batch_acks[batch_ack[0]] = batch_ack
+
+    client.on_message = on_message
+
+    for _ in range(SYNC_MAX_BATCHES_PER_RUN):
+        batch   = current_sync_batch(q)
+        payload = publish_queue(client, q, batch)
+        if not batch:
+            print_log(f"Queue published: {len(payload['active_sessions'])} session(s)")
+            break
+        print_log(
+            f"Sync batch {batch['seq']} published: {payload['sync']['size']} closed session(s), "
+            f"{payload['sync']['remaining']} remaining"
+        )
+
+        deadline = time.time() + SYNC_ACK_TIMEOUT
+        while batch["seq"] not in batch_acks and time.time() < deadline:
+            time.sleep(0.1)
+        if batch["seq"] not in batch_acks:
+            print_log(f"Sync batch {batch['seq']} not ACKed yet, resuming next run")
+            break
+        apply_batch_ack(client, q, *batch_acks.pop(batch["seq"]))
+    else:
+        # Batch limit reached — replace the retained payload of the ACKed batch
+        publish_queue(client, q, current_sync_batch(q))
+
     return q
 
 # ===========================
@@ -975,6 +2051,7 @@ def run_update(offline_mode=False):
     online = is_network_online()
 
     detected_game, detected_appid, detected_type = detect_game()
+    update_status(game={"name": detected_game, "appid": detected_appid, "type": detected_type})
 
     # ── Load last run data ────────────────────────────────────────────────────
     runs     = load_last_run()
@@ -984,6 +2061,8 @@ def run_update(offline_mode=False):
     q = load_queue()
     update_queue_for_game(q, detected_game, detected_appid, last_run, online)
     q = load_queue()
+    sample_session_telemetry(get_open_session(q))
+    update_status(session=get_open_session(q), queue=queue_depth(q))
 
     # ── Collect sensor data (needed for last_run.json even when offline) ──────
     eth_check    = get_output("nmcli -t -f TYPE,STATE dev | grep 'ethernet:connected'")
@@ -1003,6 +2082,10 @@ def run_update(offline_mode=False):
         "| grep state | awk '{print $2}'"
     ).capitalize() or "Unknown"
     mode = "Game Mode" if get_output("ps -A | grep gamescope") else "Desktop Mode"
+    update_status(online=online, device={
+        "battery": battery, "charging": charging, "mode": mode,
+        "network": network_name, "docked": is_docked,
+    })
 
     if not online:
         print_log("Network offline. Skipping MQTT publish.")
@@ -1049,10 +2132,9 @@ def run_update(offline_mode=False):
         client.publish(f"{BASE_TOPIC}/appid",        detected_appid or "", retain=True)
         client.publish(f"{BASE_TOPIC}/availability", "online",      retain=True)
 
-        # ── Step 3: Publish playtime queue ────────────────────────────────────
-        queue_payload = json.dumps(q, indent=2)
-        client.publish(f"{BASE_TOPIC}/playtime/queue", queue_payload, retain=True)
-        print_log(f"Queue published: {len(q['active_sessions'])} session(s)")
+        # ── Step 3: Publish playtime queue, closed sessions in ACKed batches ──
+        q = sync_queue(client, q)
+        update_status(queue=queue_depth(q))
 
         time.sleep(1)
         client.loop_stop()
@@ -1071,5 +2153,354 @@ def run_update(offline_mode=False):
     except Exception as e:
         print_log(f"MQTT Error: {e}")
 
+# ===========================
+# Status API
+# ===========================
+
+# In-memory status served on STATUS_SOCKET. Keys: game, session, queue,
+# device, online, telemetry, last_trace, updated.
+_status_lock        = threading.Lock()
+_status             = {}
+_status_subscribers = []
+
+def queue_depth(q):
+    """Session counts of the queue for the status API."""
+    sessions = q["active_sessions"]
+    batch    = q.get("sync")
+    return {
+        "open":     sum(1 for s in sessions if s.get("game_state") == "opened"),
+        "closed":   sum(1 for s in sessions if s.get("game_state") == "closed"),
+        "sync_seq": batch["seq"] if batch else None,
+    }
+
+def _send_status_line(conn, obj):
+    conn.sendall((json.dumps(obj, separators=(",", ":")) + "\n").encode())
+
+def update_status(**fields):
+    """
+    Merge fields into the in-memory status and send the ones whose value
+    changed to every subscriber as one change event. Values are copied, so
+    later edits to the queue dict do not leak into the status. Subscriber
+    sockets are non-blocking, so a stuck client cannot hold _status_lock.
+    """
+    fields = copy.deepcopy(fields)
+    with _status_lock:
+        changed = {k: v for k, v in fields.items() if _status.get(k) != v}
+        _status.update(fields)
+        _status["updated"] = int(time.time())
+        if not changed or not _status_subscribers:
+            return
+        event = {"event": "change", "time": _status["updated"], "changed": changed}
+        for conn in list(_status_subscribers):
+            try:
+                _send_status_line(conn, event)
+            except OSError:
+                # Gone or its buffer is full — drop it rather than stall the update
+                _status_subscribers.remove(conn)
+                conn.close()
+
+def _prune_status_subscribers():
+    """Drop subscribers that hung up. Subscribers never send, so readable means closed. Call with _status_lock held."""
+    if not _status_subscribers:
+        return
+    readable, _, _ = select.select(_status_subscribers, [], [], 0)
+    for conn in readable:
+        _status_subscribers.remove(conn)
+        conn.close()
+
+def _handle_status_client(conn):
+    """
+    One request line per connection:
+      status        → the full status as one JSON line
+      get <key>     → {"<key>": value}
+      subscribe     → a snapshot event, then one change event per update until
+                      the client disconnects
+    An empty line is treated as status.
+    """
+    conn.settimeout(1)
+    words   = conn.makefile("r").readline().split()
+    command = words[0] if words else "status"
+    with _status_lock:
+        if command == "subscribe":
+            _prune_status_subscribers()
+            if len(_status_subscribers) >= STATUS_MAX_SUBSCRIBERS:
+                reply = {"error": "too many subscribers"}
+            else:
+                # The snapshot fits the empty socket buffer; later sends must not block
+                conn.setblocking(False)
+                _send_status_line(conn, {"event": "snapshot", "status": _status})
+                _status_subscribers.append(conn)
+                return
+        elif command == "status":
+            reply = copy.deepcopy(_status)
+        elif command == "get" and len(words) == 2:
+            reply = {words[1]: copy.deepcopy(_status.get(words[1]))}
+        else:
+            reply = {"error": f"unknown command: {' '.join(words)}"}
+    _send_status_line(conn, reply)
+    conn.close()
+
+def _serve_status(server, stop_event):
+    while not stop_event.is_set():
+        try:
+            conn, _ = server.accept()
+        except socket.timeout:
+            continue
+        except OSError:
+            return
+        try:
+            _handle_status_client(conn)
+        except OSError:
+            conn.close()
+
+def close_status_subscribers():
+    with _status_lock:
+        for conn in _status_subscribers:
+            try:
+                _send_status_line(conn, {"event": "shutdown", "time": int(time.time())})
+            except OSError:
+                pass
+            conn.close()
+        _status_subscribers.clear()
+
+def query_status(command="status"):
+    """Client side of the status API: print the daemon's reply lines (streams for subscribe)."""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(STATUS_SOCKET)
+            sock.sendall(f"{command}\n".encode())
+            for line in sock.makefile("r"):
+                print(line, end="", flush=True)
+    except (FileNotFoundError, ConnectionRefusedError):
+        print("Status API not available — is the --daemon instance running?", file=sys.stderr)
+        return False
+    except KeyboardInterrupt:
+        pass
+    return True
+
+# ===========================
+# Single Instance & Request Coalescing
+# ===========================
+
+REQUEST_KINDS = ("tick", "resume", "offline")
+
+_pending_requests = queue.Queue()
+
+def acquire_instance_lock(timeout=0):
+    """Take the exclusive instance lock, waiting up to timeout seconds. Returns the lock file or None."""
+    lock_file = open(LOCK_PATH, "a")
+    deadline  = time.time() + timeout
+    while True:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return lock_file
+        except BlockingIOError:
+            if time.time() >= deadline:
+                lock_file.close()
+                return None
+            time.sleep(0.2)
+
+def hand_off_request(kind):
+    """
+    Pass a request to the running instance over CONTROL_SOCKET.
+
+    tick/resume return as soon as the request is queued. offline waits until
+    the run has finished so the offline state is published before the system
+    suspends. Returns True if the running instance accepted the request.
+    """
+    wait = (kind == "offline")
+    for _ in range(5):
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.settimeout(HANDOFF_TIMEOUT_SECONDS)
+                sock.connect(CONTROL_SOCKET)
+                sock.sendall(f"{kind}{' wait' if wait else ''}\n".encode())
+                reply = sock.makefile("r").readline().strip()
+                return reply in ("queued", "done")
+        except (FileNotFoundError, ConnectionRefusedError):
+            # Lock holder is starting up or shutting down — retry briefly
+            time.sleep(0.2)
+        except OSError as e:
+            print_log(f"Hand-off error: {e}")
+            return False
+    return False
+
+def _serve_control(server, stop_event):
+    while not stop_event.is_set():
+        try:
+            conn, _ = server.accept()
+        except socket.timeout:
+            continue
+        except OSError:
+            return
+        try:
+            conn.settimeout(2)
+            words = conn.makefile("r").readline().split()
+            kind  = words[0] if words else ""
+            if kind not in REQUEST_KINDS:
+                conn.sendall(b"error\n")
+                conn.close()
+            elif "wait" in words[1:]:
+                _pending_requests.put((kind, conn))
+            else:
+                conn.sendall(b"queued\n")
+                conn.close()
+                _pending_requests.put((kind, None))
+        except OSError:
+            conn.close()
+
+def start_socket_server(path, serve):
+    """Bind a Unix socket at path and run serve(server, stop_event) in a thread."""
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(8)
+    server.settimeout(0.5)
+    stop_event = threading.Event()
+    thread = threading.Thread(target=serve, args=(server, stop_event), daemon=True)
+    thread.start()
+    return path, server, stop_event, thread
+
+def stop_socket_server(path, server, stop_event, thread):
+    stop_event.set()
+    thread.join(timeout=3)
+    server.close()
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+def next_request_burst(timeout=0):
+    """
+    Wait up to timeout seconds for a request, then collect everything else that
+    arrives within COALESCE_SECONDS. The burst runs once: offline wins over
+    timer ticks racing the suspend, and only a later resume cancels it.
+    Returns (kind, waiters) or (None, []).
+    """
+    try:
+        burst = [_pending_requests.get(timeout=timeout) if timeout > 0 else _pending_requests.get_nowait()]
+    except queue.Empty:
+        return None, []
+    time.sleep(COALESCE_SECONDS)
+    while True:
+        try:
+            burst.append(_pending_requests.get_nowait())
+        except queue.Empty:
+            break
+    kind = burst[0][0]
+    for next_kind, _ in burst[1:]:
+        if kind != "offline" or next_kind == "resume":
+            kind = next_kind
+    if len(burst) > 1:
+        print_log(f"Coalesced {len(burst)} requests into one '{kind}' run")
+    return kind, [conn for _, conn in burst if conn is not None]
+
+def run_request(kind, waiters=()):
+    try:
+        run_update(offline_mode=(kind == "offline"))
+    except Exception as e:
+        print_log(f"Update error: {e}")
+    finally:
+        for conn in waiters:
+            try:
+                conn.sendall(b"done\n")
+                conn.close()
+            except OSError:
+                pass
+
+def run_daemon(kind):
+    """
+    Keep running: update every UPDATE_INTERVAL_SECONDS, serve hand-offs and
+    sample session telemetry in between. After an offline request the periodic
+    update pauses until the next request (resume) or five minutes have passed.
+    """
+    waiters      = []
+    cache_built  = time.time()
+    next_sample  = 0
+    while True:
+        if time.time() - cache_built >= CACHE_REFRESH_SECONDS:
+            refresh_caches()
+            cache_built = time.time()
+        run_request(kind, waiters)
+        pause     = 300 if kind == "offline" else UPDATE_INTERVAL_SECONDS
+        next_tick = time.time() + pause
+
+        while True:
+            now = time.time()
+            if now >= next_tick:
+                kind, waiters = "tick", []
+                break
+            if TELEMETRY_ENABLED and kind != "offline" and now >= next_sample:
+                sample_session_telemetry(get_open_session(load_queue()))
+                next_sample = now + TELEMETRY_SAMPLE_SECONDS
+            wake = min(next_tick, next_sample) if kind != "offline" else next_tick
+            kind_req, waiters = next_request_burst(timeout=max(0.05, wake - time.time()))
+            if kind_req:
+                kind = kind_req
+                break
+
+def main(argv):
+    kind   = "offline" if "--offline" in argv else ("resume" if "--resume" in argv else "tick")
+    daemon = "--daemon" in argv
+
+    lock = acquire_instance_lock()
+    if lock is None:
+        if daemon:
+            print_log("Another instance already holds the lock, not starting daemon")
+            return
+        if hand_off_request(kind):
+            print_log(f"Handed '{kind}' request to the running instance")
+            return
+        # Running instance did not answer — wait for it to finish and run ourselves
+        lock = acquire_instance_lock(timeout=HANDOFF_TIMEOUT_SECONDS)
+        if lock is None:
+            print_log(f"Instance lock busy, dropping '{kind}' request")
+            return
+
+    # systemd stops the daemon with SIGTERM — unwind so the socket is removed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    refresh_caches()
+    control = start_socket_server(CONTROL_SOCKET, _serve_control)
+    status  = start_socket_server(STATUS_SOCKET, _serve_status) if daemon else None
+    try:
+        if daemon:
+            run_daemon(kind)
+        else:
+            run_request(kind)
+            # Requests that arrived during the run are served in one more run per burst
+            while True:
+                next_kind, waiters = next_request_burst()
+                if next_kind is None:
+                    break
+                run_request(next_kind, waiters)
+    finally:
+        if status:
+            stop_socket_server(*status)
+            close_status_subscribers()
+        stop_socket_server(*control)
+        # Anything accepted while shutting down still gets its run
+        next_kind, waiters = next_request_burst()
+        if next_kind:
+            run_request(next_kind, waiters)
+        save_telemetry_state(force=True)
+        lock.close()
+
 if __name__ == "__main__":
-    run_update(offline_mode="--offline" in sys.argv)
+    if "--mangohud-summary" in sys.argv:
+        # Summarize MangoHud CSV logs given on the command line, e.g. to check a sample log
+        logs = sys.argv[sys.argv.index("--mangohud-summary") + 1:]
+        print(json.dumps(summarize_mangohud_logs(logs), indent=2))
+    elif "--mangohud-check" in sys.argv:
+        # Check the parser and sketch against a sample log with known stats (the bundled one by default)
+        logs = sys.argv[sys.argv.index("--mangohud-check") + 1:]
+        sys.exit(0 if check_mangohud_sample(*logs[:1]) else 1)
+    elif "--status" in sys.argv:
+        # Query the running daemon, e.g. `--status`, `--status get game` or `--status --watch`
+        args = [a for a in sys.argv[sys.argv.index("--status") + 1:] if a != "--watch"]
+        sys.exit(0 if query_status("subscribe" if "--watch" in sys.argv else " ".join(args) or "status") else 1)
+    else:
+        main(sys.argv[1:])